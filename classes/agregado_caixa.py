@@ -0,0 +1,76 @@
+from collections import defaultdict
+
+
+class AgregadoCaixa:
+    """
+        Agregados das demandas ordenadas por id_caixa (maior dist_arruamento,
+        soma do market-index, quantidade, primeira e última demanda), mantidos a
+        cada escrita do id_caixa para que as consultas não precisem varrer nem
+        copiar a layer_demandas_ordenadas.
+    """
+
+    def __init__(self):
+        # id da demanda -> [id_caixa, dist_arruamento, market-index]
+        self.demandas = {}
+        # id_caixa -> ids das demandas da caixa
+        self.membros = defaultdict(set)
+        # id_caixa -> agregados já calculados; invalidado quando uma demanda sai da caixa
+        self.cache = {}
+
+    def adiciona(self, id, id_caixa, dist_arruamento, market_index):
+        self.demandas[id] = [None, dist_arruamento, market_index]
+        self.move(id, id_caixa)
+
+    def move(self, id, id_caixa):
+        demanda = self.demandas[id]
+        id_caixa_antigo = demanda[0]
+        if id_caixa_antigo == id_caixa:
+            return
+
+        if id_caixa_antigo is not None:
+            self.membros[id_caixa_antigo].discard(id)
+            self.cache.pop(id_caixa_antigo, None)
+
+        demanda[0] = id_caixa
+        if id_caixa is not None:
+            self.membros[id_caixa].add(id)
+            agregado = self.cache.get(id_caixa)
+            if agregado is not None:
+                self.acumula(agregado, id, demanda[1], demanda[2])
+
+    @staticmethod
+    def acumula(agregado, id, dist_arruamento, market_index):
+        if agregado['max_dist_arruamento'] is None or dist_arruamento > agregado['max_dist_arruamento']:
+            agregado['max_dist_arruamento'] = dist_arruamento
+        agregado['soma_market_index'] += market_index or 0
+        agregado['quantidade'] += 1
+        if agregado['primeira_demanda'] is None or id < agregado['primeira_demanda']:
+            agregado['primeira_demanda'] = id
+        if agregado['ultima_demanda'] is None or id > agregado['ultima_demanda']:
+            agregado['ultima_demanda'] = id
+
+    def get(self, id_caixa):
+        agregado = self.cache.get(id_caixa)
+        if agregado is None:
+            agregado = self.calcula(self.membros.get(id_caixa, ()))
+            self.cache[id_caixa] = agregado
+        return agregado
+
+    def calcula(self, ids):
+        agregado = {
+            'max_dist_arruamento': None,
+            'soma_market_index': 0,
+            'quantidade': 0,
+            'primeira_demanda': None,
+            'ultima_demanda': None,
+        }
+        for id in ids:
+            _, dist_arruamento, market_index = self.demandas[id]
+            self.acumula(agregado, id, dist_arruamento, market_index)
+        return agregado
+
+    def maior_distancia(self, id_caixa, lista_demandas=None):
+        if lista_demandas:
+            ids = self.membros.get(id_caixa, set()).intersection(lista_demandas)
+            return self.calcula(ids)['max_dist_arruamento']
+        return self.get(id_caixa)['max_dist_arruamento']
@@ -1,15 +1,48 @@
 import math
+from collections import OrderedDict
 
+import numpy as np
+import shapely
 from osgeo import ogr
 
+from classes.armazem_demandas import ArmazemDemandas
+from classes.indice_espacial import IndiceDinamico, IndiceEspacial, para_ogr, para_shapely
+from classes.instrumentacao import instrumenta
+
 ogr.UseExceptions()
 
 
+def constroi_caixas(linhas, dists_maximas):
+    """
+        Buffer das caixas para arrays de linhas e dist. máximas, numa única
+        chamada vetorizada por buffer: FLAT/MITRE (limite 2.5) na dist. máxima,
+        seguido de FLAT/MITRE (limite 2.0) de 1.5 m, como o ST_Buffer aninhado
+        do antigo SQL das caixas.
+
+        Returns:
+            list: polígono shapely de cada linha, ou None quando vazio.
+    """
+    buffers = shapely.buffer(
+        np.asarray(linhas, dtype=object), np.asarray(dists_maximas, dtype=np.float64),
+        cap_style='flat', join_style='mitre', mitre_limit=2.5,
+    )
+    caixas = shapely.buffer(buffers, 1.5, cap_style='flat', join_style='mitre', mitre_limit=2.0)
+    return [None if caixa is None or caixa.is_empty else caixa for caixa in caixas]
+
+
 class AreaCaixa:
-    def __init__(self, datasource_entrada, layer='areas_de_caixa', distancia_buffer=5):
+    def __init__(self, datasource_entrada, layer='areas_de_caixa', distancia_buffer=5, armazem=None):
         self.datasource_entrada = datasource_entrada
         self.layer = layer
         self.buffer = distancia_buffer
+        self.armazem = armazem
+        # caixas inseridas/apagadas, em ordem, para os recalculos incrementais
+        self.alteracoes = []
+        self.posicao_consumidores = {}
+        self.indice_demandas = None
+        # índice das caixas já aceitas, atualizado a cada inserção/remoção
+        self.indice_caixas = IndiceDinamico()
+        self.cache_unioes = OrderedDict()
         self.cria_layer()
 
     def __str__(self):
@@ -34,137 +67,245 @@ class AreaCaixa:
     def get_srs(self):
         return self.datasource_entrada.GetLayer().GetSpatialRef()
 
-    def check_arruamento_intercepta_caixa(self, pol_caixa_wkt):
-        sql = f'''
-                SELECT  "StreetCode_associado", geometry
-                FROM areas_de_caixa
-                WHERE ST_Intersects(geometry, ST_GeomFromText('{pol_caixa_wkt}'))
-              '''
-        query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
-        qtde_caixas_interceptadas = query.GetFeatureCount()
+    def registra_alteracao(self, fid, geometria, inserida=True):
+        self.alteracoes.append((fid, geometria.Clone(), inserida))
+        if inserida:
+            self.indice_caixas.insere(fid, para_shapely(geometria))
+        else:
+            self.indice_caixas.remove(fid)
+
+    def fixa_caixas(self, geometrias):
+        """
+            Caixas mantidas de uma execução anterior (replanejamento incremental):
+            entram só no índice, com FIDs negativos, e barram as caixas novas
+            como as demais, sem entrar na layer nem nos recálculos (ver
+            replanejamento.caixas_mantidas para o que isso aproxima).
+
+            Args:
+                geometrias: geometrias shapely das caixas.
+        """
+        for fid, geometria in enumerate(geometrias, start=1):
+            self.indice_caixas.insere(-fid, geometria)
+
+    def consome_alteracoes(self, consumidor):
+        """
+            Retorna as caixas inseridas ou apagadas desde a última chamada do
+            consumidor, como tuplas (fid, geometria, inserida). Na primeira
+            chamada retorna None, indicando que o consumidor deve recalcular tudo.
+        """
+        posicao = self.posicao_consumidores.get(consumidor)
+        self.posicao_consumidores[consumidor] = len(self.alteracoes)
+        if posicao is None:
+            return None
+        return self.alteracoes[posicao:]
+
+    def get_armazem(self):
+        # sem um armazém compartilhado com Demanda, monta um a partir da layer na primeira consulta
+        if self.armazem is None:
+            self.armazem = ArmazemDemandas.carrega(self.datasource_entrada.GetLayer('layer_demandas_ordenadas'))
+        return self.armazem
+
+    def get_indice_demandas(self):
+        # as geometrias das demandas ordenadas não mudam depois da ordenação
+        lyr_demandas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
+        if self.indice_demandas is None or len(self.indice_demandas) != lyr_demandas.GetFeatureCount():
+            self.indice_demandas = IndiceEspacial(lyr_demandas, campos=('market-index',))
+        return self.indice_demandas
+
+    def check_arruamento_intercepta_caixa(self, pol_caixa):
+        """
+            Retorna a quantidade de caixas existentes que interceptam o polígono,
+            consultando o índice das caixas mantido em memória.
+
+            Args:
+                pol_caixa: geometria OGR ou shapely da caixa candidata.
+        """
+        if isinstance(pol_caixa, ogr.Geometry):
+            pol_caixa = para_shapely(pol_caixa)
+        return len(self.indice_caixas.interceptados(pol_caixa))
+
+    @instrumenta
+    def calcula_market_index(self):
+        """
+            Atualiza o market-index das caixas: a soma das demandas contidas em
+            cada feição (o GROUP BY id_caixa, geometry do SQL original, uma
+            linha por feição), mesmo quando várias feições têm o mesmo
+            id_caixa. A primeira chamada calcula todas as caixas; as seguintes
+            só as caixas inseridas desde a chamada anterior, já que as demais
+            não mudam.
+        """
+        areas_de_caixas = self.datasource_entrada.GetLayer('areas_de_caixa')
+        alteracoes = self.consome_alteracoes('market_index')
 
-        self.datasource_entrada.ReleaseResultSet(query)
+        if alteracoes is None:
+            fids = [feature.GetFID() for feature in areas_de_caixas]
+        else:
+            apagadas = {fid for fid, _, inserida in alteracoes if not inserida}
+            fids = list(dict.fromkeys(
+                fid for fid, _, inserida in alteracoes if inserida and fid not in apagadas
+            ))
 
-        return qtde_caixas_interceptadas
+        if not fids:
+            return areas_de_caixas
 
-    def calcula_market_index(self):
-        sql = '''
-        SELECT a.id_caixa, a.geometry, SUM(b."market-index") AS soma_market_index
-        FROM  areas_de_caixa a, layer_demandas_ordenadas b
-        WHERE ST_Contains(a.geometry, b.geometry)
-        GROUP BY a.id_caixa, a.geometry
-        '''
-        query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
-        areas_de_caixas = self.datasource_entrada.GetLayer('areas_de_caixa')
-        areas_de_caixas.StartTransaction()
+        features = [areas_de_caixas.GetFeature(fid) for fid in fids]
+        caixas = shapely.from_wkb([bytes(feature.GetGeometryRef().ExportToWkb()) for feature in features])
 
-        dados = {}
-        for row in query:
-            dados[row['id_caixa']] = row['soma_market_index']
+        indice_demandas = self.get_indice_demandas()
+        market_index = np.asarray(indice_demandas.atributos['market-index'], dtype=float)
+        caixa, demanda = indice_demandas.arvore.query(caixas, predicate='contains')
+        soma_market_index = np.bincount(caixa, weights=market_index[demanda], minlength=len(caixas))
+        tem_demanda = np.bincount(caixa, minlength=len(caixas)) > 0
 
-        for feature in areas_de_caixas:
-            if feature['id_caixa'] in dados:
-                feature.SetField('market-index', dados[feature['id_caixa']])
+        areas_de_caixas.StartTransaction()
+        for feature, soma, contem in zip(features, soma_market_index.tolist(), tem_demanda.tolist()):
+            # sem nenhuma demanda contida, a feição não aparecia no resultado do SQL
+            if contem:
+                feature.SetField('market-index', soma)
                 areas_de_caixas.SetFeature(feature)
-
         areas_de_caixas.CommitTransaction()
-        self.datasource_entrada.ReleaseResultSet(query)
 
         return areas_de_caixas
 
-    def caixa_sql_query(self, dist_maxima_arruamento, where_clause='1=1'):
-        sql = f'''
-                    SELECT 
-                            BufferOptions_SetEndCapStyle('FLAT'),
-                            BufferOptions_SetJoinStyle('MITRE'),
-                            BufferOptions_SetMitreLimit(2.0),
-                        tmp."StreetCode_associado", 
-                        ST_Buffer(tmp.geometry_buffer, 1.5) AS geometry 
-                    FROM        
-                        (SELECT
-                            BufferOptions_SetEndCapStyle('FLAT'),
-                            BufferOptions_SetJoinStyle('MITRE'),
-                            BufferOptions_SetMitreLimit(2.5),
-                            "StreetCode" AS 'StreetCode_associado',
-                            ST_Buffer(geometry, {dist_maxima_arruamento}) AS geometry_buffer
-                        FROM lyr_arruamento_recortado
-                        WHERE {where_clause}
-                        ) tmp
-                    '''
-        return sql
-
-    def add_area_caixa(self, id_caixa, dist_maxima_arruamento):
-        caixa_criada = False
+    def constroi_caixas(self, dists_caixas):
+        """
+            Constrói, numa única chamada vetorizada, as caixas de vários
+            id_caixa a partir dos seus trechos em lyr_arruamento_recortado
+            (ver constroi_caixas).
+
+            Args:
+                dists_caixas: {id_caixa: dist. máxima do arruamento}.
+
+            Returns:
+                dict: {id_caixa: [(polígono shapely, StreetCode), ...]}, na ordem dos trechos.
+        """
+        caixas = {id_caixa: [] for id_caixa in dists_caixas}
+        if not caixas:
+            return caixas
+
         lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
-        lyr_arruamento_recortado.SetAttributeFilter(f"id_caixa = '{id_caixa}'")
-        sql = self.caixa_sql_query(dist_maxima_arruamento)
-        query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
+        ids_caixa = ','.join(f"'{id_caixa}'" for id_caixa in caixas)
+        lyr_arruamento_recortado.SetAttributeFilter(f'id_caixa IN ({ids_caixa})')
+
+        chaves, wkbs, dists = [], [], []
+        for feature in lyr_arruamento_recortado:
+            geometria = feature.GetGeometryRef()
+            dist_maxima_arruamento = dists_caixas[feature['id_caixa']]
+            # sem linha ou sem dist. máxima, o ST_Buffer do SQL também não gerava caixa
+            if geometria is None or dist_maxima_arruamento is None:
+                continue
+            chaves.append((feature['id_caixa'], feature['StreetCode']))
+            wkbs.append(bytes(geometria.ExportToWkb()))
+            dists.append(dist_maxima_arruamento)
+        lyr_arruamento_recortado.SetAttributeFilter(None)
+
+        poligonos = constroi_caixas(shapely.from_wkb(wkbs), dists) if wkbs else []
+        for (id_caixa, street_code), poligono in zip(chaves, poligonos):
+            if poligono is not None:
+                caixas[id_caixa].append((poligono, street_code))
+        return caixas
+
+    @instrumenta
+    def add_area_caixa(self, id_caixa, dist_maxima_arruamento, caixas=None):
+        """
+            Args:
+                caixas: polígonos já construídos por constroi_caixas para o
+                    id_caixa; se None, são construídos aqui.
+        """
+        caixa_criada = False
+        if caixas is None:
+            caixas = self.constroi_caixas({id_caixa: dist_maxima_arruamento})[id_caixa]
 
         self.get_layer().StartTransaction()
 
-        for row in query:
-            if row['geometry']:
-                feature = ogr.Feature(self.get_layer().GetLayerDefn())
-                feature.SetGeometry(row['geometry'])
-                pol_caixa_wkt = feature.GetGeometryRef().ExportToWkt()
-
-                if not self.check_arruamento_intercepta_caixa(pol_caixa_wkt):
-                    feature.SetField('id_caixa', id_caixa)
-                    feature.SetField('StreetCode_associado', row['StreetCode_associado'])
-                    feature.SetField('market-index', None)
-                    feature.SetField('dist_max', dist_maxima_arruamento)
-                    feature.SetField('ordem', 1)
-                    self.get_layer().SetFeature(feature)
-                    caixa_criada = True
+        for poligono, street_code in caixas:
+            if self.insere_caixa_primaria(para_ogr(poligono), id_caixa, street_code, dist_maxima_arruamento):
+                caixa_criada = True
 
         self.get_layer().CommitTransaction()
-        self.datasource_entrada.ReleaseResultSet(query)
-        lyr_arruamento_recortado.SetAttributeFilter(None)
 
         return caixa_criada
 
-    def add_area_caixa_secundaria(self, id_caixa, dist_maxima_arruamento):
+    def insere_caixa_primaria(self, geometria, id_caixa, street_code, dist_maxima_arruamento):
+        """
+            Insere uma caixa primária já construída, desde que ela não intercepte
+            nenhuma das caixas existentes.
+
+            Returns:
+                bool: True se a caixa foi inserida.
+        """
+        if self.check_arruamento_intercepta_caixa(geometria):
+            return False
+
+        feature = ogr.Feature(self.get_layer().GetLayerDefn())
+        feature.SetGeometry(geometria)
+        feature.SetField('id_caixa', id_caixa)
+        feature.SetField('StreetCode_associado', street_code)
+        feature.SetField('market-index', None)
+        feature.SetField('dist_max', dist_maxima_arruamento)
+        feature.SetField('ordem', 1)
+        self.get_layer().SetFeature(feature)
+        self.registra_alteracao(feature.GetFID(), feature.GetGeometryRef())
+
+        return True
+
+    @instrumenta
+    def add_area_caixa_secundaria(self, id_caixa, dist_maxima_arruamento, caixas=None):
+        """
+            Args:
+                caixas: polígonos já construídos por constroi_caixas para o
+                    id_caixa; se None, são construídos aqui.
+        """
         caixa_criada = False
-        lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
-        lyr_arruamento_recortado.SetAttributeFilter(f"id_caixa = '{id_caixa}'")
-
-        if lyr_arruamento_recortado.GetFeatureCount():
-            sql = self.caixa_sql_query(
-                dist_maxima_arruamento=dist_maxima_arruamento,
-                where_clause=f"id_caixa = '{id_caixa}'")
-            query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
+        if caixas is None:
+            caixas = self.constroi_caixas({id_caixa: dist_maxima_arruamento})[id_caixa]
 
+        if caixas:
             self.get_layer().StartTransaction()
 
-            for row in query:
+            for poligono, street_code in caixas:
                 feature = ogr.Feature(self.get_layer().GetLayerDefn())
-                if not row['geometry'].IsEmpty():
-                    feature.SetGeometry(row['geometry'])
-                    pol_caixa = feature.GetGeometryRef()
-
-                    # ver se é necessário continuar aqui depois da criacao do subtrai_area_sem_demanda
-                    for feat_caixa in self.get_layer(pol_caixa.Buffer(30)):
-                        geom_caixa = feat_caixa.GetGeometryRef()
-                        if geom_caixa.Intersects(pol_caixa):
-                            pol_caixa = pol_caixa.Difference(geom_caixa)
-                        else:
-                            pass
-
-                    feature.SetGeometry(pol_caixa)
-                    feature.SetField('id_caixa', id_caixa)
-                    feature.SetField('StreetCode_associado', row['StreetCode_associado'])
-                    feature.SetField('market-index', None)
-                    feature.SetField('dist_max', dist_maxima_arruamento)
-                    feature.SetField('ordem', 2)
-                    self.get_layer().SetFeature(feature)
-                    caixa_criada = True
+                # ver se é necessário continuar aqui depois da criacao do subtrai_area_sem_demanda
+                pol_caixa = self.subtrai_caixas_vizinhas(poligono)
+
+                feature.SetGeometry(para_ogr(pol_caixa))
+                feature.SetField('id_caixa', id_caixa)
+                feature.SetField('StreetCode_associado', street_code)
+                feature.SetField('market-index', None)
+                feature.SetField('dist_max', dist_maxima_arruamento)
+                feature.SetField('ordem', 2)
+                self.get_layer().SetFeature(feature)
+                self.registra_alteracao(feature.GetFID(), feature.GetGeometryRef())
+                caixa_criada = True
 
             self.get_layer().CommitTransaction()
-            self.datasource_entrada.ReleaseResultSet(query)
-        lyr_arruamento_recortado.SetAttributeFilter(None)
 
         return caixa_criada
 
+    def subtrai_caixas_vizinhas(self, pol_caixa):
+        """
+            Remove do polígono (shapely) as caixas existentes que o interceptam,
+            com uma única diferença contra a união das vizinhas.
+        """
+        vizinhas = self.indice_caixas.interceptados(pol_caixa)
+        if not vizinhas:
+            return pol_caixa
+        return shapely.difference(pol_caixa, self.get_uniao_caixas(vizinhas))
+
+    def get_uniao_caixas(self, fids):
+        # a chave é o conjunto de FIDs: inserções e remoções geram chaves novas
+        chave = frozenset(fids)
+        uniao = self.cache_unioes.get(chave)
+        if uniao is None:
+            uniao = shapely.union_all([self.indice_caixas.geometrias[fid] for fid in fids])
+            self.cache_unioes[chave] = uniao
+            if len(self.cache_unioes) > 256:
+                self.cache_unioes.popitem(last=False)
+        else:
+            self.cache_unioes.move_to_end(chave)
+        return uniao
+
+    @instrumenta
     def remove_sobreposicoes(self):
         areas_1 = self.datasource_entrada.CopyLayer(self.get_layer(), 'areas_1')
         areas_1.SetAttributeFilter("ordem = 1")
@@ -190,17 +331,18 @@ class AreaCaixa:
         self.datasource_entrada.DeleteLayer('areas_1')
         self.datasource_entrada.DeleteLayer('areas_2')
 
+    @instrumenta
     def absorve_demandas_sem_caixa(self):
-        lyr_demandas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        lyr_demandas.SetAttributeFilter('associado = 0')
+        armazem = self.get_armazem()
 
         caixas_delete_list = []
         caixa_mais_proxima = None  # Initialize caixa_mais_proxima outside the loop
 
-        for demanda in lyr_demandas:
-            geom_demanda = demanda.GetGeometryRef()
+        for linha in np.flatnonzero(armazem['associado'] == 0).tolist():
+            geom_demanda = ogr.Geometry(ogr.wkbPoint)
+            geom_demanda.AddPoint_2D(*armazem.ponto(linha))
             areas_caixa = self.get_layer(geom_demanda.Buffer(20))
-            areas_caixa.SetAttributeFilter(f''' StreetCode_associado = {demanda['StreetCode']} ''')
+            areas_caixa.SetAttributeFilter(f''' StreetCode_associado = {armazem['StreetCode'][linha]} ''')
             for caixa in areas_caixa:
                 geom_caixa = caixa.GetGeometryRef()
 
@@ -255,11 +397,15 @@ class AreaCaixa:
         lyr = self.get_layer(bbox=None)
         lyr.SetAttributeFilter(None)
 
-        lyr_demandas.SetSpatialFilter(None)
-        lyr_demandas.SetAttributeFilter(None)
-
         for fid in list(set(caixas_delete_list)):
-            self.get_layer().DeleteFeature(fid)
+            self.apaga_caixa(fid)
+
+    def apaga_caixa(self, fid, geometria=None):
+        lyr = self.datasource_entrada.GetLayer(self.layer)
+        if geometria is None:
+            geometria = lyr.GetFeature(fid).GetGeometryRef()
+        self.registra_alteracao(fid, geometria, inserida=False)
+        lyr.DeleteFeature(fid)
 
     def identifica_caixas_m8(self):
         self.get_layer().SetAttributeFilter(' "market-index" > 8')
@@ -267,30 +413,32 @@ class AreaCaixa:
         self.get_layer().SetAttributeFilter(None)
         return id_caixas_list
 
+    @instrumenta
     def get_parametros_caixas_m8(self):
         id_caixas_maiores_8 = self.identifica_caixas_m8()
-        demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
+        armazem = self.get_armazem()
         street_code_caixa_demandas = []
 
         for id_caixa, caixa_market_index in id_caixas_maiores_8:
-            street_code = id_caixa.split('.')[0]
-            demandas_ordenadas.SetAttributeFilter(f"id_caixa = '{id_caixa}'")
+            linhas = armazem.linhas_caixa(id_caixa).tolist()
+            if not linhas:
+                continue
+            # o StreetCode da própria demanda (int), a chave da ReferenciaLinear do arruamento
+            street_code = int(armazem['StreetCode'][linhas[0]])
             lista_demandas_caixa_1 = []
             lista_demandas_caixa_2 = []
             pontos_caixa_1 = []
             pontos_caixa_2 = []
             acum = 0
 
-            for demanda in demandas_ordenadas:
-                geom = demanda.GetGeometryRef()
-                acum += demanda['market-index']
+            for linha in linhas:
+                acum += armazem['market-index'][linha]
                 if acum <= caixa_market_index / 2:
-                    lista_demandas_caixa_1.append(demanda['id'])
-                    pontos_caixa_1.append(geom.ExportToWkt())
+                    lista_demandas_caixa_1.append(int(armazem['id'][linha]))
+                    pontos_caixa_1.append(armazem.ponto(linha))
                 else:
-                    lista_demandas_caixa_2.append(demanda['id'])
-                    pontos_caixa_2.append(geom.ExportToWkt())
-
+                    lista_demandas_caixa_2.append(int(armazem['id'][linha]))
+                    pontos_caixa_2.append(armazem.ponto(linha))
 
             if len(pontos_caixa_1) and len(pontos_caixa_2):
                 caixa_1 = {
@@ -313,8 +461,6 @@ class AreaCaixa:
                 street_code_caixa_demandas.append(caixa_1)
                 street_code_caixa_demandas.append(caixa_2)
 
-        demandas_ordenadas.SetAttributeFilter(None)
-
         return street_code_caixa_demandas
 
     # def get_parametros_caixas_m8(self):
@@ -360,25 +506,25 @@ class AreaCaixa:
     #
     #     return street_code_caixa_demandas
 
+    @instrumenta
     def apaga_caixas_8m(self):
         id_caixas_8m = [id_caixa[0] for id_caixa in self.identifica_caixas_m8()]
-        demandas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        demandas.StartTransaction()
+        armazem = self.get_armazem()
         for id_caixa in id_caixas_8m:
-            demandas.SetAttributeFilter(f"id_caixa = '{id_caixa}'")
-            for demanda in demandas:
-                demanda.SetField('id_caixa', None)
-                demandas.SetFeature(demanda)
-
-        demandas.CommitTransaction()
-        demandas.SetAttributeFilter(None)
+            for linha in armazem.linhas_caixa(id_caixa).tolist():
+                armazem.set_id_caixa(linha, None)
 
         for id_caixa in id_caixas_8m:
-            self.get_layer().SetAttributeFilter(f"id_caixa ='{id_caixa}'")
-            self.get_layer().StartTransaction()
+            self.apaga_caixas_id(id_caixa)
 
-            for feature in self.get_layer():
-                self.get_layer().DeleteFeature(feature.GetFID())
+    def apaga_caixas_id(self, id_caixa):
+        """ Apaga todas as feições do id_caixa. """
+        lyr = self.get_layer()
+        lyr.SetAttributeFilter(f"id_caixa = '{id_caixa}'")
+        caixas = [(feature.GetFID(), feature.GetGeometryRef().Clone()) for feature in lyr]
+        lyr.SetAttributeFilter(None)
 
-            self.get_layer().CommitTransaction()
-            self.get_layer().SetAttributeFilter(None)
+        lyr.StartTransaction()
+        for fid, geometria in caixas:
+            self.apaga_caixa(fid, geometria)
+        lyr.CommitTransaction()
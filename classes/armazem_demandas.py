@@ -0,0 +1,144 @@
+from collections import defaultdict
+
+import numpy as np
+import shapely
+
+from classes.agregado_caixa import AgregadoCaixa
+
+
+class ArmazemDemandas:
+    """
+        Armazém colunar das demandas ordenadas. Cada campo é um array e cada
+        demanda uma linha; há índices hash por id e por StreetCode, e a
+        pertinência às caixas é a do AgregadoCaixa. Depois da ordenação é o
+        armazém, e não a layer_demandas_ordenadas, que guarda o id_caixa e o
+        associado de cada demanda: Demanda, AreaCaixa e Arruamento os leem e
+        alteram aqui, sem SetAttributeFilter nem SetFeature, e a layer só
+        recebe os valores finais em grava, antes da exportação. O campo fid
+        guarda a feição correspondente de cada linha.
+    """
+
+    COLUNAS = {
+        'fid': np.int64,
+        'id': np.int64,
+        'id_demanda': np.int64,
+        'StreetCode': np.int64,
+        'market-index': np.float64,
+        'dist_arruamento': np.float64,
+        'id_caixa': object,
+        'associado': np.int8,
+        'x': np.float64,
+        'y': np.float64,
+    }
+
+    def __init__(self, capacidade=1024):
+        self.n = 0
+        self.colunas = {nome: np.zeros(capacidade, dtype=tipo) for nome, tipo in self.COLUNAS.items()}
+        self.linha_por_id = {}
+        self.por_street_code = defaultdict(list)
+        self.agregado = AgregadoCaixa()
+        # linhas com id_caixa ou associado alterados desde a última gravação na layer
+        self.alteradas = set()
+        self.arvore = None
+
+    @classmethod
+    def carrega(cls, layer):
+        """ Monta o armazém a partir de uma layer com o esquema da layer_demandas_ordenadas. """
+        armazem = cls(capacidade=max(layer.GetFeatureCount(), 1))
+        for feature in layer:
+            geometria = feature.GetGeometryRef()
+            armazem.adiciona(
+                feature['id'], feature['id_demanda'], feature['StreetCode'], feature['market-index'],
+                feature['dist_arruamento'], feature['id_caixa'], geometria.GetX(), geometria.GetY(),
+                associado=feature['associado'] or 0, fid=feature.GetFID(),
+            )
+        layer.ResetReading()
+        return armazem
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, coluna):
+        return self.colunas[coluna][:self.n]
+
+    def cresce(self):
+        capacidade = max(2 * len(self.colunas['id']), 1)
+        for nome, array in self.colunas.items():
+            novo = np.zeros(capacidade, dtype=array.dtype)
+            novo[:self.n] = array[:self.n]
+            self.colunas[nome] = novo
+
+    def adiciona(self, id, id_demanda, street_code, market_index, dist_arruamento, id_caixa, x, y,
+                 associado=0, fid=-1):
+        if self.n == len(self.colunas['id']):
+            self.cresce()
+
+        linha = self.n
+        valores = {
+            'fid': fid, 'id': id, 'id_demanda': id_demanda, 'StreetCode': street_code,
+            'market-index': market_index, 'dist_arruamento': dist_arruamento, 'id_caixa': id_caixa,
+            'associado': associado, 'x': x, 'y': y,
+        }
+        for nome, valor in valores.items():
+            self.colunas[nome][linha] = valor
+        self.n += 1
+
+        self.linha_por_id[id] = linha
+        self.por_street_code[street_code].append(linha)
+        self.agregado.adiciona(id, id_caixa, dist_arruamento, market_index)
+
+        return linha
+
+    def set_id_caixa(self, linha, id_caixa):
+        id_caixa_antigo = self.colunas['id_caixa'][linha]
+        if id_caixa_antigo == id_caixa:
+            return
+        self.colunas['id_caixa'][linha] = id_caixa
+        self.agregado.move(int(self.colunas['id'][linha]), id_caixa)
+        self.alteradas.add(linha)
+
+    def set_associado(self, linha, associado):
+        if self.colunas['associado'][linha] == associado:
+            return
+        self.colunas['associado'][linha] = associado
+        self.alteradas.add(linha)
+
+    def linhas_caixa(self, id_caixa):
+        """ Linhas das demandas de uma caixa, na ordem do id. """
+        ids = sorted(self.agregado.membros.get(id_caixa, ()))
+        return np.asarray([self.linha_por_id[id] for id in ids], dtype=np.int64)
+
+    def linhas_street_code(self, street_code):
+        """ Linhas das demandas de um arruamento, na ordem do id. """
+        return np.asarray(self.por_street_code.get(street_code, ()), dtype=np.int64)
+
+    def ponto(self, linha):
+        return float(self.colunas['x'][linha]), float(self.colunas['y'][linha])
+
+    def pontos(self):
+        return shapely.points(self['x'], self['y'])
+
+    def get_arvore(self):
+        """ STRtree dos pontos das demandas; as posições são as linhas do armazém. """
+        # as coordenadas não mudam depois da ordenação: só novas linhas invalidam a árvore
+        if self.arvore is None or len(self.arvore) != self.n:
+            self.arvore = shapely.STRtree(self.pontos())
+        return self.arvore
+
+    def grava(self, layer):
+        """
+            Grava na layer (a layer_demandas_ordenadas de onde vêm os fids) o
+            id_caixa e o associado das linhas alteradas desde a última gravação.
+
+            Returns:
+                layer: a própria layer.
+        """
+        layer.StartTransaction()
+        for linha in sorted(self.alteradas):
+            feature = layer.GetFeature(int(self.colunas['fid'][linha]))
+            feature.SetField('id_caixa', self.colunas['id_caixa'][linha])
+            feature.SetField('associado', int(self.colunas['associado'][linha]))
+            layer.SetFeature(feature)
+        layer.CommitTransaction()
+        self.alteradas.clear()
+        return layer
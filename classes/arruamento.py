@@ -1,12 +1,18 @@
 from osgeo import ogr
 
+from classes.armazem_demandas import ArmazemDemandas
+from classes.instrumentacao import instrumenta
+from classes.referencia_linear import ReferenciaLinear, para_ogr_linha
+
 ogr.UseExceptions()
 
 
 class Arruamento:
-    def __init__(self, datasource_entrada, layer='layer_arruamento'):
+    def __init__(self, datasource_entrada, layer='layer_arruamento', armazem=None):
         self.datasource_entrada = datasource_entrada
         self.layer = layer
+        self.armazem = armazem
+        self.referencia = None
         self.cria_arruamento_recortado()
 
     def __str__(self):
@@ -18,6 +24,19 @@ class Arruamento:
     def get_srs(self):
         return self.get_layer().GetSpatialRef()
 
+    def get_referencia(self):
+        # medidas das ruas calculadas na primeira consulta; o arruamento não muda durante o fluxo
+        if self.referencia is None:
+            self.referencia = ReferenciaLinear(self.get_layer())
+        return self.referencia
+
+    def get_armazem(self):
+        # sem um armazém compartilhado com Demanda, monta um a partir da layer na primeira consulta
+        if self.armazem is None:
+            self.armazem = ArmazemDemandas.carrega(self.datasource_entrada.GetLayer('layer_demandas_ordenadas'))
+        return self.armazem
+
+    @instrumenta
     def ordena_arruamento_por_comprimento(self, lista_street_code):
         street_codes = ','.join(str(street_code) for street_code in lista_street_code)
 
@@ -54,47 +73,61 @@ class Arruamento:
 
         return lyr_arruamentos_recortados
 
+    @instrumenta
     def recorta_arruamento(self, ponto_inicial, ponto_final, streetcode, id_caixa):
+        """
+            Recorta as feições do arruamento do StreetCode entre as projeções
+            dos pontos (x, y) e grava os trechos em lyr_arruamento_recortado.
+        """
         lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
-        sql = f'''
-                SELECT StreetCode,
-                        ST_Line_Substring(
-                            geometry,
-                            ST_Line_Locate_Point(
-                                geometry,
-                                ST_ClosestPoint(
-                                    geometry,
-                                    ST_GeomFromText('{ponto_inicial}')
-                                )
-                            ),
-                            ST_Line_Locate_Point(
-                                geometry,
-                                ST_ClosestPoint(
-                                    geometry,
-                                    ST_GeomFromText('{ponto_final}')
-                                )
-                            )
-                        ) AS geometry
-                FROM {self.layer}
-                WHERE StreetCode = {streetcode}
-        '''
-        query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
 
         lyr_arruamento_recortado.StartTransaction()
 
-        for row in query:
-            if row['geometry']:
-                feature = ogr.Feature(lyr_arruamento_recortado.GetLayerDefn())
-                feature.SetGeometry(row['geometry'])
-                feature.SetField('StreetCode', streetcode)
-                feature.SetField('id_caixa', id_caixa)
-                lyr_arruamento_recortado.SetFeature(feature)
+        for _, trecho in self.get_referencia().recorta(streetcode, ponto_inicial, ponto_final):
+            self.insere_arruamento_recortado(para_ogr_linha(trecho), streetcode, id_caixa)
 
         lyr_arruamento_recortado.CommitTransaction()
-        self.datasource_entrada.ReleaseResultSet(query)
 
         return lyr_arruamento_recortado
 
+    @instrumenta
+    def recorta_arruamento_em_lote(self, streetcode, caixas):
+        """
+            Recorta o arruamento do StreetCode para todas as suas caixas de uma
+            vez: cada feição é percorrida uma única vez e todos os trechos são
+            gravados numa única transação, na mesma ordem de chamadas
+            sucessivas a recorta_arruamento.
+
+            Args:
+                streetcode: StreetCode do arruamento.
+                caixas: [(id_caixa, ponto_inicial, ponto_final), ...], na ordem das demandas.
+
+            Returns:
+                layer: lyr_arruamento_recortado.
+        """
+        lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
+        pares = [(ponto_inicial, ponto_final) for _, ponto_inicial, ponto_final in caixas]
+        trechos_caixas = self.get_referencia().recorta_em_lote(streetcode, pares)
+
+        lyr_arruamento_recortado.StartTransaction()
+
+        for (id_caixa, _, _), trechos in zip(caixas, trechos_caixas):
+            for _, trecho in trechos:
+                self.insere_arruamento_recortado(para_ogr_linha(trecho), streetcode, id_caixa)
+
+        lyr_arruamento_recortado.CommitTransaction()
+
+        return lyr_arruamento_recortado
+
+    def insere_arruamento_recortado(self, geometria, streetcode, id_caixa):
+        lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
+        feature = ogr.Feature(lyr_arruamento_recortado.GetLayerDefn())
+        feature.SetGeometry(geometria)
+        feature.SetField('StreetCode', streetcode)
+        feature.SetField('id_caixa', id_caixa)
+        lyr_arruamento_recortado.SetFeature(feature)
+
+    @instrumenta
     def apaga_arruamento_recortado(self, id_caixa):
         lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
         lyr_arruamento_recortado.SetAttributeFilter(f"id_caixa ='{id_caixa}'")
@@ -112,76 +145,30 @@ class Arruamento:
         lyr_arruamento_recortado.SetAttributeFilter(None)
 
 
+    @instrumenta
     def get_arruamento_recortado_secundario(self, caixas_secundarias):
         lyr_arruamento_recortado = self.datasource_entrada.GetLayer('lyr_arruamento_recortado')
-        self.datasource_entrada.CopyLayer(
-            lyr_arruamento_recortado,
-            'lyr_arruamento_recortado_tmp'
-        )
+        # trechos atuais, por id_caixa: os inseridos abaixo não são recortados de novo
+        recortados = ReferenciaLinear(lyr_arruamento_recortado, 'id_caixa', ('StreetCode',)).carrega()
+        armazem = self.get_armazem()
 
         for id_caixa in caixas_secundarias:
             if id_caixa.count('.') >= 2:
                 id_atual = id_caixa[:-2]
 
-                sql = f'''SELECT *
-                        FROM layer_demandas_ordenadas
-                        WHERE id_caixa = '{id_caixa}'
-                        ORDER BY id ASC LIMIT 1                
-                    '''
-                query = self.datasource_entrada.ExecuteSQL(sql)
-
-                feicao_inicial = query.GetNextFeature()
-                ponto_inicial = feicao_inicial.GetGeometryRef().ExportToWkt()
-                self.datasource_entrada.ReleaseResultSet(query)
-
-                sql = f'''SELECT *
-                    FROM layer_demandas_ordenadas
-                    WHERE id_caixa = '{id_caixa}'
-                    ORDER BY id DESC LIMIT 1                
-                '''
-                query = self.datasource_entrada.ExecuteSQL(sql)
-                feicao_final = query.GetNextFeature()
-                ponto_final = feicao_final.GetGeometryRef().ExportToWkt()
-                self.datasource_entrada.ReleaseResultSet(query)
-
-                sql = f'''
-                        SELECT '{id_caixa}' AS id_caixa, StreetCode,
-                                ST_Line_Substring(
-                                    geometry,
-                                    ST_Line_Locate_Point(
-                                        geometry,
-                                        ST_ClosestPoint(
-                                            geometry,
-                                            ST_GeomFromText('{ponto_inicial}')
-                                        )
-                                    ),
-                                    ST_Line_Locate_Point(
-                                        geometry,
-                                        ST_ClosestPoint(
-                                            geometry,
-                                            ST_GeomFromText('{ponto_final}')
-                                        )
-                                    )
-                                ) AS geometry
-                        FROM lyr_arruamento_recortado_tmp
-                        WHERE id_caixa = '{id_atual}'
-                '''
-                query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
-
-                lyr_arruamento_recortado.StartTransaction()
-
-                for row in query:
-                    if row['geometry']:
-                        feature = ogr.Feature(lyr_arruamento_recortado.GetLayerDefn())
-                        feature.SetGeometry(row['geometry'])
-                        feature.SetField('StreetCode', row['streetcode'])
-                        feature.SetField('id_caixa', id_caixa)
-                        lyr_arruamento_recortado.SetFeature(feature)
-                        break
-
-                lyr_arruamento_recortado.CommitTransaction()
-                self.datasource_entrada.ReleaseResultSet(query)
-
-        self.datasource_entrada.DeleteLayer('lyr_arruamento_recortado_tmp')
+                agregado = armazem.agregado.get(id_caixa)
+                if not agregado['quantidade']:
+                    continue
+                ponto_inicial = armazem.ponto(armazem.linha_por_id[agregado['primeira_demanda']])
+                ponto_final = armazem.ponto(armazem.linha_por_id[agregado['ultima_demanda']])
+
+                if id_atual not in recortados:
+                    continue
+                trechos = recortados.recorta(id_atual, ponto_inicial, ponto_final)
+                if trechos:
+                    linha, trecho = trechos[0]
+                    lyr_arruamento_recortado.StartTransaction()
+                    self.insere_arruamento_recortado(para_ogr_linha(trecho), linha.atributos['StreetCode'], id_caixa)
+                    lyr_arruamento_recortado.CommitTransaction()
 
         return lyr_arruamento_recortado
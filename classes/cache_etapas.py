@@ -0,0 +1,138 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from osgeo import ogr
+
+from classes.instrumentacao import logger
+
+ogr.UseExceptions()
+
+DIRETORIO_CLASSES = os.path.dirname(os.path.abspath(__file__))
+
+
+def hash_arquivos(caminhos):
+    """ SHA-256 do nome e do conteúdo dos arquivos, lidos em blocos. """
+    sha = hashlib.sha256()
+    for caminho in sorted(caminhos):
+        sha.update(os.path.basename(caminho).encode())
+        with open(caminho, 'rb') as arquivo:
+            for bloco in iter(lambda: arquivo.read(1 << 20), b''):
+                sha.update(bloco)
+    return sha.hexdigest()
+
+
+def versao_codigo():
+    """ Hash do código de classes/: alterar o algoritmo invalida o cache. """
+    return hash_arquivos(glob.glob(os.path.join(DIRETORIO_CLASSES, '*.py')))
+
+
+class CacheEtapas:
+    """
+        Cache em disco das saídas intermediárias do fluxo, endereçado pelo
+        conteúdo: a chave de uma etapa é o hash do seu nome, dos seus
+        parâmetros e da chave da etapa anterior (para a primeira etapa, o hash
+        dos arquivos de entrada), de modo que a mudança de uma entrada
+        invalida todas as etapas seguintes.
+
+        Cada entrada é um diretório <chave>/ com um GeoPackage das layers da
+        etapa (FIDs preservados) e um meta.json com os demais valores. Passando
+        de limite_mb, as entradas usadas há mais tempo são apagadas.
+    """
+
+    def __init__(self, diretorio, limite_mb=2048):
+        self.diretorio = diretorio
+        self.limite = limite_mb * 1024 * 1024
+        self.versao = versao_codigo()
+        os.makedirs(diretorio, exist_ok=True)
+
+    def chave(self, etapa, anterior, parametros=None):
+        conteudo = json.dumps([etapa, anterior, parametros or {}, self.versao], sort_keys=True, default=str)
+        return hashlib.sha256(conteudo.encode()).hexdigest()
+
+    def caminho(self, chave):
+        return os.path.join(self.diretorio, chave)
+
+    def obtem(self, chave):
+        """ meta.json da entrada (e marca a entrada como usada), ou None. """
+        caminho_meta = os.path.join(self.caminho(chave), 'meta.json')
+        if not os.path.exists(caminho_meta):
+            return None
+        os.utime(caminho_meta)
+        with open(caminho_meta) as arquivo:
+            return json.load(arquivo)
+
+    def restaura(self, chave, datasource):
+        """
+            Copia as layers da entrada para o DataSource, substituindo as de
+            mesmo nome. As layers são recriadas como no fluxo (geometria sem
+            nome, que o SQL do SQLite enxerga como "geometry") e com os FIDs
+            originais.
+        """
+        ds_cache = ogr.Open(os.path.join(self.caminho(chave), 'layers.gpkg'))
+        for i in range(ds_cache.GetLayerCount()):
+            origem = ds_cache.GetLayerByIndex(i)
+            nome = origem.GetName()
+            if datasource.GetLayerByName(nome) is not None:
+                datasource.DeleteLayer(nome)
+
+            layer = datasource.CreateLayer(nome, srs=origem.GetSpatialRef(), geom_type=origem.GetGeomType())
+            defn_origem = origem.GetLayerDefn()
+            for j in range(defn_origem.GetFieldCount()):
+                layer.CreateField(defn_origem.GetFieldDefn(j))
+
+            layer.StartTransaction()
+            for feature_origem in origem:
+                feature = ogr.Feature(layer.GetLayerDefn())
+                feature.SetFrom(feature_origem)
+                feature.SetFID(feature_origem.GetFID())
+                layer.CreateFeature(feature)
+            layer.CommitTransaction()
+        ds_cache = None
+
+    def grava(self, chave, datasource, layers, meta=None):
+        """
+            Grava as layers (nomes no DataSource) e o meta da etapa. A entrada
+            é montada num diretório temporário e renomeada no fim, para que
+            uma execução interrompida não deixe uma entrada pela metade.
+        """
+        temporario = tempfile.mkdtemp(dir=self.diretorio, prefix='.tmp_')
+        try:
+            ds_cache = ogr.GetDriverByName('GPKG').CreateDataSource(os.path.join(temporario, 'layers.gpkg'))
+            for nome in layers:
+                ds_cache.CopyLayer(datasource.GetLayerByName(nome), nome)
+            ds_cache = None
+            with open(os.path.join(temporario, 'meta.json'), 'w') as arquivo:
+                json.dump(meta or {}, arquivo)
+
+            destino = self.caminho(chave)
+            if os.path.exists(destino):
+                shutil.rmtree(destino)
+            os.replace(temporario, destino)
+        finally:
+            if os.path.exists(temporario):
+                shutil.rmtree(temporario)
+
+        self.despeja()
+
+    def despeja(self):
+        entradas = []
+        for caminho in glob.glob(os.path.join(self.diretorio, '*', 'meta.json')):
+            entrada = os.path.dirname(caminho)
+            try:
+                tamanho = sum(os.path.getsize(arquivo) for arquivo in glob.glob(os.path.join(entrada, '*')))
+                entradas.append((os.path.getmtime(caminho), tamanho, entrada))
+            except OSError:
+                # apagada por outro processo que usa o mesmo cache
+                continue
+
+        total = sum(tamanho for _, tamanho, _ in entradas)
+        for _, tamanho, entrada in sorted(entradas):
+            if total <= self.limite:
+                break
+            logger.debug('cache: apagando %s', os.path.basename(entrada))
+            shutil.rmtree(entrada, ignore_errors=True)
+            total -= tamanho
@@ -0,0 +1,187 @@
+import os
+from collections import OrderedDict
+
+from osgeo import ogr
+
+ogr.UseExceptions()
+
+# campos que o fluxo lê de cada layer de entrada; os demais não são carregados
+CAMPOS_LAYERS = {
+    'layer_arruamento': ('StreetCode',),
+    'layer_alinhamento_predial': ('id_alinhamento_predial',),
+    'layer_demandas': ('id_demanda', 'market-index'),
+    'layer_lotes': ('StreetCode',),
+}
+
+# nome da layer no DataSource de trabalho: arquivo de entrada
+ARQUIVOS_LAYERS = {
+    'layer_arruamento': 'layer_arruamento.geojson',
+    'layer_alinhamento_predial': 'layer_alinhamento_predial.geojson',
+    'layer_demandas': 'layer_demandas.geojson',
+    'layer_lotes': 'layer_lote.geojson',
+}
+
+# layers que não mudam entre execuções de uma mesma área
+LAYERS_ESTATICAS = ('layer_arruamento', 'layer_alinhamento_predial', 'layer_lotes')
+
+
+def get_delimitacao(input_dir, arquivo='layer_delimitacao.geojson'):
+    """ União dos polígonos de layer_delimitacao, ou None quando a área não tem a layer. """
+    caminho = os.path.join(input_dir, arquivo)
+    if not os.path.exists(caminho):
+        return None
+
+    ds = ogr.Open(caminho)
+    delimitacao = None
+    for feature in ds.GetLayer():
+        geometria = feature.GetGeometryRef()
+        delimitacao = geometria.Clone() if delimitacao is None else delimitacao.Union(geometria)
+    return delimitacao
+
+
+def carrega_layer(datasource, caminho, nome, campos, delimitacao=None):
+    """
+        Copia uma layer de entrada para o DataSource de trabalho mantendo só a
+        geometria e os campos declarados. As feições são lidas uma a uma (os
+        demais campos são ignorados pelo driver) e gravadas numa transação,
+        preservando os FIDs de origem, como o CopyLayer.
+
+        Args:
+            datasource: DataSource de destino (em memória).
+            caminho: arquivo de entrada.
+            nome: nome da layer criada no destino.
+            campos: campos a manter.
+            delimitacao: se informada, só as feições que a interceptam são
+                carregadas, inteiras: é um filtro, as geometrias não são
+                recortadas nela.
+
+        Returns:
+            ogr.Layer: layer criada no destino.
+    """
+    ds_origem = ogr.Open(caminho)
+    lyr_origem = ds_origem.GetLayer()
+    defn_origem = lyr_origem.GetLayerDefn()
+
+    indices = []
+    for campo in campos:
+        indice = defn_origem.GetFieldIndex(campo)
+        if indice < 0:
+            raise KeyError(f'campo {campo} não encontrado em {caminho}')
+        indices.append(indice)
+
+    lyr_origem.SetIgnoredFields([
+        defn_origem.GetFieldDefn(i).GetName() for i in range(defn_origem.GetFieldCount()) if i not in indices
+    ])
+    if delimitacao is not None:
+        lyr_origem.SetSpatialFilter(delimitacao)
+
+    layer = datasource.CreateLayer(nome, srs=lyr_origem.GetSpatialRef(), geom_type=lyr_origem.GetGeomType())
+    for indice in indices:
+        layer.CreateField(defn_origem.GetFieldDefn(indice))
+    defn = layer.GetLayerDefn()
+
+    layer.StartTransaction()
+    for feature_origem in lyr_origem:
+        feature = ogr.Feature(defn)
+        feature.SetFID(feature_origem.GetFID())
+        feature.SetGeometry(feature_origem.GetGeometryRef())
+        for i, indice in enumerate(indices):
+            feature.SetField(i, feature_origem.GetField(indice))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+    return layer
+
+
+def arquivos_entrada(input_dir, recorta=False):
+    """ Arquivos lidos por carrega_area, para compor a chave do cache de etapas. """
+    arquivos = list(ARQUIVOS_LAYERS.values()) + (['layer_delimitacao.geojson'] if recorta else [])
+    caminhos = [os.path.join(input_dir, arquivo) for arquivo in arquivos]
+    return [caminho for caminho in caminhos if os.path.exists(caminho)]
+
+
+class CamadasEstaticas:
+    """
+        Layers estáticas (arruamento, alinhamento predial, lotes) já lidas dos
+        arquivos para a memória, por área, como carrega_layer as deixa (mesmo
+        sistema de coordenadas, só os campos usados e, com recorta, só as
+        feições que interceptam a delimitação), para processos que atendem
+        vários jobs seguidos. A entrada de uma área é recarregada quando a data ou o
+        tamanho de algum arquivo muda; passando de max_areas, a área usada há
+        mais tempo é descartada.
+    """
+
+    def __init__(self, max_areas=16):
+        self.max_areas = max_areas
+        self.areas = OrderedDict()
+
+    @staticmethod
+    def assinatura(input_dir, recorta):
+        arquivos = [ARQUIVOS_LAYERS[nome] for nome in LAYERS_ESTATICAS]
+        if recorta:
+            arquivos.append('layer_delimitacao.geojson')
+        assinatura = []
+        for arquivo in arquivos:
+            caminho = os.path.join(input_dir, arquivo)
+            if os.path.exists(caminho):
+                estado = os.stat(caminho)
+                assinatura.append((arquivo, estado.st_mtime_ns, estado.st_size))
+        return tuple(assinatura)
+
+    def get(self, input_dir, recorta=False, campos_layers=CAMPOS_LAYERS):
+        """ DataSource em memória com as layers estáticas da área. """
+        chave = (os.path.abspath(input_dir), recorta)
+        assinatura = self.assinatura(input_dir, recorta)
+
+        entrada = self.areas.get(chave)
+        if entrada is not None and entrada[0] == assinatura:
+            self.areas.move_to_end(chave)
+            return entrada[1]
+
+        datasource = ogr.GetDriverByName('Memory').CreateDataSource('estaticas')
+        delimitacao = get_delimitacao(input_dir) if recorta else None
+        for nome in LAYERS_ESTATICAS:
+            caminho = os.path.join(input_dir, ARQUIVOS_LAYERS[nome])
+            if os.path.exists(caminho):
+                carrega_layer(datasource, caminho, nome, campos_layers[nome], delimitacao)
+
+        self.areas[chave] = (assinatura, datasource)
+        self.areas.move_to_end(chave)
+        if len(self.areas) > self.max_areas:
+            self.areas.popitem(last=False)
+        return datasource
+
+
+def carrega_area(datasource, input_dir, recorta=False, campos_layers=CAMPOS_LAYERS, estaticas=None):
+    """
+        Carrega as layers de entrada de uma área no DataSource de trabalho.
+        A layer de lotes é opcional; as demais são obrigatórias.
+
+        Args:
+            datasource: DataSource de destino (em memória).
+            input_dir: diretório com as layers de entrada (layer_*.geojson).
+            recorta: carrega só as feições que interceptam layer_delimitacao
+                (sem efeito quando a área não tem a layer).
+            campos_layers: campos mantidos em cada layer.
+            estaticas: CamadasEstaticas; as layers estáticas são copiadas dela
+                (em memória) em vez de lidas dos arquivos.
+
+        Returns:
+            dict: quantidade de feições carregadas por layer.
+    """
+    delimitacao = get_delimitacao(input_dir) if recorta else None
+    ds_estaticas = estaticas.get(input_dir, recorta, campos_layers) if estaticas is not None else None
+
+    quantidades = {}
+    for nome, arquivo in ARQUIVOS_LAYERS.items():
+        caminho = os.path.join(input_dir, arquivo)
+        if nome == 'layer_lotes' and not os.path.exists(caminho):
+            continue
+        if ds_estaticas is not None and nome in LAYERS_ESTATICAS:
+            # CopyLayer preserva os FIDs, como carrega_layer
+            layer = datasource.CopyLayer(ds_estaticas.GetLayerByName(nome), nome)
+        else:
+            layer = carrega_layer(datasource, caminho, nome, campos_layers[nome], delimitacao)
+        quantidades[nome] = layer.GetFeatureCount()
+
+    return quantidades
@@ -1,7 +1,13 @@
 from collections import defaultdict
 
+import numpy as np
+import shapely
 from osgeo import ogr
 
+from classes.armazem_demandas import ArmazemDemandas
+from classes.indice_espacial import IndiceEspacial, geometrias_layer, para_shapely
+from classes.instrumentacao import instrumenta
+
 ogr.UseExceptions()
 
 
@@ -9,6 +15,7 @@ class Demanda:
     def __init__(self, datasource_entrada, layer='layer_demandas'):
         self.datasource_entrada = datasource_entrada
         self.layer = layer
+        self.armazem = ArmazemDemandas()
         self.demandas_ordenadas = self.cria_demandas_ordenadas_por_arruamento()
         self.cria_layer_linhas_demandas()
 
@@ -21,44 +28,38 @@ class Demanda:
     def get_srs(self):
         return self.get_layer().GetSpatialRef()
 
+    @instrumenta
     def associa_streetcode_demanda(self, layer_com_street_code):
         self.get_layer().CreateField(ogr.FieldDefn('StreetCode', ogr.OFTInteger))
         lyr_com_street_code = self.datasource_entrada.GetLayer(layer_com_street_code.GetName())
 
         lyr_alvo_index = self.get_indice_espacial(lyr_com_street_code)
 
-        for feat in self.get_layer():
-            nearest_feature_fid = self.encontra_feicao_mais_proxima(feat, lyr_alvo_index)
-            if nearest_feature_fid is not None:
-                nearest_feature = lyr_com_street_code.GetFeature(nearest_feature_fid)
-                street_code = nearest_feature.GetField('StreetCode')
+        # consulta todas as demandas de uma vez no indice
+        lyr_demandas = self.get_layer()
+        fids, pontos = geometrias_layer(lyr_demandas)
+        mais_proximos = dict(zip(fids, lyr_alvo_index.mais_proximos(pontos)))
+
+        lyr_demandas.StartTransaction()
+        for feat in lyr_demandas:
+            posicao = mais_proximos.get(feat.GetFID(), -1)
+            if posicao >= 0:
+                street_code = lyr_alvo_index.atributos['StreetCode'][posicao]
                 feat.SetField('StreetCode', street_code)
-                self.get_layer().SetFeature(feat)
+                lyr_demandas.SetFeature(feat)
+        lyr_demandas.CommitTransaction()
 
         return self.get_layer()
 
+    @instrumenta
     def recupera_streetcodes_com_demanda(self):
         return list(set([feature['StreetCode'] for feature in self.get_layer() if feature['StreetCode'] is not None]))
 
     def get_indice_espacial(self, layer_com_street_code):
-        spatial_index = {}
-        for feature in layer_com_street_code:
-            spatial_index[feature.GetFID()] = (feature.GetGeometryRef().GetX(), feature.GetGeometryRef().GetY())
-        return spatial_index
+        return IndiceEspacial(layer_com_street_code, campos=('StreetCode',))
 
     def encontra_feicao_mais_proxima(self, feature, spatial_index):
-        min_dist = float('inf')
-        nearest_fid = None
-        feature_geometry = feature.GetGeometryRef()
-        feature_point = (feature_geometry.GetX(), feature_geometry.GetY())
-
-        for fid, point in spatial_index.items():
-            distance = ((point[0] - feature_point[0]) ** 2 + (point[1] - feature_point[1]) ** 2) ** 0.5
-            if distance < min_dist:
-                nearest_fid = fid
-                min_dist = distance
-
-        return nearest_fid
+        return spatial_index.fid_mais_proximo(feature.GetGeometryRef())
 
     def cria_demandas_ordenadas_por_arruamento(self):
         layer = self.datasource_entrada.CreateLayer(
@@ -73,6 +74,7 @@ class Demanda:
         layer.CreateField(ogr.FieldDefn('associado', ogr.OFTInteger))
         return layer
 
+    @instrumenta
     def get_demandas_ordenadas_por_arruamento(self, i, streetcode):
         sql = f'''    
                  SELECT
@@ -120,6 +122,11 @@ class Demanda:
 
                 feature.SetField('id_caixa', f'{row["StreetCode"]}.{id_caixa}')
                 self.demandas_ordenadas.SetFeature(feature)
+                self.armazem.adiciona(
+                    i, row['id_demanda'], row['StreetCode'], row['market-index'], row['dist_arruamento'],
+                    f'{row["StreetCode"]}.{id_caixa}', row['geometry'].GetX(), row['geometry'].GetY(),
+                    fid=feature.GetFID(),
+                )
                 self.demandas_ordenadas.CommitTransaction()
                 i += 1
 
@@ -127,83 +134,152 @@ class Demanda:
 
             return self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
 
-    def get_maior_distancia_arruamento(self, id_caixa, lista_demandas=None):
-        max_dist_arruamento = 0
-        lyr_demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        self.datasource_entrada.CopyLayer(lyr_demandas_ordenadas, 'layer_demandas_ordenadas_tmp')
-
-        sql = f'''
-                    SELECT max(dist_arruamento) AS max_dist_arruamento
-                    FROM layer_demandas_ordenadas_tmp
-                    WHERE "id_caixa" = '{id_caixa}'
-                '''
-        if lista_demandas:
-            lista_demandas_str = [str(demanda) for demanda in lista_demandas]
-            sql += f' AND id IN ({", ".join(lista_demandas_str)})'
-
-        query = self.datasource_entrada.ExecuteSQL(sql, dialect="SQLite")
-
-        for row in query:
-            max_dist_arruamento = row['max_dist_arruamento']
-
-        self.datasource_entrada.ReleaseResultSet(query)
-        self.datasource_entrada.DeleteLayer('layer_demandas_ordenadas_tmp')
-
-        return max_dist_arruamento
-
-    def get_pnt_inicial_final_id_caixas(self, lyr_demanda_ordenada, street_code):
-        aux = []
-        lyr_demanda_ordenada.SetAttributeFilter(f"StreetCode = {street_code}")
-
-        for feature in lyr_demanda_ordenada:
-            id = feature['id']
-            id_demanda = feature['id_demanda']
+    @instrumenta
+    def gera_demandas_ordenadas_em_lote(self, lista_street_code, i=1, layer_arruamento='layer_arruamento'):
+        """
+            Gera a layer_demandas_ordenadas de todos os arruamentos em uma única
+            passada: a distância e a posição de cada demanda ao longo do seu
+            arruamento são calculadas de forma vetorizada, e as demandas são
+            agrupadas por StreetCode e inseridas em uma única transação.
+
+            Args:
+                lista_street_code: StreetCodes na ordem de processamento (a
+                    mesma ordem em que get_demandas_ordenadas_por_arruamento
+                    seria chamada); define a sequência do campo id. Repetições
+                    são ignoradas.
+                i: primeiro id.
+                layer_arruamento: nome da layer de arruamento no DataSource.
+
+            Returns:
+                layer: layer_demandas_ordenadas.
+        """
+        # a primeira ocorrência define a ordem (a lista pode repetir StreetCodes com mais de uma feição)
+        ordem_street_code = {}
+        for ordem, street_code in enumerate(lista_street_code):
+            ordem_street_code.setdefault(street_code, ordem)
+
+        partes = {}
+        for feature in self.datasource_entrada.GetLayer(layer_arruamento):
             street_code = feature['StreetCode']
-            id_caixa = feature['id_caixa']
-            geometry = feature.GetGeometryRef().ExportToWkt()
-            aux.append({
-                'id': id,
-                'id_caixa': id_caixa,
-                'id_demanda': id_demanda,
-                'street_code': street_code,
-                'geometry': geometry,
-            })
+            if street_code in ordem_street_code and feature.GetGeometryRef() is not None:
+                partes.setdefault(street_code, []).append(para_shapely(feature.GetGeometryRef()))
+
+        # as feições de um mesmo StreetCode são unidas numa só linha (ou MultiLineString,
+        # quando não são contíguas), e a posição da demanda é medida sobre todas elas
+        linhas = {
+            street_code: geometrias[0] if len(geometrias) == 1 else shapely.line_merge(shapely.union_all(geometrias))
+            for street_code, geometrias in partes.items()
+        }
+
+        ids_demanda, street_codes, market_index, wkbs = [], [], [], []
+        for feature in self.get_layer():
+            street_code = feature['StreetCode']
+            if street_code in linhas:
+                ids_demanda.append(feature['id_demanda'])
+                street_codes.append(street_code)
+                market_index.append(feature['market-index'])
+                wkbs.append(bytes(feature.GetGeometryRef().ExportToWkb()))
+        self.get_layer().ResetReading()
+
+        pontos = shapely.from_wkb(wkbs)
+        coordenadas = shapely.get_coordinates(pontos)
+        linhas_demandas = np.array([linhas[street_code] for street_code in street_codes], dtype=object)
+        dist_arruamento = shapely.distance(pontos, linhas_demandas)
+        posicao = shapely.line_locate_point(linhas_demandas, pontos)
+        ordem_arruamento = np.array([ordem_street_code[street_code] for street_code in street_codes])
+
+        layer = self.demandas_ordenadas
+        layer.StartTransaction()
+        street_code_atual = None
+        for k in np.lexsort((posicao, ordem_arruamento)).tolist():
+            if street_codes[k] != street_code_atual:
+                street_code_atual = street_codes[k]
+                id_caixa = 1
+                acumulador = 0
+
+            if acumulador + market_index[k] <= 8:
+                acumulador += market_index[k]
+            else:
+                id_caixa += 1
+                acumulador = market_index[k]
+
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(wkbs[k]))
+            feature.SetField('id', i)
+            feature.SetField('id_demanda', ids_demanda[k])
+            feature.SetField('StreetCode', street_code_atual)
+            feature.SetField('market-index', market_index[k])
+            feature.SetField('dist_arruamento', float(dist_arruamento[k]))
+            feature.SetField('associado', 0)
+            feature.SetField('id_caixa', f'{street_code_atual}.{id_caixa}')
+            layer.CreateFeature(feature)
+            self.armazem.adiciona(
+                i, ids_demanda[k], street_code_atual, market_index[k], float(dist_arruamento[k]),
+                f'{street_code_atual}.{id_caixa}', *coordenadas[k].tolist(),
+                fid=feature.GetFID(),
+            )
+            i += 1
+        layer.CommitTransaction()
+
+        return self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
+
+    def recarrega_demandas_ordenadas(self):
+        """ Reconstrói o armazém a partir da layer_demandas_ordenadas já preenchida (ex.: restaurada do cache). """
+        self.demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
+        self.armazem = ArmazemDemandas.carrega(self.demandas_ordenadas)
+        return self.demandas_ordenadas
+
+    def get_maior_distancia_arruamento(self, id_caixa, lista_demandas=None):
+        return self.armazem.agregado.maior_distancia(id_caixa, lista_demandas)
 
+    @instrumenta
+    def get_pnt_inicial_final_id_caixas(self, street_code):
         result = defaultdict(dict)
 
-        for item in aux:
-            id_caixa = item['id_caixa']
-            geometry = item['geometry']
+        for linha in self.armazem.linhas_street_code(street_code).tolist():
+            id_caixa = self.armazem['id_caixa'][linha]
+            geometry = self.armazem.ponto(linha)
             if id_caixa not in result:
                 result[id_caixa]['id_caixa'] = id_caixa
                 result[id_caixa]['pnt_inicial'] = geometry
             else:
                 result[id_caixa]['pnt_final'] = geometry
 
-        lyr_demanda_ordenada.SetAttributeFilter(None)
-
         return list(result.values())
 
-    def atualiza_campo_associado(self):
-        lyr_demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
+    @instrumenta
+    def atualiza_campo_associado(self, caixas_alteradas=None):
+        """
+            Atualiza os campos associado e id_caixa das demandas ordenadas, no
+            armazém (ver grava_demandas_ordenadas).
+
+            Args:
+                caixas_alteradas: alterações retornadas por
+                    AreaCaixa.consome_alteracoes. Se None, todas as demandas são
+                    recalculadas; caso contrário, só as que estão dentro das
+                    caixas inseridas ou apagadas.
+        """
         lyr_area_caixa = self.datasource_entrada.GetLayer('areas_de_caixa')
-        lyr_demandas_ordenadas.StartTransaction()
-        for feat_demandas in lyr_demandas_ordenadas:
-            geom_demandas = feat_demandas.GetGeometryRef()
+
+        if caixas_alteradas is None:
+            linhas = np.arange(len(self.armazem))
+        else:
+            if not caixas_alteradas:
+                return
+            geometrias_alteradas = np.array([para_shapely(geometria) for _, geometria, _ in caixas_alteradas])
+            _, linhas = self.armazem.get_arvore().query(geometrias_alteradas)
+            linhas = np.unique(linhas)
+        pontos = shapely.points(self.armazem['x'][linhas], self.armazem['y'][linhas])
+
+        indice_caixas = IndiceEspacial(lyr_area_caixa, campos=('id_caixa',))
+        caixas = indice_caixas.primeira_intersecao(pontos)
+
+        for linha, posicao in zip(linhas.tolist(), caixas.tolist()):
             is_disjoint = 0
-            for feat_caixa in lyr_area_caixa:
-                geom_caixa = feat_caixa.GetGeometryRef()
-                id_caixa = feat_caixa['id_caixa']
-                if not geom_demandas.Disjoint(geom_caixa):
-                    is_disjoint = 1
-                    id_caixa = feat_caixa['id_caixa']
-                    feat_demandas.SetField('id_caixa', id_caixa)
-                    break
-            feat_demandas.SetField('associado', is_disjoint)
-            lyr_demandas_ordenadas.SetFeature(feat_demandas)
-
-        lyr_demandas_ordenadas.CommitTransaction()
-        return lyr_demandas_ordenadas
+            if posicao >= 0:
+                is_disjoint = 1
+                self.armazem.set_id_caixa(linha, indice_caixas.atributos['id_caixa'][posicao])
+            self.armazem.set_associado(linha, is_disjoint)
 
     def cria_layer_linhas_demandas(self):
         lyr_linhas_demandas = self.datasource_entrada.CreateLayer(
@@ -213,87 +289,75 @@ class Demanda:
 
         return lyr_linhas_demandas
 
+    @instrumenta
     def atualiza_id_caixa_demandas(self):
-        lyr_demandas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        areas_caixa = self.datasource_entrada.GetLayer('areas_de_caixa')
-        id_caixa_list = list(set([feat['id_caixa'] for feat in lyr_demandas]))
-
-        lyr_demandas.StartTransaction()
-
-        for id_caixa in id_caixa_list:
-            lyr_demandas.SetAttributeFilter(f"id_caixa = '{id_caixa}' AND associado = 0")
-            lista_fids = [fc.GetFID() for fc in lyr_demandas]
-            linestring = ogr.Geometry(ogr.wkbLineString)
-
-            for i, val in enumerate(lista_fids):
-                if i + 1 < len(lista_fids):
-                    feature_current = lyr_demandas.GetFeature(lista_fids[i])
-                    feature_next = lyr_demandas.GetFeature(lista_fids[i + 1])
-
-                    geom_current = feature_current.GetGeometryRef()
-                    geom_next = feature_next.GetGeometryRef()
-
-                    linestring.AddPoint(geom_current.GetX(), geom_current.GetY())
-                    linestring.AddPoint(geom_next.GetX(), geom_next.GetY())
-                    linestring.FlattenTo2D()
-
-                    areas_caixa.SetSpatialFilter(linestring)
-
-                    if areas_caixa.GetFeatureCount() > 0:
-
-                        for caixa in areas_caixa:
-                            caixa_geom = caixa.GetGeometryRef()
-                            if caixa_geom.Intersects(linestring):
-                                # demandas antes da caixa interceptada:
-                                lyr_demandas.SetAttributeFilter(
-                                    f"id_caixa = '{id_caixa}' AND associado = 0 AND id <= {feature_current['id']}"
-                                )
-                                for demanda in lyr_demandas:
-                                    demanda.SetField("id_caixa", f'{id_caixa}.1')
-                                    lyr_demandas.SetFeature(demanda)
-
-                                # demandas depois da caixa interceptada:
-                                lyr_demandas.SetAttributeFilter(
-                                    f"id_caixa = '{id_caixa}' AND associado = 0 AND id > {feature_current['id']}"
-                                )
-                                for demanda in lyr_demandas:
-                                    demanda.SetField("id_caixa", f'{id_caixa}.2')
-                                    lyr_demandas.SetFeature(demanda)
-                        break
-
-        lyr_demandas.CommitTransaction()
-        lyr_demandas.SetAttributeFilter(None)
-        areas_caixa.SetSpatialFilter(None)
-
+        """
+            Liga as demandas sem caixa de cada id_caixa, na ordem do id, e as
+            separa no primeiro trecho da ligação que intercepta uma caixa: as
+            demandas até ele passam para '<id_caixa>.1' e as seguintes para
+            '<id_caixa>.2'. Os trechos de todos os id_caixa são testados numa
+            única consulta ao índice das caixas.
+        """
+        armazem = self.armazem
+        sem_caixa = armazem['associado'] == 0
+
+        grupos, trechos = [], []
+        for id_caixa in set(armazem['id_caixa'].tolist()):
+            linhas = [linha for linha in armazem.linhas_caixa(id_caixa).tolist() if sem_caixa[linha]]
+            if len(linhas) > 1:
+                grupos.append((id_caixa, linhas, len(trechos)))
+                trechos.extend(
+                    [armazem.ponto(atual), armazem.ponto(proxima)] for atual, proxima in zip(linhas, linhas[1:])
+                )
+        if not grupos:
+            return
+
+        indice_caixas = IndiceEspacial(self.datasource_entrada.GetLayer('areas_de_caixa'))
+        interceptados = indice_caixas.primeira_intersecao(shapely.linestrings(trechos)) >= 0
+
+        for id_caixa, linhas, inicio in grupos:
+            interceptados_grupo = interceptados[inicio:inicio + len(linhas) - 1]
+            if not interceptados_grupo.any():
+                continue
+            corte = int(np.argmax(interceptados_grupo)) + 1
+            # demandas antes da caixa interceptada:
+            for linha in linhas[:corte]:
+                armazem.set_id_caixa(linha, f'{id_caixa}.1')
+            # demandas depois da caixa interceptada:
+            for linha in linhas[corte:]:
+                armazem.set_id_caixa(linha, f'{id_caixa}.2')
+
+    @instrumenta
     def atualiza_campo_id_caixa(self):
-        lyr_demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        lyr_demandas_ordenadas.SetAttributeFilter('associado = 0')
-
+        """ Passa as demandas sem caixa a 0.1 m de uma linha de demandas para o id_caixa da linha. """
         lyr_linhas = self.datasource_entrada.GetLayer('layer_linhas_demandas')
+        linhas_sem_caixa = np.flatnonzero(self.armazem['associado'] == 0)
+        if not len(linhas_sem_caixa):
+            return
+
+        # mesmo número de segmentos por quadrante do Buffer do OGR
+        buffers = shapely.buffer(
+            shapely.points(self.armazem['x'][linhas_sem_caixa], self.armazem['y'][linhas_sem_caixa]), 0.1,
+            quad_segs=30,
+        )
+        for linha_demandas in lyr_linhas:
+            geometria = para_shapely(linha_demandas.GetGeometryRef())
+            for linha in linhas_sem_caixa[shapely.intersects(buffers, geometria)].tolist():
+                self.armazem.set_id_caixa(linha, linha_demandas.GetField('id_caixa'))
+        lyr_linhas.ResetReading()
 
-        lyr_demandas_ordenadas.StartTransaction()
-
-        for linha in lyr_linhas:
-            linha_geom = linha.GetGeometryRef()
-            for demanda in lyr_demandas_ordenadas:
-                demanda_geom = demanda.GetGeometryRef()
-                if demanda_geom.Buffer(0.1).Intersects(linha_geom):
-                    demanda.SetField('id_caixa', linha.GetField('id_caixa'))
-                    lyr_demandas_ordenadas.SetFeature(demanda)
-
-        lyr_demandas_ordenadas.CommitTransaction()
-        lyr_demandas_ordenadas.SetAttributeFilter(None)
-
-        return lyr_demandas_ordenadas
+    def get_caixas_sem_associacao(self):
+        """ id_caixa das demandas que não estão dentro de nenhuma caixa. """
+        return list(set(self.armazem['id_caixa'][self.armazem['associado'] == 0].tolist()))
 
+    @instrumenta
     def modifica_id_caixa_maior_8(self, caixa):
-        lyr_demandas_ordenadas = self.datasource_entrada.GetLayer('layer_demandas_ordenadas')
-        lyr_demandas_ordenadas.SetAttributeFilter(f"id in {tuple(caixa['demandas'])}")
-        for feature in lyr_demandas_ordenadas:
-            feature.SetField("id_caixa", caixa['id_caixa'])
-            lyr_demandas_ordenadas.SetFeature(feature)
-
-        lyr_demandas_ordenadas.CommitTransaction()
-        lyr_demandas_ordenadas.SetAttributeFilter(None)
-
-
+        for id in caixa['demandas']:
+            self.armazem.set_id_caixa(self.armazem.linha_por_id[id], caixa['id_caixa'])
+
+    def grava_demandas_ordenadas(self):
+        """
+            Grava na layer_demandas_ordenadas o id_caixa e o associado mantidos
+            no armazém; chamado uma vez, antes da exportação.
+        """
+        return self.armazem.grava(self.datasource_entrada.GetLayer('layer_demandas_ordenadas'))
@@ -0,0 +1,183 @@
+import json
+import os
+
+import numpy as np
+import shapely
+from osgeo import ogr
+
+from classes.indice_espacial import para_ogr, para_shapely
+
+ogr.UseExceptions()
+
+# formato: (driver do OGR, extensão, opções de criação da layer)
+FORMATOS = {
+    'geojson': ('GeoJSON', '.geojson', []),
+    'gpkg': ('GPKG', '.gpkg', ['SPATIAL_INDEX=YES']),
+    'fgb': ('FlatGeobuf', '.fgb', ['SPATIAL_INDEX=YES']),
+    'parquet': ('Parquet', '.parquet', ['COMPRESSION=SNAPPY']),
+}
+
+# formatos que guardam várias layers num mesmo arquivo
+MULTI_LAYER = {'gpkg'}
+
+# parâmetros da exportação, gravados junto das layers para quem relê a saída
+ARQUIVO_PARAMETROS = 'parametros_saida.json'
+
+
+def get_driver(formato):
+    if formato not in FORMATOS:
+        raise ValueError(f'formato {formato} desconhecido (opções: {", ".join(FORMATOS)})')
+    driver = ogr.GetDriverByName(FORMATOS[formato][0])
+    if driver is None:
+        raise ValueError(f'driver {FORMATOS[formato][0]} não disponível nesta instalação do GDAL')
+    return driver
+
+
+def cria_datasource(formato, caminho):
+    driver = get_driver(formato)
+    if os.path.exists(caminho):
+        driver.DeleteDataSource(caminho)
+    return driver.CreateDataSource(caminho)
+
+
+def arredonda(geometria, precisao):
+    """ Geometria OGR com as coordenadas arredondadas para `precisao` casas decimais. """
+    return para_ogr(shapely.transform(para_shapely(geometria), lambda coordenadas: np.round(coordenadas, precisao)))
+
+
+def copia_layer(datasource, layer, nome, formato, precisao=None):
+    """
+        Grava a layer no DataSource de saída. Sem precisão, usa CopyLayer; com
+        precisão, o GeoJSON usa a opção COORDINATE_PRECISION do driver e os
+        demais formatos recebem as geometrias arredondadas.
+    """
+    opcoes = list(FORMATOS[formato][2])
+    if precisao is None:
+        return datasource.CopyLayer(layer, nome, opcoes)
+    if formato == 'geojson':
+        return datasource.CopyLayer(layer, nome, opcoes + [f'COORDINATE_PRECISION={precisao}'])
+
+    defn_origem = layer.GetLayerDefn()
+    destino = datasource.CreateLayer(nome, srs=layer.GetSpatialRef(), geom_type=layer.GetGeomType(), options=opcoes)
+    for i in range(defn_origem.GetFieldCount()):
+        destino.CreateField(defn_origem.GetFieldDefn(i))
+    defn = destino.GetLayerDefn()
+
+    destino.StartTransaction()
+    layer.ResetReading()
+    for feature_origem in layer:
+        feature = ogr.Feature(defn)
+        feature.SetFrom(feature_origem)
+        geometria = feature_origem.GetGeometryRef()
+        if geometria is not None:
+            feature.SetGeometry(arredonda(geometria, precisao))
+        destino.CreateFeature(feature)
+    destino.CommitTransaction()
+    layer.ResetReading()
+
+    return destino
+
+
+def grava_estilos(datasource, estilos):
+    """
+        Grava estilos QML na tabela layer_styles do GeoPackage, de onde o QGIS
+        os carrega como estilo padrão de cada layer.
+
+        Args:
+            estilos: {nome da layer: conteúdo do .qml}.
+    """
+    layer = datasource.CreateLayer('layer_styles', geom_type=ogr.wkbNone)
+    for campo, tipo in (
+            ('f_table_catalog', ogr.OFTString), ('f_table_schema', ogr.OFTString),
+            ('f_table_name', ogr.OFTString), ('f_geometry_column', ogr.OFTString),
+            ('styleName', ogr.OFTString), ('styleQML', ogr.OFTString), ('styleSLD', ogr.OFTString),
+            ('useAsDefault', ogr.OFTInteger), ('description', ogr.OFTString), ('owner', ogr.OFTString),
+            ('ui', ogr.OFTString), ('update_time', ogr.OFTDateTime)):
+        layer.CreateField(ogr.FieldDefn(campo, tipo))
+
+    layer.StartTransaction()
+    for nome, qml in estilos.items():
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('f_table_name', nome)
+        feature.SetField('f_geometry_column', datasource.GetLayerByName(nome).GetGeometryColumn() or 'geom')
+        feature.SetField('styleName', nome)
+        feature.SetField('styleQML', qml)
+        feature.SetField('useAsDefault', 1)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+
+def le_estilos(output_dir, nomes):
+    estilos = {}
+    for nome in nomes:
+        caminho = os.path.join(output_dir, f'{nome}.qml')
+        if os.path.exists(caminho):
+            with open(caminho) as arquivo:
+                estilos[nome] = arquivo.read()
+    return estilos
+
+
+def caminhos_layers(output_dir, nomes, formato='geojson', arquivo='resultado'):
+    """ {nome de saída: (arquivo, nome da layer no arquivo)}, como gravados por exporta_layers. """
+    extensao = FORMATOS[formato][1]
+    if formato in MULTI_LAYER:
+        return {nome: (os.path.join(output_dir, f'{arquivo}{extensao}'), nome) for nome in nomes}
+    return {nome: (os.path.join(output_dir, f'{nome}{extensao}'), nome) for nome in nomes}
+
+
+def grava_parametros(output_dir, formato, precisao=None, arquivo='resultado'):
+    with open(os.path.join(output_dir, ARQUIVO_PARAMETROS), 'w') as saida:
+        json.dump({'formato': formato, 'precisao': precisao, 'arquivo': arquivo}, saida)
+
+
+def le_parametros(output_dir):
+    """ Parâmetros da exportação de um diretório; sem o arquivo, os padrões (GeoJSON, sem arredondar). """
+    caminho = os.path.join(output_dir, ARQUIVO_PARAMETROS)
+    parametros = {'formato': 'geojson', 'precisao': None, 'arquivo': 'resultado'}
+    if os.path.exists(caminho):
+        with open(caminho) as entrada:
+            parametros.update(json.load(entrada))
+    return parametros
+
+
+def exporta_layers(layers, output_dir, formato='geojson', precisao=None, arquivo='resultado'):
+    """
+        Exporta as layers de saída no formato escolhido.
+
+        Formatos de uma layer por arquivo geram <nome><extensão> (os .qml de
+        mesmo nome no diretório continuam valendo no QGIS). O GeoPackage junta
+        todas as layers em <arquivo>.gpkg, com índice espacial, e leva os .qml
+        encontrados para a tabela layer_styles.
+
+        Args:
+            layers: {nome de saída: ogr.Layer}.
+            output_dir: diretório de saída.
+            formato: 'geojson', 'gpkg', 'fgb' ou 'parquet'.
+            precisao: casas decimais das coordenadas (padrão: sem arredondar).
+            arquivo: nome do arquivo dos formatos multi-layer.
+
+        Returns:
+            list: caminhos dos arquivos gravados.
+    """
+    get_driver(formato)
+    caminhos = caminhos_layers(output_dir, layers, formato, arquivo)
+
+    if formato in MULTI_LAYER:
+        caminho = os.path.join(output_dir, f'{arquivo}{FORMATOS[formato][1]}')
+        datasource = cria_datasource(formato, caminho)
+        for nome, layer in layers.items():
+            copia_layer(datasource, layer, nome, formato, precisao)
+        estilos = le_estilos(output_dir, layers)
+        if estilos:
+            grava_estilos(datasource, estilos)
+        datasource = None
+        return [caminho]
+
+    gravados = []
+    for nome, layer in layers.items():
+        caminho = caminhos[nome][0]
+        datasource = cria_datasource(formato, caminho)
+        copia_layer(datasource, layer, nome, formato, precisao)
+        datasource = None
+        gravados.append(caminho)
+    return gravados
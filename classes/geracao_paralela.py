@@ -0,0 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import shapely
+from osgeo import ogr
+
+from classes.area_caixa import constroi_caixas
+from classes.referencia_linear import LinhaMedida
+
+ogr.UseExceptions()
+
+
+def calcula_candidatos_arruamento(tarefa):
+    """
+        Executado no worker: recorta o arruamento e constrói as caixas
+        candidatas de todas as caixas de um StreetCode, sem acesso ao DataSource.
+
+        Args:
+            tarefa: (street_code, wkbs das feições do arruamento,
+                [(id_caixa, ponto_inicial, ponto_final, dist_max), ...]).
+
+        Returns:
+            tuple: (street_code, [(id_caixa, dist_max, [(wkb do trecho, wkb da caixa), ...]), ...]).
+    """
+    street_code, wkbs_arruamento, caixas = tarefa
+    # medidas de cada feição calculadas uma vez e reaproveitadas por todas as caixas da rua
+    linhas = [LinhaMedida.de_shapely(shapely.from_wkb(wkb)) for wkb in wkbs_arruamento]
+    linhas = [linha for linha in linhas if linha is not None]
+
+    # todos os pontos da rua projetados de uma vez em cada feição
+    pares = [(ponto_inicial, ponto_final) for _, ponto_inicial, ponto_final, _ in caixas]
+    recortes = [linha.recorta_em_lote(pares) for linha in linhas]
+
+    # trechos de todas as caixas da rua, na ordem (caixa, feição)
+    trechos, dists = [], []
+    for i, (_, _, _, dist_max) in enumerate(caixas):
+        for recorte in recortes:
+            if recorte[i] is not None:
+                trechos.append((i, shapely.linestrings(recorte[i])))
+                dists.append(dist_max)
+
+    # caixas de todos os trechos num único buffer vetorizado (sem dist. máxima, sem caixa)
+    validos = [k for k, dist_max in enumerate(dists) if dist_max is not None]
+    poligonos = [None] * len(trechos)
+    if validos:
+        construidos = constroi_caixas([trechos[k][1] for k in validos], [dists[k] for k in validos])
+        for k, poligono in zip(validos, construidos):
+            poligonos[k] = poligono
+
+    candidatos = [(id_caixa, dist_max, []) for id_caixa, _, _, dist_max in caixas]
+    for (i, trecho), poligono in zip(trechos, poligonos):
+        candidatos[i][2].append((shapely.to_wkb(trecho), None if poligono is None else shapely.to_wkb(poligono)))
+
+    return street_code, candidatos
+
+
+def monta_tarefas(arruamento, armazem, street_codes):
+    wkbs_por_street_code = {street_code: [] for street_code in street_codes}
+    for feature in arruamento.get_layer():
+        if feature['StreetCode'] in wkbs_por_street_code:
+            wkbs_por_street_code[feature['StreetCode']].append(bytes(feature.GetGeometryRef().ExportToWkb()))
+
+    tarefas = []
+    for street_code in street_codes:
+        # primeira e última demanda de cada caixa, como em Demanda.get_pnt_inicial_final_id_caixas
+        pontos = {}
+        for linha in armazem.linhas_street_code(street_code).tolist():
+            id_caixa = armazem['id_caixa'][linha]
+            pontos.setdefault(id_caixa, []).append(linha)
+
+        caixas = []
+        for id_caixa, linhas in pontos.items():
+            if len(linhas) > 1:
+                caixas.append((
+                    id_caixa,
+                    armazem.ponto(linhas[0]),
+                    armazem.ponto(linhas[-1]),
+                    armazem.agregado.maior_distancia(id_caixa),
+                ))
+        tarefas.append((street_code, wkbs_por_street_code[street_code], caixas))
+
+    return tarefas
+
+
+def gera_caixas_primarias_paralelo(arruamento, areas_caixa, armazem, street_codes, workers=None):
+    """
+        Gera as caixas primárias calculando os candidatos de cada StreetCode em
+        um pool de processos (os arruamentos mais longos primeiro) e aplicando,
+        no processo principal, a regra de interseção entre caixas na mesma
+        ordem do laço sequencial, de modo que o resultado é o mesmo.
+
+        Args:
+            arruamento: instância de Arruamento.
+            areas_caixa: instância de AreaCaixa.
+            armazem: ArmazemDemandas com as demandas já ordenadas.
+            street_codes: StreetCodes em ordem decrescente de comprimento.
+            workers: número de processos (padrão: número de CPUs).
+
+        Returns:
+            list: StreetCodes com alguma caixa não gerada.
+    """
+    tarefas = monta_tarefas(arruamento, armazem, street_codes)
+    lyr_arruamento_recortado = arruamento.datasource_entrada.GetLayer('lyr_arruamento_recortado')
+    arruamentos_nao_atendidos = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map devolve os resultados na ordem das tarefas: a fusão é determinística
+        for street_code, candidatos in executor.map(calcula_candidatos_arruamento, tarefas, chunksize=1):
+            for id_caixa, dist_max, trechos in candidatos:
+                lyr_arruamento_recortado.StartTransaction()
+                for wkb_trecho, _ in trechos:
+                    arruamento.insere_arruamento_recortado(
+                        ogr.CreateGeometryFromWkb(wkb_trecho), street_code, id_caixa
+                    )
+                lyr_arruamento_recortado.CommitTransaction()
+
+                caixa = False
+                areas_caixa.get_layer().StartTransaction()
+                for _, wkb_caixa in trechos:
+                    if wkb_caixa is not None:
+                        if areas_caixa.insere_caixa_primaria(
+                                ogr.CreateGeometryFromWkb(wkb_caixa), id_caixa, street_code, dist_max):
+                            caixa = True
+                areas_caixa.get_layer().CommitTransaction()
+
+                if not caixa:
+                    arruamentos_nao_atendidos.append(street_code)
+
+    return arruamentos_nao_atendidos
@@ -0,0 +1,166 @@
+from collections import defaultdict
+
+import numpy as np
+import shapely
+from osgeo import ogr
+
+ogr.UseExceptions()
+
+
+def para_shapely(geometria):
+    return shapely.from_wkb(bytes(geometria.ExportToWkb()))
+
+
+def para_ogr(geometria):
+    return ogr.CreateGeometryFromWkb(shapely.to_wkb(geometria))
+
+
+def geometrias_layer(layer):
+    """
+        Le todas as geometrias de uma layer de uma so vez.
+
+        Args:
+            layer: layer OGR (filtros ativos sao respeitados).
+
+        Returns:
+            tuple: lista de FIDs e array shapely com as geometrias, na ordem da layer.
+    """
+    fids = []
+    wkbs = []
+    for feature in layer:
+        geometria = feature.GetGeometryRef()
+        if geometria is not None:
+            fids.append(feature.GetFID())
+            wkbs.append(bytes(geometria.ExportToWkb()))
+    layer.ResetReading()
+    return fids, shapely.from_wkb(wkbs)
+
+
+class IndiceEspacial:
+    """
+        Indice espacial (STRtree) de uma layer, construido uma unica vez e
+        consultado em lote. As distancias sao calculadas sobre a geometria real
+        (ponto, linha ou poligono), e nao sobre o primeiro vertice.
+    """
+
+    def __init__(self, layer, campos=()):
+        self.fids, self.geometrias = geometrias_layer(layer)
+        self.atributos = {campo: [] for campo in campos}
+        if campos:
+            for feature in layer:
+                if feature.GetGeometryRef() is not None:
+                    for campo in campos:
+                        self.atributos[campo].append(feature.GetField(campo))
+            layer.ResetReading()
+        self.arvore = shapely.STRtree(self.geometrias)
+        shapely.prepare(self.geometrias)
+
+    def __len__(self):
+        return len(self.fids)
+
+    def mais_proximos(self, geometrias):
+        """
+            Retorna, para cada geometria, a posicao no indice da feicao mais
+            proxima (-1 quando o indice esta vazio). Em caso de empate vale a
+            primeira feicao da layer, como na busca linear.
+        """
+        resultado = np.full(len(geometrias), -1, dtype=np.int64)
+        if not len(self) or not len(geometrias):
+            return resultado
+
+        entrada, alvo = self.arvore.query_nearest(geometrias, all_matches=True)
+        resultado[:] = len(self)
+        np.minimum.at(resultado, entrada, alvo)
+        resultado[resultado == len(self)] = -1
+        return resultado
+
+    def fid_mais_proximo(self, geometria):
+        posicao = self.mais_proximos(np.array([para_shapely(geometria)]))[0]
+        if posicao < 0:
+            return None
+        return self.fids[posicao]
+
+    def primeira_intersecao(self, geometrias):
+        """
+            Retorna, para cada geometria, a posicao no indice da primeira feicao
+            (na ordem da layer) que a intercepta, ou -1 quando nenhuma intercepta.
+            Os candidatos vem do envelope na arvore e o teste exato e feito em
+            lote com as geometrias do indice preparadas.
+        """
+        resultado = np.full(len(geometrias), -1, dtype=np.int64)
+        if not len(self) or not len(geometrias):
+            return resultado
+
+        entrada, alvo = self.arvore.query(geometrias)
+        intercepta = shapely.intersects(self.geometrias[alvo], geometrias[entrada])
+        entrada, alvo = entrada[intercepta], alvo[intercepta]
+
+        resultado[:] = len(self)
+        np.minimum.at(resultado, entrada, alvo)
+        resultado[resultado == len(self)] = -1
+        return resultado
+
+
+class IndiceDinamico:
+    """
+        Indice espacial em grade uniforme que aceita insercoes e remocoes, para
+        conjuntos que mudam durante o processamento (ex.: as caixas aceitas).
+        Cada geometria e registrada nas celulas cobertas pelo seu envelope e
+        guardada preparada para os testes exatos.
+    """
+
+    def __init__(self, tamanho_celula=100.0):
+        self.tamanho_celula = tamanho_celula
+        self.geometrias = {}
+        self.celulas = defaultdict(set)
+        self.celulas_por_fid = {}
+
+    def __len__(self):
+        return len(self.geometrias)
+
+    def __contains__(self, fid):
+        return fid in self.geometrias
+
+    def celulas_envelope(self, geometria):
+        xmin, ymin, xmax, ymax = shapely.bounds(geometria)
+        if np.isnan(xmin):
+            return []
+        i0, j0 = int(xmin // self.tamanho_celula), int(ymin // self.tamanho_celula)
+        i1, j1 = int(xmax // self.tamanho_celula), int(ymax // self.tamanho_celula)
+        return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+    def insere(self, fid, geometria):
+        if fid in self.geometrias:
+            self.remove(fid)
+        shapely.prepare(geometria)
+        self.geometrias[fid] = geometria
+        celulas = self.celulas_envelope(geometria)
+        self.celulas_por_fid[fid] = celulas
+        for celula in celulas:
+            self.celulas[celula].add(fid)
+
+    def remove(self, fid):
+        if fid not in self.geometrias:
+            return
+        del self.geometrias[fid]
+        for celula in self.celulas_por_fid.pop(fid):
+            self.celulas[celula].discard(fid)
+            if not self.celulas[celula]:
+                del self.celulas[celula]
+
+    def candidatos(self, geometria):
+        """ FIDs cujo envelope intercepta o envelope da geometria, em ordem. """
+        xmin, ymin, xmax, ymax = shapely.bounds(geometria)
+        fids = set()
+        for celula in self.celulas_envelope(geometria):
+            fids.update(self.celulas.get(celula, ()))
+        resultado = []
+        for fid in sorted(fids):
+            gxmin, gymin, gxmax, gymax = shapely.bounds(self.geometrias[fid])
+            if gxmin <= xmax and gxmax >= xmin and gymin <= ymax and gymax >= ymin:
+                resultado.append(fid)
+        return resultado
+
+    def interceptados(self, geometria):
+        """ FIDs das geometrias que interceptam a geometria, em ordem. """
+        return [fid for fid in self.candidatos(geometria) if self.geometrias[fid].intersects(geometria)]
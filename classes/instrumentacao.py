@@ -0,0 +1,302 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+from classes.memoria import MB, MemoriaExcedida, pegada_layers, pico_rss, rss_atual, zera_pico_rss
+
+logger = logging.getLogger('algoritmo')
+
+
+class EtapaNula:
+    """ Etapa devolvida quando a instrumentação está desligada: não mede nada. """
+    entrada = None
+    saida = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, nome, valor):
+        pass
+
+
+ETAPA_NULA = EtapaNula()
+
+
+class Etapa:
+    """
+        Uma execução de etapa: tempo de parede, tempo de CPU e quantidade de
+        feições de entrada/saída (preenchidas por quem usa a etapa).
+    """
+
+    def __init__(self, instrumentacao, nome, entrada=None):
+        self.instrumentacao = instrumentacao
+        self.nome = nome
+        self.entrada = entrada
+        self.saida = None
+        self.inicio = None
+        self.duracao = None
+        self.cpu = None
+        self.profundidade = 0
+        self.rss = None
+        self.pico_rss = None
+        self.pico_python = None
+        self.layers = None
+
+    def __enter__(self):
+        pilha = self.instrumentacao.pilha()
+        self.profundidade = len(pilha)
+        if self.instrumentacao.memoria:
+            self.instrumentacao.inicia_memoria(self, pilha)
+        pilha.append(self)
+        nivel = logging.INFO if self.profundidade == 0 else logging.DEBUG
+        logger.log(nivel, '%s%s...', '  ' * self.profundidade, self.nome)
+        self.inicio = time.perf_counter()
+        self.inicio_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.duracao = time.perf_counter() - self.inicio
+        self.cpu = time.process_time() - self.inicio_cpu
+        pilha = self.instrumentacao.pilha()
+        pilha.pop()
+        if self.instrumentacao.memoria:
+            self.instrumentacao.finaliza_memoria(self, pilha)
+        self.instrumentacao.registra(self)
+        if self.instrumentacao.orcamento:
+            self.instrumentacao.verifica_orcamento(self.nome)
+        return False
+
+    def como_dict(self):
+        return {
+            'nome': self.nome,
+            'inicio': self.inicio - self.instrumentacao.origem,
+            'duracao': self.duracao,
+            'cpu': self.cpu,
+            'entrada': self.entrada,
+            'saida': self.saida,
+            'profundidade': self.profundidade,
+            'rss': self.rss,
+            'pico_rss': self.pico_rss,
+            'pico_python': self.pico_python,
+            'layers': self.layers,
+        }
+
+
+class Instrumentacao:
+    """
+        Registro das etapas do fluxo. Desligada, etapa() devolve sempre a mesma
+        EtapaNula e os métodos decorados com @instrumenta só pagam um teste de
+        atributo.
+
+        Args:
+            ativo: mede as etapas do fluxo (with instrumentacao.etapa(...)).
+            metodos: mede também os métodos decorados com @instrumenta.
+            memoria: mede o pico de RSS e de alocações Python (tracemalloc,
+                que deixa o Python sensivelmente mais lento) de cada etapa e a
+                pegada das layers dos DataSources monitorados.
+            orcamento_mb: RSS máximo; passando dele, a etapa ou método em curso
+                levanta MemoriaExcedida com o relatório de memória.
+    """
+
+    def __init__(self, ativo=False, metodos=False, memoria=False, orcamento_mb=None):
+        self.local = threading.local()
+        self.datasources = []
+        self.iniciou_tracemalloc = False
+        self.configura(ativo, metodos, memoria, orcamento_mb)
+        self.reinicia()
+
+    def configura(self, ativo=True, metodos=False, memoria=False, orcamento_mb=None):
+        self.ativo = ativo
+        self.metodos = ativo and metodos
+        self.memoria = ativo and memoria
+        self.orcamento = orcamento_mb * MB if orcamento_mb else None
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.iniciou_tracemalloc = True
+        return self
+
+    def encerra(self):
+        """ Para o tracemalloc iniciado por configura, para não pesar sobre o que roda depois no processo. """
+        if self.iniciou_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.iniciou_tracemalloc = False
+        self.memoria = False
+
+    def reinicia(self):
+        self.registros = []
+        self.datasources = []
+        self.origem = time.perf_counter()
+
+    def monitora(self, datasource):
+        """ Inclui as layers do DataSource no relatório de memória. """
+        self.datasources.append(datasource)
+        return datasource
+
+    def inicia_memoria(self, etapa, pilha):
+        # o pico é zerado a cada etapa: antes, guarda o pico parcial da etapa de fora
+        if pilha:
+            self.acumula_pico(pilha[-1], pico_rss(), tracemalloc.get_traced_memory()[1])
+        zera_pico_rss()
+        tracemalloc.reset_peak()
+        etapa.pico_rss = 0
+        etapa.pico_python = 0
+
+    def finaliza_memoria(self, etapa, pilha):
+        self.acumula_pico(etapa, pico_rss(), tracemalloc.get_traced_memory()[1])
+        etapa.rss = rss_atual()
+        if pilha:
+            self.acumula_pico(pilha[-1], etapa.pico_rss, etapa.pico_python)
+        elif self.datasources:
+            etapa.layers = self.pegada_layers()
+
+    @staticmethod
+    def acumula_pico(etapa, rss, python):
+        etapa.pico_rss = max(etapa.pico_rss or 0, rss)
+        etapa.pico_python = max(etapa.pico_python or 0, python)
+
+    def pegada_layers(self):
+        pegadas = {}
+        for datasource in self.datasources:
+            pegadas.update(pegada_layers(datasource))
+        return pegadas
+
+    def verifica_orcamento(self, concluida=None):
+        rss = rss_atual()
+        if rss <= self.orcamento:
+            return
+        relatorio = self.relatorio_memoria(rss)
+        etapas = relatorio['pilha'] + ([concluida] if concluida else [])
+        logger.error(json.dumps(relatorio, indent=2))
+        raise MemoriaExcedida(
+            f"RSS de {rss / MB:.0f} MB passou do orçamento de {self.orcamento / MB:.0f} MB "
+            f"na etapa {' > '.join(etapas) or '-'}",
+            relatorio,
+        )
+
+    def relatorio_memoria(self, rss=None):
+        """ Estado da memória: RSS, pilha de etapas em curso, picos já medidos e layers. """
+        return {
+            'rss_mb': (rss or rss_atual()) / MB,
+            'orcamento_mb': self.orcamento / MB if self.orcamento else None,
+            'pilha': [etapa.nome for etapa in self.pilha()],
+            'etapas': {
+                etapa.nome: {
+                    'pico_rss_mb': (etapa.pico_rss or 0) / MB, 'pico_python_mb': (etapa.pico_python or 0) / MB,
+                }
+                for etapa in self.registros if etapa.profundidade == 0
+            },
+            'layers': self.pegada_layers(),
+        }
+
+    def pilha(self):
+        if not hasattr(self.local, 'pilha'):
+            self.local.pilha = []
+        return self.local.pilha
+
+    def etapa(self, nome, entrada=None):
+        if not self.ativo:
+            return ETAPA_NULA
+        return Etapa(self, nome, entrada)
+
+    def registra(self, etapa):
+        self.registros.append(etapa)
+        nivel = logging.INFO if etapa.profundidade == 0 else logging.DEBUG
+        logger.log(nivel, '%s%s: %.3f s', '  ' * etapa.profundidade, etapa.nome, etapa.duracao)
+
+    def tempos(self, profundidade=0):
+        """ Tempo de parede das etapas de uma profundidade, somado por nome. """
+        tempos = {}
+        for etapa in self.registros:
+            if etapa.profundidade == profundidade:
+                tempos[etapa.nome] = tempos.get(etapa.nome, 0.0) + etapa.duracao
+        return tempos
+
+    def resumo(self):
+        """ Totais por nome de etapa: chamadas, tempo de parede, CPU e feições. """
+        resumo = {}
+        for etapa in self.registros:
+            item = resumo.setdefault(etapa.nome, {
+                'chamadas': 0, 'tempo': 0.0, 'cpu': 0.0, 'entrada': 0, 'saida': 0,
+            })
+            item['chamadas'] += 1
+            item['tempo'] += etapa.duracao
+            item['cpu'] += etapa.cpu
+            item['entrada'] += etapa.entrada or 0
+            item['saida'] += etapa.saida or 0
+            if etapa.pico_rss is not None:
+                item['pico_rss'] = max(item.get('pico_rss', 0), etapa.pico_rss)
+                item['pico_python'] = max(item.get('pico_python', 0), etapa.pico_python)
+        return dict(sorted(resumo.items(), key=lambda item: item[1]['tempo'], reverse=True))
+
+    def exporta_json(self, caminho):
+        with open(caminho, 'w') as arquivo:
+            json.dump({
+                'resumo': self.resumo(),
+                'etapas': [etapa.como_dict() for etapa in self.registros],
+            }, arquivo, indent=2)
+
+    def exporta_chrome_trace(self, caminho):
+        """ Formato Trace Event, para abrir em chrome://tracing ou no Perfetto. """
+        eventos = []
+        for etapa in self.registros:
+            eventos.append({
+                'name': etapa.nome,
+                'ph': 'X',
+                'ts': (etapa.inicio - self.origem) * 1e6,
+                'dur': etapa.duracao * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {'cpu': etapa.cpu, 'entrada': etapa.entrada, 'saida': etapa.saida},
+            })
+            if etapa.rss is not None:
+                # contador: o Perfetto desenha a curva de RSS abaixo das etapas
+                eventos.append({
+                    'name': 'memoria',
+                    'ph': 'C',
+                    'ts': (etapa.inicio + etapa.duracao - self.origem) * 1e6,
+                    'pid': os.getpid(),
+                    'args': {'rss_mb': etapa.rss / MB, 'pico_python_mb': etapa.pico_python / MB},
+                })
+        with open(caminho, 'w') as arquivo:
+            json.dump({'traceEvents': eventos, 'displayTimeUnit': 'ms'}, arquivo)
+
+
+# instância usada pelo fluxo e pelos métodos decorados; desligada por padrão
+instrumentacao = Instrumentacao()
+
+
+def conta_feicoes(resultado):
+    if hasattr(resultado, 'GetFeatureCount'):
+        return resultado.GetFeatureCount()
+    if isinstance(resultado, (list, tuple, set, dict)):
+        return len(resultado)
+    return None
+
+
+def instrumenta(funcao):
+    """
+        Mede cada chamada do método quando instrumentacao.metodos está ligado.
+        A quantidade de feições de saída é obtida do retorno (layer ou lista).
+        Com orçamento de memória, a verificação é feita a cada chamada.
+    """
+    nome = funcao.__qualname__
+
+    @functools.wraps(funcao)
+    def medido(*args, **kwargs):
+        if not instrumentacao.metodos:
+            if instrumentacao.orcamento:
+                instrumentacao.verifica_orcamento()
+            return funcao(*args, **kwargs)
+        with Etapa(instrumentacao, nome) as etapa:
+            resultado = funcao(*args, **kwargs)
+            etapa.saida = conta_feicoes(resultado)
+        return resultado
+
+    return medido
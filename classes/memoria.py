@@ -0,0 +1,76 @@
+import os
+import resource
+
+MB = 1024 * 1024
+PAGINA = os.sysconf('SC_PAGE_SIZE')
+
+
+class MemoriaExcedida(MemoryError):
+    """ Levantada quando o RSS do processo passa do orçamento configurado. """
+
+    def __init__(self, mensagem, relatorio):
+        super().__init__(mensagem)
+        self.relatorio = relatorio
+
+
+def rss_atual():
+    """ Memória residente do processo, em bytes. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGINA
+    except OSError:
+        # sem /proc: o pico do processo é a melhor aproximação disponível
+        return pico_rss()
+
+
+def pico_rss():
+    """ Maior RSS desde o último zera_pico_rss() (ou desde o início do processo), em bytes. """
+    try:
+        with open('/proc/self/status') as status:
+            for linha in status:
+                if linha.startswith('VmHWM:'):
+                    return int(linha.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss vem em kB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def zera_pico_rss():
+    """
+        Zera o VmHWM do processo (Linux 4.0+), para medir o pico de cada etapa.
+        Retorna False quando não é possível: o pico passa a ser o do processo.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def pegada_layer(layer):
+    """
+        Estimativa dos bytes de uma layer do DataSource em memória: geometrias
+        pelo tamanho do WKB e campos por 8 bytes cada (texto pelo comprimento).
+    """
+    total = 0
+    layer.ResetReading()
+    for feature in layer:
+        geometria = feature.GetGeometryRef()
+        if geometria is not None:
+            total += geometria.WkbSize()
+        for i in range(feature.GetFieldCount()):
+            valor = feature.GetField(i)
+            total += len(valor) if isinstance(valor, str) else 8
+    layer.ResetReading()
+    return total
+
+
+def pegada_layers(datasource):
+    """ {nome da layer: {'feicoes': n, 'bytes': estimativa}}, da maior para a menor. """
+    pegadas = {}
+    for i in range(datasource.GetLayerCount()):
+        layer = datasource.GetLayerByIndex(i)
+        pegadas[layer.GetName()] = {'feicoes': layer.GetFeatureCount(), 'bytes': pegada_layer(layer)}
+    return dict(sorted(pegadas.items(), key=lambda item: item[1]['bytes'], reverse=True))
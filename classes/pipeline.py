@@ -0,0 +1,317 @@
+import os
+import time
+
+from osgeo import ogr
+
+from classes.area_caixa import AreaCaixa
+from classes.arruamento import Arruamento
+from classes.cache_etapas import hash_arquivos
+from classes.carregador import CAMPOS_LAYERS, arquivos_entrada, carrega_area
+from classes.demanda import Demanda
+from classes.exportacao import exporta_layers, grava_parametros
+from classes.geracao_paralela import gera_caixas_primarias_paralelo
+from classes.instrumentacao import instrumentacao, logger
+from classes.rastreio_sql import DataSourceRastreado
+from classes.replanejamento import (
+    arquivos_saida, caixas_mantidas, carrega_saida_anterior, incorpora_saida_anterior, proximo_id,
+    restringe_demandas, street_codes_afetados,
+)
+from classes.testada import Testada
+
+ogr.UseExceptions()
+
+
+def divide_caixas_maiores_8(caixas_maiores_8, arruamento, demandas, areas_caixa):
+    """
+        Substitui cada caixa com market-index maior que 8 pelas caixas das
+        suas duas metades (ver AreaCaixa.get_parametros_caixas_m8).
+    """
+    for caixa in caixas_maiores_8:
+        # subdividindo os arruamentos das caixas maiores que 8
+        arruamento.recorta_arruamento(
+            caixa['ponto_inicial'], caixa['ponto_final'], caixa['street_code'], caixa['id_caixa']
+        )
+        # atualizando os id_caixa das demandas
+        demandas.modifica_id_caixa_maior_8(caixa)
+        # apaga o arruamento e a caixa anteriores, que foram subdivididos; mantida, a caixa
+        # antiga cobriria as metades, que sairiam vazias da subtração das vizinhas
+        arruamento.apaga_arruamento_recortado(caixa['id_caixa_antigo'])
+        areas_caixa.apaga_caixas_id(caixa['id_caixa_antigo'])
+        # cria a caixa da metade, uma vez: repetida por demanda, como no laço original, cada
+        # cópia era subtraída das anteriores e entrava na layer como uma geometria vazia
+        dist_maxima_arruamento = demandas.get_maior_distancia_arruamento(caixa['id_caixa'])
+        areas_caixa.add_area_caixa_secundaria(caixa['id_caixa'], dist_maxima_arruamento)
+
+
+def processa_area(input_dir, output_dir, paralelo=False, workers=None, metodos=False, rastreio=None, metricas=None,
+                  rastreio_sql=None, memoria=False, orcamento_mb=None, recorta=False, formato='geojson',
+                  precisao=None, cache=None, anterior=None, estaticas=None, instrumentar=False):
+    """
+        Executa o fluxo completo de geração das caixas para uma área.
+
+        Args:
+            input_dir: diretório com as layers de entrada (layer_*.geojson).
+            output_dir: diretório onde as layers de saída são gravadas.
+            paralelo: se True, as caixas primárias são calculadas por StreetCode
+                em um pool de processos (mesmo resultado do laço sequencial).
+            workers: número de processos do modo paralelo (padrão: CPUs).
+            recorta: carrega só as feições que interceptam layer_delimitacao
+                (inteiras; as geometrias não são recortadas).
+            formato: formato de saída ('geojson', 'gpkg', 'fgb' ou 'parquet').
+            precisao: casas decimais das coordenadas gravadas (padrão: todas).
+            cache: CacheEtapas; associação e ordenação são restauradas dele
+                quando as entradas e os parâmetros não mudaram.
+            anterior: diretório com as saídas de uma execução anterior da
+                área (em qualquer formato); só as ruas cujas demandas mudaram,
+                as vizinhas e as ligadas a elas por demandas contidas em caixas
+                são replanejadas, o restante é mantido (ver caixas_mantidas).
+            estaticas: CamadasEstaticas com as layers estáticas já em memória
+                (processos de longa duração que atendem vários jobs).
+            instrumentar: mede as etapas (tempos e contagens do resultado);
+                desligado, as etapas não custam quase nada. É ligado também
+                por metodos, rastreio, metricas, rastreio_sql, memoria e
+                orcamento_mb.
+            metodos: mede também cada chamada dos métodos das classes.
+            rastreio: arquivo onde gravar as etapas no formato Chrome trace.
+            metricas: arquivo onde gravar as etapas e o resumo em JSON.
+            rastreio_sql: arquivo onde gravar o resumo das consultas ExecuteSQL
+                por etapa; as formas repetidas (N+1) também vão para o log.
+            memoria: mede os picos de memória por etapa e a pegada das layers.
+            orcamento_mb: RSS máximo; acima dele o fluxo é interrompido com
+                MemoriaExcedida e o relatório de memória vai para o log.
+
+        Returns:
+            dict: tempo total, tempo de cada etapa (em segundos) e o resumo da
+                instrumentação por etapa/método (vazios sem instrumentação).
+    """
+    start_time = time.time()
+
+    # o rastreio de SQL atribui cada consulta à etapa em andamento: sem etapas, todas ficariam sem etapa
+    ativo = bool(instrumentar or metodos or rastreio or metricas or rastreio_sql or memoria or orcamento_mb)
+    instrumentacao.configura(ativo=ativo, metodos=metodos, memoria=memoria, orcamento_mb=orcamento_mb)
+    instrumentacao.reinicia()
+
+    with instrumentacao.etapa('carga') as etapa:
+        # criando um banco na memória para manipular as camadas:
+        driver_associado = ogr.GetDriverByName('Memory')
+        ds_associado = driver_associado.CreateDataSource('ds_associado')
+        if rastreio_sql:
+            ds_associado = DataSourceRastreado(ds_associado)
+        instrumentacao.monitora(ds_associado)
+
+        # só a geometria e os campos usados pelo fluxo; sem a camada de lotes,
+        # a testada (centróides) é gerada a partir do alinhamento predial
+        etapa.saida = sum(carrega_area(ds_associado, input_dir, recorta=recorta, estaticas=estaticas).values())
+
+        # chave do cache: as etapas seguintes encadeiam a partir do conteúdo das entradas
+        if cache:
+            chave = cache.chave('carga', hash_arquivos(arquivos_entrada(input_dir, recorta)), {
+                'recorta': recorta, 'campos': CAMPOS_LAYERS,
+            })
+
+    with instrumentacao.etapa('associacao') as etapa:
+        if cache:
+            chave = cache.chave('associacao', chave)
+        if cache and cache.obtem(chave) is not None:
+            # layer_demandas com o StreetCode associado numa execução anterior
+            cache.restaura(chave, ds_associado)
+            demandas = Demanda(ds_associado)
+            demandas_street_code = demandas.get_layer()
+        else:
+            # Recuperar o layer demandas
+            demandas = Demanda(ds_associado)
+
+            # Recuperar o layer_lote
+            layer_lotes = ds_associado.GetLayerByName('layer_lotes')
+
+            # realiza a verificação da existência da camada layer_lotes
+            if layer_lotes:
+                logger.info('associa streetCode a demandas atravez da camada lote')
+                demandas_street_code = demandas.associa_streetcode_demanda(layer_lotes)
+            else:
+                # caso não exista, será utlizada a testada como base
+                logger.info('associa streetCode a demandas atravez da geracao da testada')
+                testada = Testada(ds_associado).gerar_testadas()
+                demandas_street_code = demandas.associa_streetcode_demanda(testada)
+
+            if cache:
+                cache.grava(chave, ds_associado, ['layer_demandas'])
+        etapa.entrada = etapa.saida = demandas_street_code.GetFeatureCount()
+
+    # replanejamento incremental: só as ruas com demandas alteradas e suas vizinhas
+    primeiro_id = 1
+    if anterior:
+        with instrumentacao.etapa('replanejamento') as etapa:
+            saida_anterior, parametros_anterior = carrega_saida_anterior(anterior)
+            alterados, afetados = street_codes_afetados(
+                demandas.get_layer(), saida_anterior, ds_associado.GetLayer('layer_arruamento'),
+                parametros_anterior['precisao'],
+            )
+            logger.info('%d ruas alteradas, %d a replanejar', len(alterados), len(afetados))
+            restringe_demandas(demandas.get_layer(), afetados)
+            primeiro_id = proximo_id(saida_anterior, afetados)
+            etapa.entrada = len(alterados)
+            etapa.saida = len(afetados)
+
+            if cache:
+                chave = cache.chave('replanejamento', chave, {'anterior': hash_arquivos(arquivos_saida(anterior))})
+
+    with instrumentacao.etapa('ordenacao') as etapa:
+        meta = None
+        if cache:
+            chave = cache.chave('ordenacao', chave)
+            meta = cache.obtem(chave)
+        if meta is not None:
+            # demandas ordenadas numa execução anterior: o armazém é remontado a partir da layer
+            cache.restaura(chave, ds_associado)
+            demandas_ordenadas = demandas.recarrega_demandas_ordenadas()
+            street_codes_ordenados = meta['street_codes_ordenados']
+
+        arruamento = Arruamento(ds_associado, armazem=demandas.armazem)
+
+        # instancia layer areas_de_caixa (vazio)
+        areas_caixa = AreaCaixa(ds_associado, distancia_buffer=0, armazem=demandas.armazem)
+        if anterior:
+            # as caixas das ruas mantidas barram as novas, como numa execução completa
+            areas_caixa.fixa_caixas(caixas_mantidas(saida_anterior, afetados))
+
+        if meta is None:
+            lista_street_code = demandas.recupera_streetcodes_com_demanda()
+
+            # ordenar arruamentos a partir do comprimento
+            arruamentos_ordenados = arruamento.ordena_arruamento_por_comprimento(lista_street_code)
+
+            # ordena as demandas de todos os arruamentos de uma vez, na ordem do comprimento
+            # um StreetCode com várias feições aparece uma vez por feição: fica só a primeira
+            street_codes_ordenados = list(dict.fromkeys(feature['StreetCode'] for feature in arruamentos_ordenados))
+            demandas_ordenadas = demandas.gera_demandas_ordenadas_em_lote(street_codes_ordenados, i=primeiro_id)
+
+            if cache:
+                cache.grava(chave, ds_associado, ['layer_demandas_ordenadas'], {
+                    'street_codes_ordenados': street_codes_ordenados,
+                })
+        etapa.entrada = len(street_codes_ordenados)
+        etapa.saida = demandas_ordenadas.GetFeatureCount()
+
+    # lista dos arruamentos sem caixa
+    arruamentos_nao_atendidos = []
+
+    with instrumentacao.etapa('caixas_primarias') as etapa:
+        etapa.entrada = len(street_codes_ordenados)
+        if paralelo:
+            # candidatos calculados por StreetCode em paralelo, fundidos na ordem do comprimento
+            arruamentos_nao_atendidos = gera_caixas_primarias_paralelo(
+                arruamento, areas_caixa, demandas.armazem, street_codes_ordenados, workers
+            )
+        else:
+            # percorrer arruamentos um a um
+            for street_code in street_codes_ordenados:
+                dados_pnt_inicial_final = demandas.get_pnt_inicial_final_id_caixas(street_code)
+
+                caixas = [
+                    (item.get('id_caixa'), item.get('pnt_inicial', 0), item.get('pnt_final', 0))
+                    for item in dados_pnt_inicial_final
+                ]
+                caixas = [(id_caixa, pnt_inicial, pnt_final) for id_caixa, pnt_inicial, pnt_final in caixas
+                          if pnt_inicial and pnt_final]
+
+                # recortar o arruamento de uma vez, para servir de 'linha centro' para cada caixa
+                arruamento.recorta_arruamento_em_lote(street_code, caixas)
+
+                # obtem a dist. maxima p/ utilizar na criacao de cada caixa:
+                dists_caixas = {
+                    id_caixa: demandas.get_maior_distancia_arruamento(id_caixa) for id_caixa, _, _ in caixas
+                }
+                # buffers de todas as caixas da rua de uma vez; a inserção segue uma a uma
+                poligonos_caixas = areas_caixa.constroi_caixas(dists_caixas)
+
+                for id_caixa, dist_maxima_arruamento in dists_caixas.items():
+                    caixa = areas_caixa.add_area_caixa(id_caixa, dist_maxima_arruamento, poligonos_caixas[id_caixa])
+                    if not caixa:
+                        # cria uma lista com o arruamentos onde nao foram geradas caixas
+                        arruamentos_nao_atendidos.append(street_code)
+
+        # calcula a soma dos market-index dentro de cada caixa criada
+        areas_caixa.calcula_market_index()
+
+        # Verifica quais demanadas ficaram sem caixa (associado = 0)
+        demandas.atualiza_campo_associado(areas_caixa.consome_alteracoes('associado'))
+        etapa.saida = areas_caixa.get_layer().GetFeatureCount()
+
+    with instrumentacao.etapa('caixas_secundarias') as etapa:
+        # liga as demandas sem caixa por linhas, as recortando nas interseccoes das caixas
+        linhas_demandas = demandas.atualiza_id_caixa_demandas()
+
+        # atualiza o campo id_caixa, a partir dos ids caixas gerados acima
+        demandas.atualiza_campo_id_caixa()
+
+        caixas_secundarias = demandas.get_caixas_sem_associacao()
+        etapa.entrada = len(caixas_secundarias)
+
+        arruamentos_recortados_secundarios = arruamento.get_arruamento_recortado_secundario(caixas_secundarias)
+
+        dists_caixas = {id_caixa: demandas.get_maior_distancia_arruamento(id_caixa) for id_caixa in caixas_secundarias}
+        poligonos_caixas = areas_caixa.constroi_caixas(dists_caixas)
+
+        for id_caixa, dist_maxima_arruamento in dists_caixas.items():
+            caixa = areas_caixa.add_area_caixa_secundaria(id_caixa, dist_maxima_arruamento, poligonos_caixas[id_caixa])
+
+        demandas.atualiza_campo_associado(areas_caixa.consome_alteracoes('associado'))
+        areas_caixa.calcula_market_index()
+        etapa.saida = areas_caixa.get_layer().GetFeatureCount()
+
+    with instrumentacao.etapa('absorcao') as etapa:
+        etapa.entrada = areas_caixa.get_layer().GetFeatureCount()
+        areas_caixa.absorve_demandas_sem_caixa()
+        demandas.atualiza_campo_associado(areas_caixa.consome_alteracoes('associado'))
+        areas_caixa.calcula_market_index()
+        etapa.saida = areas_caixa.get_layer().GetFeatureCount()
+
+    with instrumentacao.etapa('divisao_maior_8') as etapa:
+        caixas_maiores_8 = areas_caixa.get_parametros_caixas_m8()
+        etapa.entrada = len(caixas_maiores_8)
+
+        # areas_caixa.apaga_caixas_8m()
+
+        divide_caixas_maiores_8(caixas_maiores_8, arruamento, demandas, areas_caixa)
+
+        areas_caixa.calcula_market_index()
+        etapa.saida = areas_caixa.get_layer().GetFeatureCount()
+
+    with instrumentacao.etapa('exportacao') as etapa:
+        # o id_caixa e o associado das demandas ficaram no armazém durante o fluxo
+        demandas_ordenadas = demandas.grava_demandas_ordenadas()
+        if anterior:
+            incorpora_saida_anterior(ds_associado, saida_anterior, afetados)
+
+        areas_caixa = ds_associado.GetLayer('areas_de_caixa')
+        arruamento_recortado_lyr = ds_associado.GetLayer('lyr_arruamento_recortado')
+
+        os.makedirs(output_dir, exist_ok=True)
+        exporta_layers({
+            'demandas_ordenadas': demandas_ordenadas,
+            'arruamento_recortado': arruamento_recortado_lyr,
+            'areas_caixa': areas_caixa,
+        }, output_dir, formato, precisao)
+        grava_parametros(output_dir, formato, precisao)
+        etapa.saida = (
+            demandas_ordenadas.GetFeatureCount() + arruamento_recortado_lyr.GetFeatureCount()
+            + areas_caixa.GetFeatureCount()
+        )
+
+    end_time = time.time()
+    total_time = end_time - start_time
+    logger.info('Tempo total de processamento: %.2f segundos', total_time)
+
+    if rastreio:
+        instrumentacao.exporta_chrome_trace(rastreio)
+    if metricas:
+        instrumentacao.exporta_json(metricas)
+
+    resultado = {'tempo_total': total_time, 'etapas': instrumentacao.tempos(), 'resumo': instrumentacao.resumo()}
+    if rastreio_sql:
+        ds_associado.relata()
+        ds_associado.exporta_json(rastreio_sql)
+        resultado['sql_repetidas'] = ds_associado.consultas_repetidas()
+
+    return resultado
@@ -0,0 +1,94 @@
+import json
+import re
+import time
+from collections import defaultdict
+
+from classes.instrumentacao import instrumentacao, logger
+
+RE_TEXTO = re.compile(r"'(?:[^']|'')*'")
+RE_NUMERO = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b')
+RE_LISTA = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+RE_ESPACO = re.compile(r'\s+')
+
+
+def normaliza_sql(sql):
+    """
+        Forma da consulta: literais de texto e números viram '?', listas de
+        IN viram '(?...)' e os espaços são colapsados. Consultas que só
+        diferem nos valores (ex.: o StreetCode do laço) têm a mesma forma.
+    """
+    forma = RE_TEXTO.sub('?', sql)
+    forma = RE_NUMERO.sub('?', forma)
+    forma = RE_LISTA.sub('(?...)', forma)
+    return RE_ESPACO.sub(' ', forma).strip()
+
+
+class DataSourceRastreado:
+    """
+        Envolve um DataSource do OGR registrando cada ExecuteSQL: forma
+        normalizada, duração, quantidade de linhas e a etapa do fluxo em que
+        foi executada. Os demais métodos são repassados ao DataSource.
+
+        A contagem de linhas usa GetFeatureCount do resultado, o que pode
+        custar uma segunda passada da consulta; o tempo registrado não a inclui.
+    """
+
+    def __init__(self, datasource):
+        self.datasource = datasource
+        self.consultas = []
+
+    def __getattr__(self, nome):
+        return getattr(self.datasource, nome)
+
+    def ExecuteSQL(self, sql, *args, **kwargs):
+        inicio = time.perf_counter()
+        resultado = self.datasource.ExecuteSQL(sql, *args, **kwargs)
+        duracao = time.perf_counter() - inicio
+
+        linhas = resultado.GetFeatureCount() if resultado is not None else 0
+        pilha = instrumentacao.pilha()
+        self.consultas.append({
+            'etapa': pilha[0].nome if pilha else None,
+            'forma': normaliza_sql(sql),
+            'duracao': duracao,
+            'linhas': linhas,
+        })
+        logger.debug('SQL %.4f s, %d linhas: %s', duracao, linhas, RE_ESPACO.sub(' ', sql).strip())
+        return resultado
+
+    def resumo(self):
+        """ Totais por (etapa, forma): execuções, tempo e linhas, do mais caro ao mais barato. """
+        grupos = defaultdict(lambda: {'execucoes': 0, 'tempo': 0.0, 'linhas': 0})
+        for consulta in self.consultas:
+            grupo = grupos[(consulta['etapa'], consulta['forma'])]
+            grupo['execucoes'] += 1
+            grupo['tempo'] += consulta['duracao']
+            grupo['linhas'] += consulta['linhas']
+
+        return sorted(
+            ({'etapa': etapa, 'forma': forma, **totais} for (etapa, forma), totais in grupos.items()),
+            key=lambda grupo: grupo['tempo'], reverse=True,
+        )
+
+    def consultas_repetidas(self, limite=1000):
+        """
+            Formas executadas pelo menos `limite` vezes numa mesma etapa: SQL
+            por linha dentro de um laço (N+1), candidata a virar um caminho em lote.
+        """
+        return [grupo for grupo in self.resumo() if grupo['execucoes'] >= limite]
+
+    def relata(self, limite=1000):
+        for grupo in self.consultas_repetidas(limite):
+            logger.warning(
+                'consulta repetida %d vezes na etapa %s (%.3f s, %d linhas): %s',
+                grupo['execucoes'], grupo['etapa'], grupo['tempo'], grupo['linhas'], grupo['forma'],
+            )
+
+    def exporta_json(self, caminho, limite=1000):
+        with open(caminho, 'w') as arquivo:
+            json.dump({
+                'total': len(self.consultas),
+                'tempo': sum(consulta['duracao'] for consulta in self.consultas),
+                'repetidas': self.consultas_repetidas(limite),
+                'resumo': self.resumo(),
+            }, arquivo, indent=2)
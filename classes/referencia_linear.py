@@ -0,0 +1,187 @@
+import numpy as np
+import shapely
+from osgeo import ogr
+
+from classes.indice_espacial import para_ogr
+
+ogr.UseExceptions()
+
+
+class LinhaMedida:
+    """
+        Linha com a medida (distância acumulada desde o início) de cada
+        vértice, para projetar pontos e extrair trechos direto dos arrays de
+        coordenadas, sem SQL nem WKT. Só LineStrings: o ST_Line_Substring do
+        SQLite também não recorta MultiLineStrings.
+    """
+
+    def __init__(self, coordenadas, atributos=None):
+        self.coordenadas = np.asarray(coordenadas, dtype=np.float64)[:, :2]
+        self.segmentos = np.diff(self.coordenadas, axis=0)
+        self.quadrados = (self.segmentos ** 2).sum(axis=1)
+        self.comprimentos = np.sqrt(self.quadrados)
+        self.medidas = np.concatenate(([0.0], np.cumsum(self.comprimentos)))
+        self.atributos = atributos or {}
+
+    @classmethod
+    def de_ogr(cls, geometria, atributos=None):
+        if geometria is None or ogr.GT_Flatten(geometria.GetGeometryType()) != ogr.wkbLineString:
+            return None
+        if geometria.GetPointCount() < 2:
+            return None
+        return cls(geometria.GetPoints(), atributos)
+
+    @classmethod
+    def de_shapely(cls, geometria, atributos=None):
+        if geometria is None or geometria.geom_type != 'LineString' or len(geometria.coords) < 2:
+            return None
+        return cls(shapely.get_coordinates(geometria), atributos)
+
+    @property
+    def comprimento(self):
+        return float(self.medidas[-1])
+
+    def localiza(self, pontos):
+        """
+            Medida da projeção de cada ponto na linha, como
+            ST_Line_Locate_Point(ST_ClosestPoint(...)) (mas em unidades de
+            comprimento, não normalizada). Havendo empate, vale o primeiro
+            segmento, como no GEOS.
+
+            Args:
+                pontos: array (n, 2) de coordenadas.
+
+            Returns:
+                np.ndarray: n medidas.
+        """
+        pontos = np.asarray(pontos, dtype=np.float64).reshape(-1, 2)
+        origens = self.coordenadas[:-1]
+
+        # parâmetro da projeção em cada segmento (pontos x segmentos), limitado ao segmento
+        relativos = pontos[:, None, :] - origens[None, :, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = (relativos * self.segmentos[None, :, :]).sum(axis=2) / self.quadrados
+        t = np.clip(np.nan_to_num(t, nan=0.0), 0.0, 1.0)
+
+        distancias = ((relativos - t[:, :, None] * self.segmentos[None, :, :]) ** 2).sum(axis=2)
+        segmento = np.argmin(distancias, axis=1)
+        linhas = np.arange(len(pontos))
+        return self.medidas[segmento] + t[linhas, segmento] * self.comprimentos[segmento]
+
+    def interpola(self, medida):
+        """ Coordenadas do ponto da linha na medida informada. """
+        segmento = int(np.clip(np.searchsorted(self.medidas, medida, side='right') - 1, 0, len(self.segmentos) - 1))
+        if self.comprimentos[segmento] == 0:
+            return self.coordenadas[segmento]
+        t = (medida - self.medidas[segmento]) / self.comprimentos[segmento]
+        return self.coordenadas[segmento] + t * self.segmentos[segmento]
+
+    def trecho(self, inicio, fim):
+        """
+            Coordenadas do trecho entre duas medidas (ST_Line_Substring), ou
+            None quando o trecho é degenerado (fim <= inicio).
+        """
+        if fim <= inicio:
+            return None
+        internos = (self.medidas > inicio) & (self.medidas < fim)
+        return np.vstack((self.interpola(inicio), self.coordenadas[internos], self.interpola(fim)))
+
+    def recorta(self, ponto_inicial, ponto_final):
+        """ Trecho entre as projeções dos dois pontos (x, y), ou None. """
+        inicio, fim = self.localiza([ponto_inicial, ponto_final])
+        return self.trecho(inicio, fim)
+
+    def recorta_em_lote(self, pares):
+        """
+            Trechos de vários pares (ponto_inicial, ponto_final): todos os
+            pontos são projetados numa única chamada de localiza.
+
+            Returns:
+                list: coordenadas do trecho (ou None) de cada par, na ordem dos pares.
+        """
+        if not len(pares):
+            return []
+        medidas = self.localiza(np.asarray(pares, dtype=np.float64).reshape(-1, 2)).reshape(-1, 2)
+        return [self.trecho(inicio, fim) for inicio, fim in medidas.tolist()]
+
+
+def para_ogr_linha(coordenadas):
+    return para_ogr(shapely.linestrings(coordenadas))
+
+
+class ReferenciaLinear:
+    """
+        LinhaMedida das feições de uma layer, agrupadas pelo valor de um campo
+        (ex.: StreetCode). A layer é lida uma única vez, na primeira consulta,
+        e as medidas de cada linha são reaproveitadas em todos os recortes
+        seguintes; alterações posteriores na layer não são vistas.
+    """
+
+    def __init__(self, layer, campo='StreetCode', campos=()):
+        self.layer = layer
+        self.campo = campo
+        self.campos = campos
+        self.linhas = None
+
+    def carrega(self):
+        self.linhas = {}
+        for feature in self.layer:
+            # mesmo as feições sem linha válida ocupam a chave, para que ela não seja relida
+            linhas = self.linhas.setdefault(feature[self.campo], [])
+            linha = LinhaMedida.de_ogr(
+                feature.GetGeometryRef(), {campo: feature[campo] for campo in self.campos}
+            )
+            if linha is not None:
+                linhas.append(linha)
+        self.layer.ResetReading()
+        return self
+
+    def __contains__(self, valor):
+        if self.linhas is None:
+            self.carrega()
+        return valor in self.linhas
+
+    def get(self, valor):
+        """ Linhas com o valor no campo, na ordem da layer. """
+        if self.linhas is None:
+            self.carrega()
+        return self.linhas.get(valor, [])
+
+    def linhas_do_valor(self, valor):
+        # recortar por um valor ausente é erro de chave (ex.: StreetCode em str), não um recorte vazio
+        if valor not in self:
+            raise KeyError(f'{self.campo} = {valor!r} não existe na layer {self.layer.GetName()}')
+        return self.linhas[valor]
+
+    def recorta(self, valor, ponto_inicial, ponto_final):
+        """
+            Recorta cada linha com o valor no campo entre as projeções dos dois
+            pontos, como o ST_Line_Substring aplicado a cada feição.
+
+            Returns:
+                list: (LinhaMedida, coordenadas do trecho) das linhas com trecho não degenerado.
+
+            Raises:
+                KeyError: nenhuma feição tem o valor no campo.
+        """
+        trechos = []
+        for linha in self.linhas_do_valor(valor):
+            trecho = linha.recorta(ponto_inicial, ponto_final)
+            if trecho is not None:
+                trechos.append((linha, trecho))
+        return trechos
+
+    def recorta_em_lote(self, valor, pares):
+        """
+            Como recorta, para vários pares (ponto_inicial, ponto_final) das
+            mesmas linhas: cada linha é percorrida uma única vez.
+
+            Returns:
+                list: para cada par, a lista de (LinhaMedida, coordenadas do trecho).
+        """
+        trechos = [[] for _ in pares]
+        for linha in self.linhas_do_valor(valor):
+            for i, trecho in enumerate(linha.recorta_em_lote(pares)):
+                if trecho is not None:
+                    trechos[i].append((linha, trecho))
+        return trechos
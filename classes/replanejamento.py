@@ -0,0 +1,219 @@
+import os
+from collections import defaultdict
+
+import shapely
+from osgeo import ogr
+
+from classes.exportacao import ARQUIVO_PARAMETROS, FORMATOS, caminhos_layers, get_driver, le_parametros
+from classes.indice_espacial import para_shapely
+
+ogr.UseExceptions()
+
+# layer de saída: (layer de trabalho no DataSource, campo com o StreetCode)
+SAIDAS = {
+    'demandas_ordenadas': ('layer_demandas_ordenadas', 'StreetCode'),
+    'arruamento_recortado': ('lyr_arruamento_recortado', 'StreetCode'),
+    'areas_caixa': ('areas_de_caixa', 'StreetCode_associado'),
+}
+
+
+def arquivos_saida(output_dir):
+    """ Arquivos da saída de uma execução, no formato em que foi exportada. """
+    parametros = le_parametros(output_dir)
+    caminhos = caminhos_layers(output_dir, SAIDAS, parametros['formato'], parametros['arquivo'])
+    arquivos = list(dict.fromkeys(caminho for caminho, _ in caminhos.values()))
+    parametros_saida = os.path.join(output_dir, ARQUIVO_PARAMETROS)
+    return arquivos + ([parametros_saida] if os.path.exists(parametros_saida) else [])
+
+
+def carrega_saida_anterior(output_dir):
+    """
+        Copia as saídas de uma execução anterior para um DataSource em
+        memória, de modo que o diretório possa ser sobrescrito pela nova
+        execução. O formato e a precisão vêm do parametros_saida.json gravado
+        na exportação (sem ele, GeoJSON sem arredondamento).
+
+        Returns:
+            tuple: (DataSource, parâmetros da exportação anterior).
+    """
+    parametros = le_parametros(output_dir)
+    if parametros['formato'] not in FORMATOS:
+        raise ValueError(f"formato da saída anterior desconhecido: {parametros['formato']}")
+    # driver ausente nesta instalação: erro claro antes de tentar abrir os arquivos
+    get_driver(parametros['formato'])
+
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('saida_anterior')
+    caminhos = caminhos_layers(output_dir, SAIDAS, parametros['formato'], parametros['arquivo'])
+    for nome, (caminho, nome_layer) in caminhos.items():
+        if not os.path.exists(caminho):
+            raise FileNotFoundError(f'saída anterior não encontrada: {caminho}')
+        ds_origem = ogr.Open(caminho)
+        layer = ds_origem.GetLayerByName(nome_layer) or ds_origem.GetLayer()
+        datasource.CopyLayer(layer, nome)
+    return datasource, parametros
+
+
+def geometrias_campo(layer, campo):
+    """ Geometrias (shapely) e valores do campo das feições com geometria, na ordem da layer. """
+    geometrias, valores = [], []
+    for feature in layer:
+        if feature.GetGeometryRef() is not None:
+            geometrias.append(para_shapely(feature.GetGeometryRef()))
+            valores.append(feature[campo])
+    layer.ResetReading()
+    return geometrias, valores
+
+
+def assinaturas_demandas(layer, casas=3):
+    """ {id_demanda: (StreetCode, market-index, x, y)}: o que, mudando, exige replanejar a rua. """
+    assinaturas = {}
+    for feature in layer:
+        geometria = feature.GetGeometryRef()
+        assinaturas[feature['id_demanda']] = (
+            feature['StreetCode'], feature['market-index'],
+            round(geometria.GetX(), casas), round(geometria.GetY(), casas),
+        )
+    layer.ResetReading()
+    return assinaturas
+
+
+def street_codes_alterados(lyr_demandas, lyr_demandas_anterior, casas=3):
+    """
+        StreetCodes cujo conjunto de demandas mudou: demandas incluídas,
+        removidas, com outro market-index, outra posição ou outro StreetCode
+        (nesse caso, a rua antiga e a nova). As posições são comparadas com
+        `casas` decimais, que não deve passar da precisão da saída anterior.
+    """
+    novas = assinaturas_demandas(lyr_demandas, casas)
+    anteriores = assinaturas_demandas(lyr_demandas_anterior, casas)
+
+    alterados = set()
+    for id_demanda in novas.keys() | anteriores.keys():
+        nova, anterior = novas.get(id_demanda), anteriores.get(id_demanda)
+        if nova != anterior:
+            alterados.update(
+                assinatura[0] for assinatura in (nova, anterior) if assinatura is not None and assinatura[0] is not None
+            )
+    return alterados
+
+
+def street_codes_vizinhos(street_codes, lyr_areas_anterior, lyr_arruamento):
+    """
+        Ruas que interagem com as ruas alteradas: as que têm caixa (na execução
+        anterior) interceptando uma caixa delas, já que as caixas se bloqueiam
+        umas às outras, e as que cruzam ou tocam o arruamento delas.
+    """
+    vizinhos = set()
+    for layer, campo in ((lyr_areas_anterior, 'StreetCode_associado'), (lyr_arruamento, 'StreetCode')):
+        geometrias, codigos = geometrias_campo(layer, campo)
+        alteradas = [geometria for geometria, street_code in zip(geometrias, codigos) if street_code in street_codes]
+        if not alteradas:
+            continue
+
+        _, vizinhas = shapely.STRtree(geometrias).query(alteradas, predicate='intersects')
+        vizinhos.update(codigos[i] for i in vizinhas.tolist())
+
+    vizinhos.discard(None)
+    return vizinhos - set(street_codes)
+
+
+def fecha_por_contencao(street_codes, lyr_demandas, lyr_areas_anterior):
+    """
+        Acrescenta, até estabilizar, as ruas ligadas às replanejadas por uma
+        demanda de uma dentro de uma caixa anterior da outra. Numa execução
+        completa, essa demanda seria associada àquela caixa e contaria no seu
+        market-index; replanejando as duas, a associação e o market-index são
+        calculados com ambas presentes.
+    """
+    caixas, codigos_caixas = geometrias_campo(lyr_areas_anterior, 'StreetCode_associado')
+    pontos, codigos_demandas = geometrias_campo(lyr_demandas, 'StreetCode')
+    afetados = set(street_codes)
+    if not caixas or not pontos:
+        return afetados
+
+    ligacoes = defaultdict(set)
+    indices_caixas, indices_demandas = shapely.STRtree(pontos).query(caixas, predicate='contains')
+    for i, j in zip(indices_caixas.tolist(), indices_demandas.tolist()):
+        rua_caixa, rua_demanda = codigos_caixas[i], codigos_demandas[j]
+        if rua_caixa is not None and rua_demanda is not None and rua_caixa != rua_demanda:
+            ligacoes[rua_caixa].add(rua_demanda)
+            ligacoes[rua_demanda].add(rua_caixa)
+
+    pendentes = list(afetados)
+    while pendentes:
+        for street_code in ligacoes.get(pendentes.pop(), ()):
+            if street_code not in afetados:
+                afetados.add(street_code)
+                pendentes.append(street_code)
+    return afetados
+
+
+def street_codes_afetados(lyr_demandas, saida_anterior, lyr_arruamento, precisao=None):
+    """
+        Args:
+            precisao: casas decimais da saída anterior; as posições são
+                comparadas com no máximo essa precisão.
+
+        Returns:
+            tuple: (StreetCodes alterados, alterados + vizinhos a replanejar).
+    """
+    casas = 3 if precisao is None else min(3, precisao)
+    lyr_areas_anterior = saida_anterior.GetLayer('areas_caixa')
+    alterados = street_codes_alterados(lyr_demandas, saida_anterior.GetLayer('demandas_ordenadas'), casas)
+    vizinhos = street_codes_vizinhos(alterados, lyr_areas_anterior, lyr_arruamento)
+    afetados = fecha_por_contencao(alterados | vizinhos, lyr_demandas, lyr_areas_anterior)
+    return alterados, afetados
+
+
+def restringe_demandas(lyr_demandas, street_codes):
+    """ Apaga da layer as demandas das ruas que não serão replanejadas. """
+    fids = [feature.GetFID() for feature in lyr_demandas if feature['StreetCode'] not in street_codes]
+    lyr_demandas.ResetReading()
+    lyr_demandas.StartTransaction()
+    for fid in fids:
+        lyr_demandas.DeleteFeature(fid)
+    lyr_demandas.CommitTransaction()
+    return lyr_demandas.GetFeatureCount()
+
+
+def caixas_mantidas(saida_anterior, street_codes):
+    """
+        Geometrias (shapely) das caixas anteriores das ruas que não serão
+        replanejadas. Elas só barram as caixas novas: não entram na associação
+        nem no market-index, o que fecha_por_contencao torna desnecessário
+        para as demandas que elas já continham. Fica uma aproximação: uma
+        caixa replanejada que passe a cobrir outra área pode conter demandas
+        mantidas sem somá-las, e o recorte das linhas entre demandas sem caixa
+        (caixas secundárias) não vê as caixas mantidas.
+    """
+    geometrias, codigos = geometrias_campo(saida_anterior.GetLayer('areas_caixa'), 'StreetCode_associado')
+    return [geometria for geometria, street_code in zip(geometrias, codigos) if street_code not in street_codes]
+
+
+def proximo_id(saida_anterior, street_codes):
+    """ Primeiro id livre para as demandas replanejadas, depois das demandas mantidas. """
+    layer = saida_anterior.GetLayer('demandas_ordenadas')
+    ids = [feature['id'] for feature in layer if feature['StreetCode'] not in street_codes]
+    layer.ResetReading()
+    return max(ids, default=0) + 1
+
+
+def incorpora_saida_anterior(datasource, saida_anterior, street_codes):
+    """
+        Acrescenta às layers de trabalho as feições anteriores das ruas que não
+        foram replanejadas, para que a exportação tenha a área completa.
+    """
+    for nome, (nome_trabalho, campo) in SAIDAS.items():
+        origem = saida_anterior.GetLayer(nome)
+        destino = datasource.GetLayer(nome_trabalho)
+        defn = destino.GetLayerDefn()
+
+        destino.StartTransaction()
+        for feature_origem in origem:
+            if feature_origem[campo] in street_codes:
+                continue
+            feature = ogr.Feature(defn)
+            feature.SetFrom(feature_origem)
+            destino.CreateFeature(feature)
+        destino.CommitTransaction()
+        origem.ResetReading()
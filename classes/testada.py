@@ -1,5 +1,9 @@
+import numpy as np
+import shapely
 from osgeo import ogr
-from shapely.geometry import LineString
+
+from classes.indice_espacial import IndiceEspacial, geometrias_layer
+from classes.instrumentacao import instrumenta
 
 ogr.UseExceptions()
 
@@ -15,13 +19,16 @@ class Testada:
     def get_srs(self):
         return self.get_layer_origem().GetSpatialRef()
 
-    def gerar_testadas(self):
+    @instrumenta
+    def gerar_testadas(self, em_lote=True):
         """
             Esta função retorna uma camada do tipo ponto, para cada centróide do
             alinhamento predial, contendo o StreetCode do mesmo.
 
             Args:
-                datasource_entrada: DataSource de entrada.
+                em_lote: se True, o StreetCode é associado em uma única passada
+                    sobre um índice espacial do arruamento; caso contrário, usa
+                    uma consulta SQL por testada.
 
             Returns:
                 layer: layer_testada.
@@ -34,24 +41,98 @@ class Testada:
         layer_testada.CreateField(ogr.FieldDefn('id_testada', ogr.OFTInteger))
         layer_testada.CreateField(ogr.FieldDefn('StreetCode', ogr.OFTInteger))
 
-        i = 1
+        self.insere_pontos_medios(layer_testada, *self.calcula_pontos_medios(lyr_origem))
+
+        # Atualiza o campo StreetCode por aproximação do centroide em rel. ao arruamento:
+        if em_lote:
+            self.atualiza_streetcode_em_lote(layer_testada)
+        else:
+            self.atualiza_streetcode_sql(layer_testada)
+
+        self.datasource_entrada.CopyLayer(layer_testada, 'layer_testada')
+
+        return layer_testada
+
+    def calcula_pontos_medios(self, lyr_origem):
+        """
+            Calcula, de uma só vez, o ponto médio de todos os segmentos do
+            alinhamento predial a partir dos arrays de coordenadas.
+
+            Args:
+                lyr_origem: layer de linhas do alinhamento predial.
+
+            Returns:
+                tuple: array (n, 2) com os pontos médios e array com o
+                    id_alinhamento_predial de cada ponto, na ordem dos segmentos.
+        """
+        wkbs = []
+        ids_alinhamento = []
         for feicao in lyr_origem:
-            linestring = feicao.GetGeometryRef()
-            vertices = linestring.GetPoints()
+            wkbs.append(bytes(feicao.GetGeometryRef().ExportToWkb()))
+            ids_alinhamento.append(feicao.GetField('id_alinhamento_predial'))
+        lyr_origem.ResetReading()
+
+        partes, indice_feicao = shapely.get_parts(shapely.from_wkb(wkbs), return_index=True)
+        coordenadas, indice_parte = shapely.get_coordinates(partes, return_index=True)
+
+        # só são segmentos os pares de vértices consecutivos da mesma parte
+        mesma_parte = indice_parte[:-1] == indice_parte[1:]
+        pontos_medios = (coordenadas[:-1][mesma_parte] + coordenadas[1:][mesma_parte]) / 2
+        ids_segmentos = np.asarray(ids_alinhamento, dtype=object)[indice_feicao[indice_parte[:-1][mesma_parte]]]
+
+        return pontos_medios, ids_segmentos
+
+    def insere_pontos_medios(self, layer_testada, pontos_medios, ids_alinhamento):
+        layer_testada.StartTransaction()
+        defn = layer_testada.GetLayerDefn()
+        for i, ((x, y), id_alinhamento) in enumerate(zip(pontos_medios.tolist(), ids_alinhamento), start=1):
+            ponto = ogr.Geometry(ogr.wkbPoint)
+            ponto.AddPoint_2D(x, y)
+            testada_feicao = ogr.Feature(defn)
+            testada_feicao.SetGeometry(ponto)
+            testada_feicao.SetField('id_alinhamento_predial', id_alinhamento)
+            testada_feicao.SetField('id_testada', i)
+            testada_feicao.SetField('StreetCode', None)
+            layer_testada.CreateFeature(testada_feicao)
+        layer_testada.CommitTransaction()
 
-            segmentos = list(map(LineString, zip(vertices[:-1], vertices[1:])))
+        return layer_testada
 
-            for segmento in segmentos:
-                testada_feicao = ogr.Feature(layer_testada.GetLayerDefn())
-                testada_feicao.SetGeometry(ogr.CreateGeometryFromWkt(segmento.centroid.wkt))
-                testada_feicao.SetField('id_alinhamento_predial', feicao.GetField('id_alinhamento_predial'))
-                testada_feicao.SetField('id_testada', i)
-                testada_feicao.SetField('StreetCode', None)
-                layer_testada.CreateFeature(testada_feicao)
-                i += 1
+    @instrumenta
+    def atualiza_streetcode_em_lote(self, layer_testada, layer_arruamento='layer_arruamento'):
+        """
+            Associa a cada testada o StreetCode do arruamento mais próximo, usando
+            um índice espacial das linhas construído uma única vez.
 
-        # Atualiza o campo StreetCode por aproximação do centroide em rel. ao arruamento:
-        query = None
+            Args:
+                layer_testada: layer de pontos gerada por gerar_testadas.
+                layer_arruamento: nome da layer de arruamento no DataSource.
+
+            Returns:
+                layer: layer_testada.
+        """
+        indice_arruamento = IndiceEspacial(
+            self.datasource_entrada.GetLayer(layer_arruamento), campos=('StreetCode',)
+        )
+        fids, pontos = geometrias_layer(layer_testada)
+        mais_proximos = dict(zip(fids, indice_arruamento.mais_proximos(pontos)))
+
+        layer_testada.StartTransaction()
+        for feature in layer_testada:
+            posicao = mais_proximos.get(feature.GetFID(), -1)
+            if posicao >= 0:
+                feature.SetField('StreetCode', indice_arruamento.atributos['StreetCode'][posicao])
+                layer_testada.SetFeature(feature)
+        layer_testada.CommitTransaction()
+
+        return layer_testada
+
+    @instrumenta
+    def atualiza_streetcode_sql(self, layer_testada):
+        """
+            Versão original, com uma consulta SQL por testada. Mantida para
+            comparação com o modo em lote.
+        """
         ids_testada_list = [feat.GetField('id_testada') for feat in layer_testada]
         for id_testada in ids_testada_list:
             layer_testada.SetAttributeFilter(f'id_testada = {id_testada}')
@@ -76,8 +157,6 @@ class Testada:
             layer_testada.CommitTransaction()
             layer_testada.SetAttributeFilter(None)
 
-        self.datasource_entrada.CopyLayer(layer_testada, 'layer_testada')
-
-        self.datasource_entrada.ReleaseResultSet(query)
+            self.datasource_entrada.ReleaseResultSet(query)
 
         return layer_testada
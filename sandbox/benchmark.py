@@ -0,0 +1,127 @@
+"""
+    Benchmark do fluxo completo sobre as áreas de data/input, com aquecimento,
+    repetições e tempos por etapa gravados em JSON.
+
+    Exemplo:
+        python benchmark.py --repeticoes 5 --resultado benchmark.json
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import shapely
+from osgeo import gdal
+
+from classes.pipeline import processa_area
+
+ETAPAS = (
+    'carga', 'associacao', 'ordenacao', 'caixas_primarias', 'caixas_secundarias',
+    'absorcao', 'divisao_maior_8', 'exportacao',
+)
+
+
+def resume(valores):
+    return {
+        'min': min(valores),
+        'max': max(valores),
+        'media': statistics.fmean(valores),
+        'mediana': statistics.median(valores),
+        'desvio': statistics.stdev(valores) if len(valores) > 1 else 0.0,
+    }
+
+
+def executa(input_dir, output_dir, **kwargs):
+    # o log de progresso do fluxo atrapalharia a leitura do benchmark
+    logging.getLogger('algoritmo').setLevel(logging.WARNING)
+    return processa_area(input_dir, output_dir, instrumentar=True, **kwargs)
+
+
+def mede_area(input_dir, repeticoes, aquecimento, **kwargs):
+    with tempfile.TemporaryDirectory() as output_dir:
+        for _ in range(aquecimento):
+            executa(input_dir, output_dir, **kwargs)
+
+        execucoes = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            resultado = executa(input_dir, output_dir, **kwargs)
+            resultado['tempo_total'] = time.perf_counter() - inicio
+            execucoes.append(resultado)
+
+    return {
+        'area': os.path.basename(os.path.normpath(input_dir)),
+        'execucoes': execucoes,
+        'tempo_total': resume([execucao['tempo_total'] for execucao in execucoes]),
+        'etapas': {
+            etapa: resume([execucao['etapas'].get(etapa, 0.0) for execucao in execucoes])
+            for etapa in ETAPAS
+        },
+    }
+
+
+def versao_codigo():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ambiente():
+    return {
+        'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': versao_codigo(),
+        'python': platform.python_version(),
+        'gdal': gdal.__version__,
+        'shapely': shapely.__version__,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def imprime_resumo(areas):
+    print(f"{'area':<12} {'total':>9} " + ' '.join(f'{etapa[:10]:>10}' for etapa in ETAPAS))
+    for area in areas:
+        colunas = ' '.join(f"{area['etapas'][etapa]['mediana']:>10.3f}" for etapa in ETAPAS)
+        print(f"{area['area']:<12} {area['tempo_total']['mediana']:>9.3f} {colunas}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark do fluxo de geração de caixas.')
+    parser.add_argument('areas', nargs='*', default=['data/input/area_*'], help='diretórios ou padrões glob')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--aquecimento', type=int, default=1)
+    parser.add_argument('--paralelo', action='store_true', help='usa o modo paralelo das caixas primárias')
+    parser.add_argument('--resultado', default='benchmark.json', help='arquivo JSON de saída')
+    args = parser.parse_args(argv)
+
+    areas = sorted({caminho for padrao in args.areas for caminho in glob.glob(padrao) if os.path.isdir(caminho)})
+
+    resultados = []
+    for input_dir in areas:
+        print(f'medindo {input_dir}...', file=sys.stderr)
+        resultados.append(mede_area(input_dir, args.repeticoes, args.aquecimento, paralelo=args.paralelo))
+
+    with open(args.resultado, 'w') as arquivo:
+        json.dump({
+            'ambiente': ambiente(),
+            'parametros': {
+                'repeticoes': args.repeticoes, 'aquecimento': args.aquecimento, 'paralelo': args.paralelo,
+            },
+            'areas': resultados,
+        }, arquivo, indent=2)
+
+    imprime_resumo(resultados)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+    Compara os formatos de exportação (tempo de gravação e tamanho dos
+    arquivos) sobre saídas já geradas em data/output.
+
+    Exemplo:
+        python benchmark_exportacao.py data/output/area_1 --precisao 3 --repeticoes 5
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from osgeo import ogr
+
+from classes.exportacao import FORMATOS, exporta_layers, get_driver
+
+ogr.UseExceptions()
+
+LAYERS = ('demandas_ordenadas', 'arruamento_recortado', 'areas_caixa')
+
+
+def carrega_saidas(output_dir):
+    """ Copia as layers de saída (GeoJSON) de uma área para um DataSource em memória. """
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('saidas')
+    layers = {}
+    for nome in LAYERS:
+        caminho = os.path.join(output_dir, f'{nome}.geojson')
+        if os.path.exists(caminho):
+            layers[nome] = datasource.CopyLayer(ogr.Open(caminho).GetLayer(), nome)
+    return datasource, layers
+
+
+def mede_formato(layers, formato, precisao, repeticoes):
+    tempos = []
+    with tempfile.TemporaryDirectory() as diretorio:
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            caminhos = exporta_layers(layers, diretorio, formato, precisao)
+            tempos.append(time.perf_counter() - inicio)
+        tamanho = sum(os.path.getsize(caminho) for caminho in caminhos)
+
+    return {'tempo_mediana': statistics.median(tempos), 'tempo_min': min(tempos), 'bytes': tamanho}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark dos formatos de exportação.')
+    parser.add_argument('saidas', nargs='*', default=['data/output/area_*'], help='diretórios de saída ou padrões glob')
+    parser.add_argument('--formatos', nargs='+', default=list(FORMATOS), choices=list(FORMATOS))
+    parser.add_argument('--precisao', type=int, default=None, help='casas decimais das coordenadas')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--resultado', default='benchmark_exportacao.json', help='arquivo JSON de saída')
+    args = parser.parse_args(argv)
+
+    diretorios = sorted({caminho for padrao in args.saidas for caminho in glob.glob(padrao) if os.path.isdir(caminho)})
+
+    resultados = []
+    print(f"{'area':<12} {'formato':<8} {'tempo (s)':>10} {'tamanho (kB)':>13}")
+    for output_dir in diretorios:
+        datasource, layers = carrega_saidas(output_dir)
+        if not layers:
+            continue
+        area = os.path.basename(os.path.normpath(output_dir))
+        for formato in args.formatos:
+            try:
+                get_driver(formato)
+            except ValueError as e:
+                resultados.append({'area': area, 'formato': formato, 'erro': str(e)})
+                print(f'{area:<12} {formato:<8} {e}')
+                continue
+            medida = mede_formato(layers, formato, args.precisao, args.repeticoes)
+            resultados.append({'area': area, 'formato': formato, **medida})
+            print(f"{area:<12} {formato:<8} {medida['tempo_mediana']:>10.4f} {medida['bytes'] / 1024:>13.1f}")
+
+    with open(args.resultado, 'w') as arquivo:
+        json.dump({
+            'parametros': {'precisao': args.precisao, 'repeticoes': args.repeticoes},
+            'resultados': resultados,
+        }, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+    Gera uma área sintética no mesmo esquema de data/input/area_*, para medir
+    como cada etapa escala com o número de demandas.
+
+    A cidade é uma grade de ruas (com os cruzamentos deslocados conforme a
+    irregularidade); cada quadra tem um alinhamento predial recuado das ruas,
+    e demandas, lotes e postes são distribuídos ao longo deles.
+
+    Exemplo:
+        python gera_cidade_sintetica.py data/input/sintetica_100k --ruas 120 --densidade 0.6
+"""
+import argparse
+import os
+
+import numpy as np
+import shapely
+from osgeo import ogr, osr
+
+ogr.UseExceptions()
+
+EPSG = 31982
+ORIGEM = (545000.0, 7755000.0)
+
+
+def gera_cruzamentos(n_linhas, n_colunas, tamanho_quadra, irregularidade, rng):
+    ii, jj = np.meshgrid(np.arange(n_linhas), np.arange(n_colunas), indexing='ij')
+    x = ORIGEM[0] + jj * tamanho_quadra
+    y = ORIGEM[1] + ii * tamanho_quadra
+    deslocamento = irregularidade * tamanho_quadra / 2
+    x = x + rng.uniform(-deslocamento, deslocamento, x.shape)
+    y = y + rng.uniform(-deslocamento, deslocamento, y.shape)
+    return np.stack([x, y], axis=-1)
+
+
+def gera_arruamento(cruzamentos):
+    n_linhas, n_colunas, _ = cruzamentos.shape
+    ruas = [shapely.LineString(cruzamentos[i, :, :]) for i in range(n_linhas)]
+    ruas += [shapely.LineString(cruzamentos[:, j, :]) for j in range(n_colunas)]
+    return ruas
+
+
+def gera_quadras(cruzamentos, recuo):
+    n_linhas, n_colunas, _ = cruzamentos.shape
+    quadras = []
+    for i in range(n_linhas - 1):
+        for j in range(n_colunas - 1):
+            quadra = shapely.Polygon([
+                cruzamentos[i, j], cruzamentos[i, j + 1], cruzamentos[i + 1, j + 1], cruzamentos[i + 1, j],
+            ]).buffer(-recuo, join_style='mitre')
+            if isinstance(quadra, shapely.Polygon) and not quadra.is_empty:
+                quadras.append(quadra)
+    return quadras
+
+
+def pontos_ao_longo(linha, espacamento, rng):
+    if linha.length < espacamento:
+        return np.empty((0, 2))
+    distancias = np.arange(rng.uniform(0, espacamento), linha.length, espacamento)
+    return shapely.get_coordinates(shapely.line_interpolate_point(linha, distancias))
+
+
+def gera_cidade(n_ruas, densidade, irregularidade, tamanho_quadra=100.0, recuo=8.0, seed=0):
+    """
+        Args:
+            n_ruas: quantidade de ruas (metade em cada direção da grade).
+            densidade: demandas por metro de alinhamento predial.
+            irregularidade: 0 (grade regular) a 1 (cruzamentos deslocados em
+                até meia quadra).
+            tamanho_quadra: distância nominal entre ruas, em metros.
+            recuo: distância do alinhamento predial ao eixo da rua, em metros.
+            seed: semente do gerador aleatório.
+
+        Returns:
+            dict: layers no formato {nome: (tipo de geometria, campos, feições)}.
+    """
+    rng = np.random.default_rng(seed)
+    n_linhas = max(n_ruas // 2, 2)
+    n_colunas = max(n_ruas - n_ruas // 2, 2)
+
+    cruzamentos = gera_cruzamentos(n_linhas, n_colunas, tamanho_quadra, irregularidade, rng)
+    ruas = gera_arruamento(cruzamentos)
+    quadras = gera_quadras(cruzamentos, recuo)
+    alinhamentos = [quadra.exterior for quadra in quadras]
+    indice_ruas = shapely.STRtree(ruas)
+
+    # demandas ao longo do alinhamento, recuadas 2 m para dentro da quadra
+    # (quadras estreitas demais para o recuo ficam com as demandas no alinhamento)
+    recuadas = []
+    for quadra, alinhamento in zip(quadras, alinhamentos):
+        interior = quadra.buffer(-2.0, join_style='mitre')
+        if isinstance(interior, shapely.Polygon) and not interior.is_empty:
+            recuadas.append(interior.exterior)
+        else:
+            recuadas.append(alinhamento)
+    coordenadas = [pontos_ao_longo(linha, 1 / densidade, rng) for linha in recuadas]
+    pontos = np.concatenate(coordenadas) if coordenadas else np.empty((0, 2))
+    pontos = pontos + rng.normal(0, 0.5, pontos.shape)
+    market_index = rng.choice([0.5, 1.0, 2.0], size=len(pontos), p=[0.7, 0.25, 0.05])
+
+    # um lote a cada ~3 demandas, com o StreetCode da rua mais próxima
+    lotes = pontos[::3]
+    rua_lote = indice_ruas.query_nearest(shapely.points(lotes), return_distance=False, all_matches=False)[1]
+
+    postes = np.concatenate([pontos_ao_longo(rua.offset_curve(4), 35.0, rng) for rua in ruas])
+
+    xmin, ymin, xmax, ymax = shapely.total_bounds(ruas)
+
+    return {
+        'layer_arruamento': (ogr.wkbLineString, [('StreetCode_antigo', ogr.OFTInteger), ('StreetCode', ogr.OFTInteger)], [
+            (rua, {'StreetCode_antigo': 1000 + i, 'StreetCode': i}) for i, rua in enumerate(ruas, start=1)
+        ]),
+        'layer_demandas': (ogr.wkbPoint, [('id_demanda', ogr.OFTInteger), ('market-index', ogr.OFTReal)], [
+            (shapely.Point(xy), {'id_demanda': i, 'market-index': float(mi)})
+            for i, (xy, mi) in enumerate(zip(pontos, market_index), start=1)
+        ]),
+        'layer_lote': (ogr.wkbPoint, [('id_lote', ogr.OFTInteger), ('StreetCode', ogr.OFTString)], [
+            (shapely.Point(xy), {'id_lote': i, 'StreetCode': str(rua + 1)})
+            for i, (xy, rua) in enumerate(zip(lotes, rua_lote), start=1)
+        ]),
+        'layer_alinhamento_predial': (ogr.wkbLineString, [('id_alinhamento_predial', ogr.OFTInteger)], [
+            (shapely.LineString(alinhamento.coords), {'id_alinhamento_predial': i})
+            for i, alinhamento in enumerate(alinhamentos, start=1)
+        ]),
+        'layer_postes': (ogr.wkbPoint, [('id_poste', ogr.OFTInteger)], [
+            (shapely.Point(xy), {'id_poste': i}) for i, xy in enumerate(postes, start=1)
+        ]),
+        'layer_delimitacao': (ogr.wkbPolygon, [('id', ogr.OFTString)], [
+            (shapely.box(xmin, ymin, xmax, ymax), {'id': 'sintetica'})
+        ]),
+    }
+
+
+def grava_layer(output_dir, nome, tipo_geometria, campos, feicoes):
+    caminho = os.path.join(output_dir, f'{nome}.geojson')
+    driver = ogr.GetDriverByName('GeoJSON')
+    if os.path.exists(caminho):
+        driver.DeleteDataSource(caminho)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+
+    ds = driver.CreateDataSource(caminho)
+    layer = ds.CreateLayer(nome, srs=srs, geom_type=tipo_geometria)
+    for campo, tipo in campos:
+        layer.CreateField(ogr.FieldDefn(campo, tipo))
+
+    layer.StartTransaction()
+    for geometria, atributos in feicoes:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(shapely.to_wkb(geometria)))
+        for campo, valor in atributos.items():
+            feature.SetField(campo, valor)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    ds = None
+
+    return len(feicoes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera uma área sintética para testes de escala.')
+    parser.add_argument('saida', help='diretório da área (ex.: data/input/sintetica_1)')
+    parser.add_argument('--ruas', type=int, default=40, help='quantidade de ruas')
+    parser.add_argument('--densidade', type=float, default=0.3, help='demandas por metro de alinhamento')
+    parser.add_argument('--irregularidade', type=float, default=0.2, help='0 (regular) a 1')
+    parser.add_argument('--quadra', type=float, default=100.0, help='tamanho nominal da quadra, em metros')
+    parser.add_argument('--sem-lote', action='store_true', help='não gera layer_lote (força o uso da testada)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    layers = gera_cidade(args.ruas, args.densidade, args.irregularidade, args.quadra, seed=args.seed)
+    if args.sem_lote:
+        del layers['layer_lote']
+
+    os.makedirs(args.saida, exist_ok=True)
+    for nome, (tipo_geometria, campos, feicoes) in layers.items():
+        quantidade = grava_layer(args.saida, nome, tipo_geometria, campos, feicoes)
+        print(f'{nome}: {quantidade} feições')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+    Processa várias áreas em paralelo, cada uma em seu próprio processo (com o
+    seu próprio DataSource em memória).
+
+    Exemplo:
+        python processa_areas.py 'data/input/area_*' --workers 4
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from classes.cache_etapas import CacheEtapas
+from classes.memoria import MemoriaExcedida
+from classes.replanejamento import arquivos_saida
+from classes.pipeline import processa_area
+
+
+def expande_areas(padroes):
+    areas = []
+    for padrao in padroes:
+        encontrados = sorted(glob.glob(padrao)) or [padrao]
+        areas.extend(caminho for caminho in encontrados if os.path.isdir(caminho))
+    return list(dict.fromkeys(areas))
+
+
+def executa_area(input_dir, output_root, orcamento_mb=None, cache_dir=None, incremental=False):
+    """
+        Processa uma área no processo atual, isolando falhas: uma exceção vira
+        um resultado com status 'erro' em vez de interromper o lote. O log do
+        fluxo vai para processa_area.log e as etapas, no formato Chrome trace,
+        para rastreio.json no diretório de saída. Com orcamento_mb, a área que
+        passa do orçamento de memória falha com o relatório de memória. Com
+        cache_dir, as etapas cujas entradas não mudaram são lidas do cache.
+        Com incremental, a saída já existente da área é a execução anterior
+        e só as ruas com demandas alteradas (e vizinhas) são replanejadas.
+    """
+    area = os.path.basename(os.path.normpath(input_dir))
+    output_dir = os.path.join(output_root, area)
+    os.makedirs(output_dir, exist_ok=True)
+
+    resultado = {'area': area, 'input_dir': input_dir, 'output_dir': output_dir, 'pid': os.getpid()}
+    anterior = None
+    if incremental and all(os.path.exists(caminho) for caminho in arquivos_saida(output_dir)):
+        anterior = output_dir
+    inicio = time.perf_counter()
+    with open(os.path.join(output_dir, 'processa_area.log'), 'w') as log, contextlib.redirect_stdout(log):
+        logging.basicConfig(stream=log, level=logging.INFO, format='%(asctime)s %(message)s', force=True)
+        try:
+            resultado.update(processa_area(
+                input_dir, output_dir, instrumentar=True, rastreio=os.path.join(output_dir, 'rastreio.json'),
+                memoria=orcamento_mb is not None, orcamento_mb=orcamento_mb,
+                cache=CacheEtapas(cache_dir) if cache_dir else None, anterior=anterior,
+            ) or {})
+            resultado['status'] = 'ok'
+        except MemoriaExcedida as e:
+            resultado['status'] = 'erro'
+            resultado['erro'] = f'{type(e).__name__}: {e}'
+            resultado['memoria'] = e.relatorio
+        except Exception as e:
+            traceback.print_exc(file=log)
+            resultado['status'] = 'erro'
+            resultado['erro'] = f'{type(e).__name__}: {e}'
+    resultado['tempo'] = time.perf_counter() - inicio
+
+    return resultado
+
+
+def processa_areas(areas, output_root, workers=None, orcamento_mb=None, cache_dir=None, incremental=False):
+    """
+        Processa uma lista de diretórios de área em um pool de processos.
+
+        Args:
+            areas: diretórios de entrada, no formato de data/input/area_*.
+            output_root: diretório onde é criado um subdiretório por área.
+            workers: número de processos (padrão: número de CPUs).
+            orcamento_mb: RSS máximo por área (por processo), em MB.
+            cache_dir: diretório do cache de etapas, compartilhado entre as áreas.
+            incremental: replaneja a partir da saída anterior de cada área, se houver.
+
+        Returns:
+            list: um dict por área com status, tempo e, em caso de falha, o erro.
+    """
+    resultados = []
+    # max_tasks_per_child=1: cada área roda em um processo novo, sem estado herdado
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as executor:
+        futuros = {executor.submit(executa_area, area, output_root, orcamento_mb, cache_dir, incremental): area for area in areas}
+        for futuro in as_completed(futuros):
+            area = futuros[futuro]
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                # o processo do worker morreu (ex.: falha dentro do GDAL)
+                resultado = {
+                    'area': os.path.basename(os.path.normpath(area)), 'input_dir': area,
+                    'status': 'erro', 'erro': f'{type(e).__name__}: {e}',
+                }
+            print(f"{resultado['area']}: {resultado['status']} ({resultado.get('tempo', 0):.2f} s)")
+            resultados.append(resultado)
+
+    return sorted(resultados, key=lambda resultado: resultado['input_dir'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Processa várias áreas em paralelo.')
+    parser.add_argument('areas', nargs='+', help='diretórios de área ou padrões glob (ex.: data/input/area_*)')
+    parser.add_argument('--saida', default='data/output', help='diretório raiz de saída')
+    parser.add_argument('--workers', type=int, default=None, help='número de processos (padrão: CPUs)')
+    parser.add_argument('--resultado', default=None, help='arquivo JSON com o resumo do lote')
+    parser.add_argument('--orcamento-mb', type=float, default=None, help='RSS máximo por área, em MB')
+    parser.add_argument('--cache', default=None, help='diretório do cache de etapas entre execuções')
+    parser.add_argument('--incremental', action='store_true', help='replaneja só as ruas alteradas desde a última saída')
+    args = parser.parse_args(argv)
+
+    areas = expande_areas(args.areas)
+    inicio = time.perf_counter()
+    resultados = processa_areas(areas, args.saida, args.workers, args.orcamento_mb, args.cache, args.incremental)
+    tempo_total = time.perf_counter() - inicio
+
+    falhas = [resultado for resultado in resultados if resultado['status'] != 'ok']
+    print(f'{len(resultados)} áreas, {len(falhas)} com erro, tempo total: {tempo_total:.2f} s')
+
+    if args.resultado:
+        with open(args.resultado, 'w') as arquivo:
+            json.dump({'tempo_total': tempo_total, 'areas': resultados}, arquivo, indent=2)
+
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,54 +1,12 @@
-import os
-import time
+import logging
 
 from osgeo import ogr
 
-from classes.area_caixa import AreaCaixa
-from classes.arruamento import Arruamento
-from classes.demanda import Demanda
-from classes.testada import Testada
+from classes.exportacao import exporta_layers
+from classes.pipeline import processa_area
 
 ogr.UseExceptions()
 
-start_time = time.time()
-
-area = 'area_3_1'
-
-input_dir = f'data/input/{area}/'
-output_dir = f'data/output/{area}/'
-
-postes = f'{input_dir}layer_postes.geojson'
-demandas = f'{input_dir}layer_demandas.geojson'
-arruamento = f'{input_dir}layer_arruamento.geojson'
-alinhamento_predial = f'{input_dir}layer_alinhamento_predial.geojson'
-lote = f'{input_dir}layer_lote.geojson'
-
-drv_gjs = ogr.GetDriverByName('GeoJSON')
-ds_postes = drv_gjs.Open(postes)
-ds_arruamento = drv_gjs.Open(arruamento)
-ds_alinhamento_predial = drv_gjs.Open(alinhamento_predial)
-ds_demandas = drv_gjs.Open(demandas)
-ds_lote = drv_gjs.Open(lote)
-
-# criando um banco na memória para manipular as camadas:
-driver_associado = ogr.GetDriverByName('Memory')
-ds_associado = driver_associado.CreateDataSource('ds_associado')
-
-# obtendo as camadas de cada DataSource
-layer_postes = ds_postes.GetLayer()
-layer_arruamento = ds_arruamento.GetLayer()
-layer_alinhamento_predial = ds_alinhamento_predial.GetLayer()
-layer_demandas = ds_demandas.GetLayer()
-layer_lotes = ds_lote.GetLayer()
-
-# ds_associado.CopyLayer(layer_postes, 'layer_postes')
-ds_associado.CopyLayer(layer_arruamento, 'layer_arruamento')
-ds_associado.CopyLayer(layer_alinhamento_predial, 'layer_alinhamento_predial')
-ds_associado.CopyLayer(layer_demandas, 'layer_demandas')
-
-# OBS: se quiser gerar a camada da testada (centróides), é só mudar o nome, ex.: layer_lotesssss
-ds_associado.CopyLayer(layer_lotes, 'layer_lotes')
-
 
 def printa_nomes_das_layers(ds):
     print("\nPrintando nomes das layers")
@@ -101,168 +59,12 @@ def print_layer_head(layer):
     print(f"| Número de feições na camada: {layer.GetFeatureCount()}\n")
 
 
-def export_geojson(out_name, layer_name, output_dir):
-    driver_export = ogr.GetDriverByName('GeoJSON')
-    if os.path.exists(f'{output_dir}{out_name}.geojson'):
-        driver_export.DeleteDataSource(f'{output_dir}{out_name}.geojson')
-
-    ds_export = driver_export.CreateDataSource(f'{output_dir}{out_name}.geojson')
-    ds_export.CopyLayer(layer_name, f'{out_name}')
-    ds_export = None
-
-
-# Recuperar o layer demandas
-demandas = Demanda(ds_associado)
-
-# Recuperar o layer_lote
-layer_lotes = ds_associado.GetLayerByName('layer_lotes')
-
-# realiza a verificação da existência da camada layer_lotes
-if layer_lotes:
-    print('associa streetCode a demandas atravez da camada lote...')
-    demandas_street_code = demandas.associa_streetcode_demanda(layer_lotes)
-else:
-    # caso não exista, será utlizada a testada como base
-    print('associa streetCode a demandas atravez da geracao da testada...')
-    testada = Testada(ds_associado).gerar_testadas()
-    demandas_street_code = demandas.associa_streetcode_demanda(testada)
-
-print('recupera streetcodes com demanda...')
-lista_street_code = demandas.recupera_streetcodes_com_demanda()
-
-arruamento = Arruamento(ds_associado)
-
-arruamento_recortado_lyr = ds_associado.GetLayer('lyr_arruamento_recortado')
-
-# ordenar arruamentos a partir do comprimento
-print('ordena arruamento por comprimento...')
-arruamentos_ordenados = arruamento.ordena_arruamento_por_comprimento(lista_street_code)
-
-# instancia layer areas_de_caixa (vazio)
-areas_caixa = AreaCaixa(ds_associado, distancia_buffer=0)
-
-demandas_ordenadas = None
-
-# utilizado para criar um id unico para cada demanda
-i = 1
-# lista dos arruamentos sem caixa
-arruamentos_nao_atendidos = []
-
-distancias_maximas_dict = {}
-# percorrer arruamentos um a um
-#
-print('percorre os arruamentos ordenados...')
-for feature in arruamentos_ordenados:
-    # ordenar demandas pela distancia do inicio do arruamento
-
-    street_code = feature['StreetCode']
-    print('gera demandas ordenadas por arruamento...')
-    demandas_ordenadas = demandas.get_demandas_ordenadas_por_arruamento(i, street_code)
-
-    # atualiza o id do arruamento de fopyrma que ele fique sequencial
-    i = demandas_ordenadas.GetFeatureCount() + 1
-
-    print('gera pnt_inicial e final das caixas...')
-    dados_pnt_inicial_final = demandas.get_pnt_inicial_final_id_caixas(demandas_ordenadas, street_code)
-
-    for item in dados_pnt_inicial_final:
-        id_caixa = item.get('id_caixa')
-        pnt_inicial = item.get('pnt_inicial', 0)
-        pnt_final = item.get('pnt_final', 0)
-
-        if pnt_inicial and pnt_final:
-            # recortar arruamento para servir de 'linha centro' para a caixa
-            print('recorta arruamento...')
-            arruamento_recortado = arruamento.recorta_arruamento(
-                pnt_inicial,
-                pnt_final,
-                street_code,
-                id_caixa
-            )
-
-            # obtem a dist. maxima p/ utilizar na criacao da caixa:
-            dist_maxima_arruamento = demandas.get_maior_distancia_arruamento(id_caixa)
-
-            caixa = areas_caixa.add_area_caixa(id_caixa, dist_maxima_arruamento)
-            print('gerando caixas:', id_caixa, caixa)
-            if not caixa:
-                # cria uma lista com o arruamentos onde nao foram geradas caixas
-                arruamentos_nao_atendidos.append(street_code)
-
-print('Sai do loop inicial para geracao das caixas...')
-
-# calcula a soma dos market-index dentro de cada caixa criada
-print('calcula market index...')
-areas_caixa.calcula_market_index()
-
-# Verifica quais demanadas ficaram sem caixa (associado = 0)
-print('atualiza campo associado...')
-demandas.atualiza_campo_associado()
-
-# liga as demandas sem caixa por linhas, as recortando nas interseccoes das caixas
-print('cria linhas de demandas...')
-linhas_demandas = demandas.atualiza_id_caixa_demandas()
-
-# atualiza o campo id_caixa, a partir dos ids caixas gerados acima
-print('atualiza campo id_caixa...')
-demandas_ordenadas = demandas.atualiza_campo_id_caixa()
-
-print('lista caixas secundarias...')
-caixas_secundarias = list(set([demanda['id_caixa'] for demanda in demandas_ordenadas if demanda['associado'] == 0]))
-
-print('cria arruamento recortado secundario...')
-arruamentos_recortados_secundarios = arruamento.get_arruamento_recortado_secundario(caixas_secundarias)
-
-for id_caixa in caixas_secundarias:
-    dist_maxima_arruamento = demandas.get_maior_distancia_arruamento(id_caixa)
-    print('cria area de caixa secundaria...', id_caixa)
-    caixa = areas_caixa.add_area_caixa_secundaria(id_caixa, dist_maxima_arruamento)
-
-print('atualiza campo associado (segunda vez)...')
-demandas.atualiza_campo_associado()
-
-print('calcula market index (segunda vez)...')
-areas_caixa.calcula_market_index()
-
-print('absorve demandas sem caixa...')
-areas_caixa.absorve_demandas_sem_caixa()
-
-print('atualiza campo associado (terceira vez)...')
-demandas.atualiza_campo_associado()
-
-print('calcula market index (terceira vez)...')
-areas_caixa.calcula_market_index()
-
-print('encontra caixas maiores que 8...')
-caixas_maiores_8 = areas_caixa.get_parametros_caixas_m8()
-
-# areas_caixa.apaga_caixas_8m()
-
-for caixa in caixas_maiores_8:
-    print('subdividindo os arruamentos das caixas maiores que 8...')
-    arruamento.recorta_arruamento(
-        caixa['ponto_inicial'], caixa['ponto_final'], caixa['street_code'], caixa['id_caixa']
-    )
-    # atualizando os id_caixa das demandas
-    demandas.modifica_id_caixa_maior_8(caixa)
-    # apaga o arruamento anterior, que foi subdividido:
-    arruamento.apaga_arruamento_recortado(caixa['id_caixa_antigo'])
-    # modifica o id_caixa das demandas, da caixa que que foi subdividida:
-    for id_demanda in caixa['demandas']:
-        dist_maxima_arruamento = demandas.get_maior_distancia_arruamento(caixa['id_caixa'])
-        areas_caixa.add_area_caixa_secundaria(caixa['id_caixa'], dist_maxima_arruamento)
-
-print('calcula market index (quarta vez)...')
-areas_caixa.calcula_market_index()
-
-areas_caixa = ds_associado.GetLayer('areas_de_caixa')
-arruamento_recortado_lyr = ds_associado.GetLayer('lyr_arruamento_recortado')
-# ----------------------------------------------------------
+def export_geojson(out_name, layer_name, output_dir, precisao=None):
+    exporta_layers({out_name: layer_name}, output_dir, 'geojson', precisao)
 
-export_geojson('demandas_ordenadas', demandas_ordenadas, output_dir)
-export_geojson('arruamento_recortado', arruamento_recortado_lyr, output_dir)
-export_geojson('areas_caixa', areas_caixa, output_dir)
 
-end_time = time.time()
-total_time = end_time - start_time
-print("Tempo total de processamento:", round(total_time, 2), "segundos")
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    area = 'area_3_1'
+    # com a instrumentação ligada, o início e o fim de cada etapa vão para o log
+    processa_area(f'data/input/{area}/', f'data/output/{area}/', instrumentar=True)
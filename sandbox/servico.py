@@ -0,0 +1,268 @@
+"""
+    Serviço local de geração de caixas: recebe jobs de área por HTTP
+    (localhost) e os executa num pool limitado de processos já aquecidos, com
+    os imports, os drivers e as layers estáticas de cada área em memória.
+
+    Com todas as vagas (workers + fila) ocupadas, novos jobs recebem 503 com
+    Retry-After, em vez de acumular sem limite.
+
+    Exemplo:
+        python servico.py --porta 8765 --workers 4 --fila 8
+        curl -X POST localhost:8765/jobs \\
+            -d '{"input_dir": "data/input/area_1", "output_dir": "data/output/area_1", "esperar": true}'
+        curl localhost:8765/jobs/1
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from osgeo import ogr
+
+from classes.cache_etapas import CacheEtapas
+from classes.carregador import CamadasEstaticas
+from classes.instrumentacao import instrumentacao
+from classes.pipeline import processa_area
+
+ogr.UseExceptions()
+
+# parâmetros de processa_area aceitos no corpo do job
+PARAMETROS = (
+    'paralelo', 'workers', 'metodos', 'rastreio', 'metricas', 'rastreio_sql', 'memoria', 'orcamento_mb',
+    'recorta', 'formato', 'precisao', 'anterior',
+)
+
+# parâmetros que são caminhos: relativos ao output_dir do job e restritos a ele
+CAMINHOS = ('rastreio', 'metricas', 'rastreio_sql', 'anterior')
+
+STATUS_HTTP = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+
+# estado de cada processo do pool, criado por aquece()
+ESTATICAS = None
+CACHE = None
+
+
+def aquece(max_areas, cache_dir):
+    """ Inicializador dos processos do pool: drivers, layers estáticas e cache de etapas. """
+    global ESTATICAS, CACHE
+    for driver in ('GeoJSON', 'Memory', 'GPKG'):
+        ogr.GetDriverByName(driver)
+    ESTATICAS = CamadasEstaticas(max_areas)
+    CACHE = CacheEtapas(cache_dir) if cache_dir else None
+    logging.getLogger('algoritmo').setLevel(logging.WARNING)
+
+
+def aquecido():
+    """ Tarefa vazia enviada a cada worker na partida, para que aquece rode antes do primeiro job. """
+    return os.getpid()
+
+
+def restringe_caminhos(job):
+    """
+        Resolve os parâmetros de CAMINHOS relativos ao output_dir do job.
+
+        Raises:
+            ValueError: se algum deles aponta para fora do output_dir.
+    """
+    output_dir = os.path.realpath(job['output_dir'])
+    for nome in CAMINHOS:
+        if job.get(nome) is None:
+            continue
+        caminho = os.path.realpath(os.path.join(output_dir, str(job[nome])))
+        if os.path.commonpath([caminho, output_dir]) != output_dir:
+            raise ValueError(f'{nome} deve ficar dentro de output_dir')
+        job[nome] = caminho
+    return job
+
+
+def executa_job(job):
+    """ Executado no processo do pool; falhas viram um resultado com status 'erro'. """
+    inicio = time.perf_counter()
+    try:
+        parametros = {nome: job[nome] for nome in PARAMETROS if nome in job}
+        resultado = processa_area(
+            job['input_dir'], job['output_dir'], cache=CACHE, estaticas=ESTATICAS, instrumentar=True, **parametros
+        )
+        resultado['status'] = 'ok'
+    except Exception as e:
+        resultado = {'status': 'erro', 'erro': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+    finally:
+        # o tracemalloc de um job com memoria=True deixaria os seguintes mais lentos
+        instrumentacao.encerra()
+    resultado['pid'] = os.getpid()
+    resultado['tempo'] = time.perf_counter() - inicio
+    return resultado
+
+
+class Servico:
+    """
+        Recebe os jobs e os distribui no pool. Cada job ocupa uma vaga do
+        envio até a conclusão; os jobs concluídos ficam consultáveis (os
+        max_jobs mais recentes).
+    """
+
+    def __init__(self, workers=None, fila=None, max_areas=16, cache_dir=None, max_jobs=1000):
+        self.workers = workers or os.cpu_count()
+        self.inicializacao = (max_areas, cache_dir)
+        self.executor = self.cria_executor()
+        self.vagas = self.workers + (self.workers if fila is None else fila)
+        self.em_curso = 0
+        self.jobs = OrderedDict()
+        self.max_jobs = max_jobs
+        self.ids = itertools.count(1)
+
+    def cria_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=aquece, initargs=self.inicializacao)
+
+    def aquece_pool(self):
+        """
+            O pool só cria os processos ao receber tarefas: uma tarefa vazia
+            por worker, enviadas juntas, faz cada processo nascer e rodar
+            aquece antes do primeiro job.
+        """
+        futuros = [self.executor.submit(aquecido) for _ in range(self.workers)]
+        pids = {futuro.result() for futuro in futuros}
+        logging.info('%d processos aquecidos', len(pids))
+
+    def envia(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            return loop.run_in_executor(self.executor, executa_job, job)
+        except BrokenProcessPool:
+            # um worker morreu: o pool é recriado (e as layers estáticas, recarregadas)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.cria_executor()
+            return loop.run_in_executor(self.executor, executa_job, job)
+
+    def estado(self):
+        return {'em_curso': self.em_curso, 'vagas': self.vagas, 'jobs': len(self.jobs)}
+
+    def submete(self, job):
+        """ Envia o job ao pool; retorna (registro, futuro) ou None sem vaga. """
+        if self.em_curso >= self.vagas:
+            return None
+
+        futuro = self.envia(job)
+        self.em_curso += 1
+
+        id_job = next(self.ids)
+        registro = {'id': id_job, 'status': 'pendente', 'input_dir': job['input_dir'], 'recebido': time.time()}
+        self.jobs[id_job] = registro
+        if len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+
+        def conclui(futuro):
+            self.em_curso -= 1
+            if futuro.cancelled():
+                registro['status'] = 'cancelado'
+            elif futuro.exception() is not None:
+                # o processo do worker morreu (ex.: falha dentro do GDAL)
+                registro.update(status='erro', erro=f'{type(futuro.exception()).__name__}: {futuro.exception()}')
+            else:
+                registro.update(futuro.result())
+            registro['concluido'] = time.time()
+
+        futuro.add_done_callback(conclui)
+        return registro, futuro
+
+    async def trata_job(self, corpo):
+        try:
+            job = json.loads(corpo or b'{}')
+        except json.JSONDecodeError as e:
+            return 400, {'erro': f'JSON inválido: {e}'}
+        if not isinstance(job, dict) or 'input_dir' not in job or 'output_dir' not in job:
+            return 400, {'erro': 'input_dir e output_dir são obrigatórios'}
+        if not os.path.isdir(job['input_dir']):
+            return 400, {'erro': f"input_dir não encontrado: {job['input_dir']}"}
+        try:
+            restringe_caminhos(job)
+        except ValueError as e:
+            return 400, {'erro': str(e)}
+
+        submetido = self.submete(job)
+        if submetido is None:
+            return 503, {'erro': 'sem vagas, tente novamente', **self.estado()}
+        registro, futuro = submetido
+
+        if job.get('esperar'):
+            # o cliente interativo espera o resultado na mesma conexão
+            await asyncio.wait([futuro])
+            return 200, registro
+        return 202, {'id': registro['id'], 'status': registro['status']}
+
+    async def rota(self, metodo, caminho, corpo):
+        partes = [parte for parte in caminho.split('?')[0].split('/') if parte]
+        if metodo == 'POST' and partes == ['jobs']:
+            return await self.trata_job(corpo)
+        if metodo == 'GET' and len(partes) == 2 and partes[0] == 'jobs' and partes[1].isdigit():
+            registro = self.jobs.get(int(partes[1]))
+            return (200, registro) if registro is not None else (404, {'erro': 'job não encontrado'})
+        if metodo == 'GET' and partes == ['estado']:
+            return 200, self.estado()
+        return 404, {'erro': f'rota não encontrada: {metodo} {caminho}'}
+
+    async def atende(self, reader, writer):
+        """ HTTP/1.1 mínimo: uma requisição por conexão, corpo e resposta em JSON. """
+        try:
+            linha = (await reader.readline()).decode('latin-1').split()
+            if len(linha) < 2:
+                return
+            metodo, caminho = linha[0], linha[1]
+
+            cabecalhos = {}
+            while (cabecalho := (await reader.readline()).decode('latin-1').strip()):
+                nome, _, valor = cabecalho.partition(':')
+                cabecalhos[nome.strip().lower()] = valor.strip()
+            corpo = await reader.readexactly(int(cabecalhos.get('content-length', 0)))
+
+            status, resposta = await self.rota(metodo, caminho, corpo)
+            conteudo = json.dumps(resposta, default=str).encode()
+            extra = 'Retry-After: 1\r\n' if status == 503 else ''
+            writer.write((
+                f'HTTP/1.1 {status} {STATUS_HTTP[status]}\r\n'
+                f'Content-Type: application/json\r\nContent-Length: {len(conteudo)}\r\n'
+                f'{extra}Connection: close\r\n\r\n'
+            ).encode() + conteudo)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', porta=8765):
+        servidor = await asyncio.start_server(self.atende, host, porta)
+        logging.info('servindo em %s:%d (%d vagas)', host, porta, self.vagas)
+        async with servidor:
+            await servidor.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serviço local de geração de caixas.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None, help='processos do pool (padrão: CPUs)')
+    parser.add_argument('--fila', type=int, default=None, help='jobs aguardando além dos em execução (padrão: workers)')
+    parser.add_argument('--max-areas', type=int, default=16, help='áreas com layers estáticas em memória, por processo')
+    parser.add_argument('--cache', default=None, help='diretório do cache de etapas')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    servico = Servico(args.workers, args.fila, args.max_areas, args.cache)
+    try:
+        servico.aquece_pool()
+        asyncio.run(servico.serve(args.host, args.porta))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servico.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+    main()
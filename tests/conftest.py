@@ -0,0 +1,5 @@
+import os
+import sys
+
+# os testes importam classes.* a partir da raiz do repositório, como os scripts do sandbox
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+import pytest
+import shapely
+
+from classes.armazem_demandas import ArmazemDemandas
+
+
+@pytest.fixture
+def armazem():
+    armazem = ArmazemDemandas(capacidade=1)
+    for id, x in enumerate((0.0, 10.0, 20.0), start=1):
+        armazem.adiciona(id, 100 + id, 5, 2.0, 1.5, '5.1', x, 0.0, fid=id - 1)
+    return armazem
+
+
+def test_alteracoes_ficam_no_armazem_ate_a_gravacao(armazem):
+    armazem.set_id_caixa(2, '5.2')
+    armazem.set_associado(0, 1)
+    # valores iguais aos atuais não contam como alteração
+    armazem.set_id_caixa(1, '5.1')
+    armazem.set_associado(1, 0)
+
+    assert armazem.alteradas == {0, 2}
+    assert armazem.linhas_caixa('5.1').tolist() == [0, 1]
+    assert armazem.linhas_caixa('5.2').tolist() == [2]
+
+
+def test_arvore_indexa_as_linhas(armazem):
+    linhas = armazem.get_arvore().query(shapely.box(5, -1, 25, 1))
+
+    assert sorted(linhas.tolist()) == [1, 2]
+
+
+def test_grava_so_as_linhas_alteradas(armazem):
+    ogr = pytest.importorskip('osgeo.ogr')
+    layer = ogr.GetDriverByName('Memory').CreateDataSource('teste').CreateLayer(
+        'layer_demandas_ordenadas', geom_type=ogr.wkbPoint
+    )
+    layer.CreateField(ogr.FieldDefn('id_caixa', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('associado', ogr.OFTInteger))
+    for _ in range(len(armazem)):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('id_caixa', '5.1')
+        feature.SetField('associado', 0)
+        layer.CreateFeature(feature)
+
+    armazem.set_id_caixa(2, '5.2')
+    armazem.set_associado(2, 1)
+    armazem.grava(layer)
+
+    assert [(feature['id_caixa'], feature['associado']) for feature in layer] == [
+        ('5.1', 0), ('5.1', 0), ('5.2', 1),
+    ]
+    assert not armazem.alteradas
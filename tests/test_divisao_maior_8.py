@@ -0,0 +1,101 @@
+from collections import Counter
+
+import pytest
+
+ogr = pytest.importorskip('osgeo.ogr')
+
+from classes.area_caixa import AreaCaixa
+from classes.arruamento import Arruamento
+from classes.demanda import Demanda
+from classes.pipeline import divide_caixas_maiores_8
+
+STREET_CODE = 7
+
+
+@pytest.fixture
+def area():
+    """
+        Uma rua (StreetCode 7, de 0 a 100 m) com quatro demandas de 2.5 a 2 m
+        dela, todas numa única caixa de market-index 10, como depois da
+        absorção.
+    """
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('teste')
+
+    lyr_arruamento = datasource.CreateLayer('layer_arruamento', geom_type=ogr.wkbLineString)
+    lyr_arruamento.CreateField(ogr.FieldDefn('StreetCode', ogr.OFTInteger))
+    feature = ogr.Feature(lyr_arruamento.GetLayerDefn())
+    feature.SetField('StreetCode', STREET_CODE)
+    feature.SetGeometry(ogr.CreateGeometryFromWkt('LINESTRING (0 0, 100 0)'))
+    lyr_arruamento.CreateFeature(feature)
+
+    lyr_demandas = datasource.CreateLayer('layer_demandas', geom_type=ogr.wkbPoint)
+    lyr_demandas.CreateField(ogr.FieldDefn('id_demanda', ogr.OFTInteger))
+    lyr_demandas.CreateField(ogr.FieldDefn('StreetCode', ogr.OFTInteger))
+    lyr_demandas.CreateField(ogr.FieldDefn('market-index', ogr.OFTReal))
+    for id_demanda, x in enumerate((10, 30, 60, 90), start=1):
+        feature = ogr.Feature(lyr_demandas.GetLayerDefn())
+        feature.SetField('id_demanda', id_demanda)
+        feature.SetField('StreetCode', STREET_CODE)
+        feature.SetField('market-index', 2.5)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POINT ({x} 2)'))
+        lyr_demandas.CreateFeature(feature)
+
+    demandas = Demanda(datasource)
+    demandas.gera_demandas_ordenadas_em_lote([STREET_CODE])
+    # a ordenação fecha a caixa 7.1 em 7.5; a quarta demanda entra nela como na absorção
+    demandas.armazem.set_id_caixa(demandas.armazem.linha_por_id[4], f'{STREET_CODE}.1')
+
+    arruamento = Arruamento(datasource, armazem=demandas.armazem)
+    areas_caixa = AreaCaixa(datasource, distancia_buffer=0, armazem=demandas.armazem)
+    arruamento.recorta_arruamento((0.0, 0.0), (100.0, 0.0), STREET_CODE, f'{STREET_CODE}.1')
+    areas_caixa.add_area_caixa(f'{STREET_CODE}.1', 2.0)
+    areas_caixa.calcula_market_index()
+
+    return arruamento, demandas, areas_caixa
+
+
+def caixas(areas_caixa):
+    return [(feature['id_caixa'], feature.GetGeometryRef().GetArea()) for feature in areas_caixa.get_layer()]
+
+
+def test_parametros_das_metades_usam_street_code_da_rua(area):
+    _, _, areas_caixa = area
+
+    parametros = areas_caixa.get_parametros_caixas_m8()
+
+    assert [caixa['id_caixa'] for caixa in parametros] == ['7.1.1', '7.1.2']
+    assert [caixa['demandas'] for caixa in parametros] == [[1, 2], [3, 4]]
+    assert all(caixa['street_code'] == STREET_CODE for caixa in parametros)
+    assert all(isinstance(caixa['street_code'], int) for caixa in parametros)
+
+
+def test_caixa_maior_8_dividida_em_duas(area):
+    arruamento, demandas, areas_caixa = area
+    assert [id_caixa for id_caixa, _ in caixas(areas_caixa)] == ['7.1']
+
+    divide_caixas_maiores_8(areas_caixa.get_parametros_caixas_m8(), arruamento, demandas, areas_caixa)
+
+    lyr_arruamento_recortado = arruamento.datasource_entrada.GetLayer('lyr_arruamento_recortado')
+    recortados = Counter(feature['id_caixa'] for feature in lyr_arruamento_recortado)
+    assert recortados == {'7.1.1': 1, '7.1.2': 1}
+    assert sorted(id_caixa for id_caixa, _ in caixas(areas_caixa)) == ['7.1.1', '7.1.2']
+    assert all(area_caixa > 0 for _, area_caixa in caixas(areas_caixa))
+
+
+def test_recorte_por_street_code_inexistente_falha(area):
+    arruamento, _, _ = area
+
+    with pytest.raises(KeyError):
+        arruamento.get_referencia().recorta(str(STREET_CODE), (0.0, 0.0), (100.0, 0.0))
+
+
+def test_cada_metade_inserida_uma_vez(area):
+    arruamento, demandas, areas_caixa = area
+    quantidade_antes = areas_caixa.get_layer().GetFeatureCount()
+
+    divide_caixas_maiores_8(areas_caixa.get_parametros_caixas_m8(), arruamento, demandas, areas_caixa)
+
+    # a caixa maior que 8 dá lugar às suas duas metades, sem cópias vazias
+    assert areas_caixa.get_layer().GetFeatureCount() == quantidade_antes + 1
+    assert Counter(id_caixa for id_caixa, _ in caixas(areas_caixa)) == {'7.1.1': 1, '7.1.2': 1}
+    assert not any(feature.GetGeometryRef().IsEmpty() for feature in areas_caixa.get_layer())
@@ -0,0 +1,46 @@
+import pytest
+
+ogr = pytest.importorskip('osgeo.ogr')
+
+from classes.area_caixa import AreaCaixa
+
+
+def quadrado(x):
+    return ogr.CreateGeometryFromWkt(f'POLYGON (({x} 0, {x + 10} 0, {x + 10} 10, {x} 10, {x} 0))')
+
+
+@pytest.fixture
+def areas_caixa():
+    datasource = ogr.GetDriverByName('Memory').CreateDataSource('teste')
+    lyr_demandas = datasource.CreateLayer('layer_demandas_ordenadas', geom_type=ogr.wkbPoint)
+    lyr_demandas.CreateField(ogr.FieldDefn('market-index', ogr.OFTReal))
+    for x, market_index in ((2, 1.0), (5, 2.0), (25, 4.0), (45, 5.0)):
+        feature = ogr.Feature(lyr_demandas.GetLayerDefn())
+        feature.SetField('market-index', market_index)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f'POINT ({x} 5)'))
+        lyr_demandas.CreateFeature(feature)
+    return AreaCaixa(datasource, distancia_buffer=0)
+
+
+def market_index(areas_caixa):
+    return [feature['market-index'] for feature in areas_caixa.get_layer()]
+
+
+def test_feicoes_do_mesmo_id_caixa_tem_somas_proprias(areas_caixa):
+    areas_caixa.insere_caixa_primaria(quadrado(0), '3.1', 3, 2.0)
+    areas_caixa.insere_caixa_primaria(quadrado(20), '3.1', 3, 2.0)
+
+    areas_caixa.calcula_market_index()
+
+    assert market_index(areas_caixa) == [3.0, 4.0]
+
+
+def test_recalculo_incremental_mantem_as_somas_por_feicao(areas_caixa):
+    areas_caixa.insere_caixa_primaria(quadrado(0), '3.1', 3, 2.0)
+    areas_caixa.insere_caixa_primaria(quadrado(20), '3.1', 3, 2.0)
+    areas_caixa.calcula_market_index()
+
+    areas_caixa.insere_caixa_primaria(quadrado(40), '3.1', 3, 2.0)
+    areas_caixa.calcula_market_index()
+
+    assert market_index(areas_caixa) == [3.0, 4.0, 5.0]
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from classes.instrumentacao import instrumentacao
+from classes.rastreio_sql import DataSourceRastreado
+
+
+class DataSourceVazio:
+    """ Só o ExecuteSQL que o DataSourceRastreado envolve. """
+
+    def ExecuteSQL(self, sql, *args, **kwargs):
+        return None
+
+
+@pytest.fixture
+def instrumentacao_ativa():
+    instrumentacao.configura(ativo=True)
+    instrumentacao.reinicia()
+    yield instrumentacao
+    instrumentacao.configura(ativo=False)
+
+
+def test_consultas_atribuidas_a_etapa_de_fora(instrumentacao_ativa):
+    datasource = DataSourceRastreado(DataSourceVazio())
+
+    with instrumentacao_ativa.etapa('ordenacao'):
+        datasource.ExecuteSQL('SELECT * FROM layer_arruamento WHERE "StreetCode" IN (1, 2)')
+        with instrumentacao_ativa.etapa('interna'):
+            datasource.ExecuteSQL('SELECT * FROM layer_arruamento WHERE "StreetCode" IN (3)')
+    datasource.ExecuteSQL('SELECT 1')
+
+    assert [consulta['etapa'] for consulta in datasource.consultas] == ['ordenacao', 'ordenacao', None]
+    assert datasource.resumo()[0]['forma'] == 'SELECT * FROM layer_arruamento WHERE "StreetCode" IN (?...)'
+
+
+def grava_geojson(caminho, feicoes):
+    with open(caminho, 'w') as arquivo:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': propriedades, 'geometry': geometria}
+            for propriedades, geometria in feicoes
+        ]}, arquivo)
+
+
+def test_processa_area_atribui_consultas_as_etapas(tmp_path):
+    pytest.importorskip('osgeo.ogr')
+    from classes.pipeline import processa_area
+
+    entrada = tmp_path / 'entrada'
+    entrada.mkdir()
+    grava_geojson(entrada / 'layer_arruamento.geojson', [
+        ({'StreetCode': 7}, {'type': 'LineString', 'coordinates': [[0, 0], [100, 0]]}),
+    ])
+    grava_geojson(entrada / 'layer_alinhamento_predial.geojson', [
+        ({'id_alinhamento_predial': 1}, {'type': 'LineString', 'coordinates': [[0, 8], [100, 8]]}),
+    ])
+    grava_geojson(entrada / 'layer_lote.geojson', [
+        ({'StreetCode': 7}, {'type': 'Polygon', 'coordinates': [[[0, 3], [100, 3], [100, 15], [0, 15], [0, 3]]]}),
+    ])
+    grava_geojson(entrada / 'layer_demandas.geojson', [
+        ({'id_demanda': id_demanda, 'market-index': 1.0}, {'type': 'Point', 'coordinates': [x, 2]})
+        for id_demanda, x in enumerate((10, 30, 60, 90), start=1)
+    ])
+    rastreio_sql = tmp_path / 'rastreio_sql.json'
+
+    # só o rastreio de SQL: nenhuma outra opção liga a instrumentação
+    processa_area(f'{entrada}/', f'{tmp_path / "saida"}/', rastreio_sql=str(rastreio_sql))
+
+    with open(rastreio_sql) as arquivo:
+        resumo = json.load(arquivo)['resumo']
+    etapas = {grupo['etapa'] for grupo in resumo}
+    assert resumo
+    assert None not in etapas
+    assert 'ordenacao' in etapas